@@ -1,94 +1,253 @@
 # app.py - OphtalCAM EMR (PROFESSIONAL MEDICAL VERSION)
 import streamlit as st
 import sqlite3
+import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta, date
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
 import calendar
+import functools
+import csv
+import io
 import os
+import re
 import json
 import hashlib
 import math
 import base64
+import time
+import shutil
+import struct
+import sys
+import tempfile
+import zlib
+import argparse
+import queue
+import threading
+import unicodedata
+import weakref
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # the columnar analytics copy is optional
+    pa = pq = None
 
 st.set_page_config(page_title="OphtalCAM EMR", page_icon="👁️", layout="wide", initial_sidebar_state="collapsed")
 
 # -----------------------
-# Database init + auto-migration
+# Database connection pool (WAL)
 # -----------------------
-@st.cache_resource
-def init_db():
-    # AUTO-MIGRATION - Dodaj sve missing stupce
-    try:
-        conn_temp = sqlite3.connect('ophtalcam.db', check_same_thread=False)
-        c_temp = conn_temp.cursor()
-        
-        # Provjeri i dodaj sve missing stupce
-        tables_columns = {
-            'refraction_exams': [
-                'final_near_od_sphere',
-'final_near_od_cylinder',
-'final_near_od_axis',
-'final_near_od_prism',
-'final_near_od_base',
-'final_near_od_va',
-
-'final_near_os_sphere',
-'final_near_os_cylinder',
-'final_near_os_axis',
-'final_near_os_prism',
-'final_near_os_base',
-'final_near_os_va',
-
-'final_near_deg_od',
-'final_near_deg_os',
-
-'final_add_od',
-'final_add_os',
-
-
-            ],
-            'posterior_segment_exams': [
-                'ophthalmoscopy_od', 'ophthalmoscopy_os'
-            ],
-            'anterior_segment_exams': [
-                'anterior_chamber_depth_od', 'anterior_chamber_depth_os', 
-                'anterior_chamber_volume_od', 'anterior_chamber_volume_os'
-            ],
-            'functional_tests': [
-                'rapd', 'near_point_convergence_break', 'near_point_convergence_recovery'
-            ],
-            'medical_history': [
-                'chief_complaint'
-            ],
-            'contact_lens_prescriptions': [
-                'lens_material', 'lens_color', 'rgp_brand', 'rgp_base_curve', 'rgp_diameter',
-                'rgp_power_od_sphere', 'rgp_power_od_cylinder', 'rgp_power_od_axis', 'rgp_add_od',
-                'rgp_power_os_sphere', 'rgp_power_os_cylinder', 'rgp_power_os_axis', 'rgp_add_os',
-                'scleral_brand', 'scleral_diameter', 'scleral_power_od_sphere', 'scleral_power_od_cylinder', 
-                'scleral_power_od_axis', 'scleral_add_od', 'scleral_power_os_sphere', 'scleral_power_os_cylinder', 
-                'scleral_power_os_axis', 'scleral_add_os', 'ortho_k_parameters', 'ortho_k_treatment_zone', 
-                'ortho_k_reverse_curve', 'ortho_k_alignment_curve', 'ortho_k_landing_zone', 'special_lens_parameters'
-            ]
-        }
-        
-        for table, columns in tables_columns.items():
-            c_temp.execute(f"PRAGMA table_info({table})")
-            existing_columns = [col[1] for col in c_temp.fetchall()]
-            
-            for column in columns:
-                if column not in existing_columns:
-                    c_temp.execute(f"ALTER TABLE {table} ADD COLUMN {column} TEXT")
-                    print(f"Added column {column} to {table}")
-        
-        conn_temp.commit()
-        conn_temp.close()
-        print("Database migration completed successfully")
-    except Exception as e:
-        print(f"Database migration: {e}")
+DB_PATH = 'ophtalcam.db'
+DB_BUSY_TIMEOUT_MS = 5000
+DB_CACHED_STATEMENTS = 256  # prepared statements kept per connection, keyed by SQL text
+ARCHIVE_SYNC_INTERVAL = 5  # seconds a long-lived thread goes without re-checking the archive files
+
+class _PooledConnection(sqlite3.Connection):
+    """sqlite3 connection that remembers what its archive views were built over."""
+    archive_signature = None
+
+class _ConnectionLease:
+    """Ties a pooled connection to the thread that checked it out.
+
+    The lease lives in a threading.local, so when the Streamlit script thread
+    finishes the lease is collected and the connection goes back to the pool."""
+    def __init__(self, conn, checkin):
+        self.conn = conn
+        self.synced_at = None
+        weakref.finalize(self, checkin, conn)
+
+class ConnectionPool:
+    """Per-thread SQLite connections in WAL mode.
+
+    Every script run (one thread per session rerun) gets its own connection, so
+    readers never wait on the writer and concurrent saves only contend for the
+    write lock, bounded by the busy timeout instead of failing with
+    "database is locked"."""
+    def __init__(self, path=DB_PATH, busy_timeout_ms=DB_BUSY_TIMEOUT_MS):
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        self._idle = queue.SimpleQueue()
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000, check_same_thread=False,
+                               cached_statements=DB_CACHED_STATEMENTS, factory=_PooledConnection)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _checkin(self, conn):
+        try:
+            conn.rollback()  # never hand an open transaction to the next thread
+            self._idle.put(conn)
+        except sqlite3.Error:
+            conn.close()
+
+    def migrate(self):
+        """Apply pending migrations on a connection of its own.
+
+        Pooled connections carry the temp <table>_all views, and SQLite checks
+        every view of the connection on ALTER TABLE ... RENAME, so a rebuild
+        migration (refraction_exams_compact) would fail under them. The pooled
+        connections rebuild their views once main.schema_version changes."""
+        conn = self._connect()
+        try:
+            return apply_migrations(conn)
+        finally:
+            conn.close()
+
+    def connection(self):
+        """Connection owned by the calling thread, reused for the whole script run."""
+        lease = getattr(self._local, 'lease', None)
+        if lease is None:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+            lease = _ConnectionLease(conn, self._checkin)
+            self._local.lease = lease
+        if lease.synced_at is None or time.monotonic() - lease.synced_at > ARCHIVE_SYNC_INTERVAL:
+            if self.sync_archives(lease.conn):
+                lease.synced_at = time.monotonic()
+        return lease.conn
+
+    def sync_archives(self, conn):
+        """Attach new archive files and rebuild the <table>_all views when needed.
+
+        connection() calls it once per checkout and then at most every
+        ARCHIVE_SYNC_INTERVAL, so long-lived worker threads pick up newly
+        archived exams too. Skipped inside a transaction, where SQLite can't
+        attach or detach; returns False then."""
+        if conn.in_transaction:
+            return False
+        files = archive_files()
+        limit = conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+        if len(files) > limit:
+            raise RuntimeError(f"{len(files)} archive files, but SQLite attaches at most {limit}: stop the app "
+                               f"and run `python app.py archive --consolidate`")
+        known = conn.archive_signature
+        if known and known[0] == tuple(files) and known == self._archive_signature(conn, files):
+            return True
+        attached = set(archive_schemas(conn))
+        for schema in attached - {f"archive_{year}" for year in files}:
+            conn.execute(f"DETACH DATABASE {schema}")
+        for year, path in files.items():
+            if f"archive_{year}" not in attached:
+                conn.execute(f"ATTACH DATABASE ? AS archive_{year}", (path,))
+        build_archive_views(conn)
+        conn.archive_signature = self._archive_signature(conn, files)
+        return True
+
+    @staticmethod
+    def _archive_signature(conn, files):
+        # archive files on disk (all attached) + the schema of every database the views read
+        return tuple(files), tuple(conn.execute(f"PRAGMA {schema}.schema_version").fetchone()[0]
+                                   for schema in ['main'] + [f"archive_{year}" for year in files])
+
+_worker = threading.local()  # .pool: set by background threads that run outside any script run
+
+def get_conn():
+    """Database connection for the current session thread.
+
+    Background threads have no Streamlit script context, so they set
+    _worker.pool instead of reaching the pool through st.cache_resource."""
+    pool = getattr(_worker, 'pool', None)
+    return (pool or init_db()).connection()
 
-    conn = sqlite3.connect('ophtalcam.db', check_same_thread=False)
-    c = conn.cursor()
+# -----------------------
+# QUERY HELPERS
+# -----------------------
+# Thin wrappers over the raw cursor for reads that don't need a DataFrame.
+# Keep the SQL text constant and pass values as parameters so the prepared
+# statement is reused from the connection's statement cache.
+def scalar(sql, params=(), conn=None):
+    """First column of the first row, or None."""
+    row = (conn or get_conn()).execute(sql, params).fetchone()
+    return row[0] if row else None
+
+def one(sql, params=(), conn=None):
+    """First row as a sqlite3.Row (index or column-name access), or None."""
+    cur = (conn or get_conn()).cursor()
+    cur.row_factory = sqlite3.Row
+    return cur.execute(sql, params).fetchone()
+
+def rows(sql, params=(), conn=None):
+    """All rows as sqlite3.Row objects. Use pd.read_sql only for tables and charts."""
+    cur = (conn or get_conn()).cursor()
+    cur.row_factory = sqlite3.Row
+    return cur.execute(sql, params).fetchall()
 
+# -----------------------
+# Database init + auto-migration
+# -----------------------
+# (index name, table, columns) per migration step. A shipped list is frozen:
+# a new index goes into a new list with its own migration.
+PATIENT_DATE_INDEXES = [  # migration 3: history and report queries filter by patient, sort by date
+    ("idx_medical_history_patient_date", "medical_history", "patient_id, visit_date DESC"),
+    ("idx_refraction_exams_patient_date", "refraction_exams", "patient_id, exam_date DESC"),
+    ("idx_refraction_exams_date", "refraction_exams", "exam_date"),
+    ("idx_functional_tests_patient_date", "functional_tests", "patient_id, test_date DESC"),
+    ("idx_anterior_segment_exams_patient_date", "anterior_segment_exams", "patient_id, exam_date DESC"),
+    ("idx_posterior_segment_exams_patient_date", "posterior_segment_exams", "patient_id, exam_date DESC"),
+    ("idx_contact_lens_prescriptions_patient_date", "contact_lens_prescriptions", "patient_id, prescription_date DESC"),
+    ("idx_appointments_date", "appointments", "appointment_date"),
+    ("idx_appointments_patient_date", "appointments", "patient_id, appointment_date"),
+    ("idx_patients_created_date", "patients", "created_date"),
+    ("idx_patient_group_assignments_patient", "patient_group_assignments", "patient_id, group_id"),
+]
+PATIENT_GENDER_INDEXES = [  # migration 8
+    ("idx_patients_gender", "patients", "gender"),
+]
+PATIENT_NAME_INDEXES = [  # migration 12
+    ("idx_patients_name", "patients", "last_name, first_name"),  # + the implicit rowid: the search keyset order
+]
+BIRTH_DATE_GROUP_INDEXES = [  # migration 13
+    ("idx_patients_date_of_birth", "patients", "date_of_birth"),
+    ("idx_patient_group_assignments_group", "patient_group_assignments", "group_id, patient_id"),
+]
+# Every managed index; archive files get the ones on their tables
+MANAGED_INDEXES = PATIENT_DATE_INDEXES + PATIENT_GENDER_INDEXES + PATIENT_NAME_INDEXES + BIRTH_DATE_GROUP_INDEXES
+
+# Columns added after the first releases; older databases get them through
+# migration 2 (one PRAGMA table_info per table, run once).
+LEGACY_COLUMNS = {
+    'refraction_exams': [
+        'final_near_od_sphere', 'final_near_od_cylinder', 'final_near_od_axis',
+        'final_near_od_prism', 'final_near_od_base', 'final_near_od_va',
+        'final_near_os_sphere', 'final_near_os_cylinder', 'final_near_os_axis',
+        'final_near_os_prism', 'final_near_os_base', 'final_near_os_va',
+        'final_near_deg_od', 'final_near_deg_os',
+        'final_add_od', 'final_add_os'
+    ],
+    'posterior_segment_exams': [
+        'ophthalmoscopy_od', 'ophthalmoscopy_os'
+    ],
+    'anterior_segment_exams': [
+        'anterior_chamber_depth_od', 'anterior_chamber_depth_os', 
+        'anterior_chamber_volume_od', 'anterior_chamber_volume_os'
+    ],
+    'functional_tests': [
+        'rapd', 'near_point_convergence_break', 'near_point_convergence_recovery'
+    ],
+    'medical_history': [
+        'chief_complaint'
+    ],
+    'contact_lens_prescriptions': [
+        'lens_material', 'lens_color', 'rgp_brand', 'rgp_base_curve', 'rgp_diameter',
+        'rgp_power_od_sphere', 'rgp_power_od_cylinder', 'rgp_power_od_axis', 'rgp_add_od',
+        'rgp_power_os_sphere', 'rgp_power_os_cylinder', 'rgp_power_os_axis', 'rgp_add_os',
+        'scleral_brand', 'scleral_diameter', 'scleral_power_od_sphere', 'scleral_power_od_cylinder', 
+        'scleral_power_od_axis', 'scleral_add_od', 'scleral_power_os_sphere', 'scleral_power_os_cylinder', 
+        'scleral_power_os_axis', 'scleral_add_os', 'ortho_k_parameters', 'ortho_k_treatment_zone', 
+        'ortho_k_reverse_curve', 'ortho_k_alignment_curve', 'ortho_k_landing_zone', 'special_lens_parameters'
+    ]
+}
+
+def _migration_base_schema(c):
     # Users table with license info
     c.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -472,6 +631,24 @@ def init_db():
         )
     ''')
 
+def _migration_legacy_columns(c):
+    for table, columns in LEGACY_COLUMNS.items():
+        c.execute(f"PRAGMA table_info({table})")
+        existing_columns = [col[1] for col in c.fetchall()]
+
+        for column in columns:
+            if column not in existing_columns:
+                c.execute(f"ALTER TABLE {table} ADD COLUMN {column} TEXT")
+                print(f"Added column {column} to {table}")
+
+def _migration_indexes(indexes):
+    """Migration step creating `indexes`, one of the frozen lists above."""
+    def step(c):
+        for index_name, table, columns in indexes:
+            c.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table} ({columns})")
+    return step
+
+def _migration_default_data(c):
     # Default admin + groups
     try:
         admin_hash = hashlib.sha256("admin123".encode()).hexdigest()
@@ -496,8 +673,935 @@ def init_db():
         except Exception:
             pass
 
-    conn.commit()
-    return conn
+# -----------------------
+# Compact refraction storage
+# -----------------------
+# One refraction_values row per (exam, stage, eye) replaces the ~80 per-eye
+# columns of the original wide refraction_exams row. Each stage maps its
+# fields onto the legacy wide column names ({eye} is 'od' / 'os'), which
+# is what the refraction_exams_wide compatibility view exposes.
+REFRACTION_VALUE_FIELDS = ('sphere', 'cylinder', 'axis', 'prism', 'base', 'va')
+REFRACTION_EYES = ('od', 'os')
+REFRACTION_STAGES = {
+    'uncorrected': {'va': 'uncorrected_{eye}_va'},
+    'habitual_distance': {
+        'sphere': 'habitual_distance_{eye}_sphere', 'cylinder': 'habitual_distance_{eye}_cylinder',
+        'axis': 'habitual_distance_{eye}_axis', 'prism': 'habitual_distance_{eye}_prism',
+        'base': 'habitual_distance_{eye}_base', 'va': 'habitual_{eye}_va'
+    },
+    'habitual_near': {
+        'sphere': 'habitual_near_{eye}_sphere', 'cylinder': 'habitual_near_{eye}_cylinder',
+        'axis': 'habitual_near_{eye}_axis', 'prism': 'habitual_near_{eye}_prism',
+        'base': 'habitual_near_{eye}_base'
+    },
+    'autorefractor': {
+        'sphere': 'autorefractor_{eye}_sphere', 'cylinder': 'autorefractor_{eye}_cylinder',
+        'axis': 'autorefractor_{eye}_axis'
+    },
+    'subjective': {
+        'sphere': 'subjective_{eye}_sphere', 'cylinder': 'subjective_{eye}_cylinder',
+        'axis': 'subjective_{eye}_axis', 'va': 'subjective_{eye}_va'
+    },
+    'subjective_binocular_distance': {
+        'sphere': 'subjective_binocular_distance_{eye}_sphere', 'cylinder': 'subjective_binocular_distance_{eye}_cylinder',
+        'axis': 'subjective_binocular_distance_{eye}_axis', 'prism': 'subjective_binocular_distance_{eye}_prism',
+        'base': 'subjective_binocular_distance_{eye}_base'
+    },
+    'subjective_binocular_near': {
+        'sphere': 'subjective_binocular_near_{eye}_sphere', 'cylinder': 'subjective_binocular_near_{eye}_cylinder',
+        'axis': 'subjective_binocular_near_{eye}_axis', 'prism': 'subjective_binocular_near_{eye}_prism',
+        'base': 'subjective_binocular_near_{eye}_base'
+    },
+    'final_distance': {
+        'sphere': 'final_prescribed_{eye}_sphere', 'cylinder': 'final_prescribed_{eye}_cylinder',
+        'axis': 'final_prescribed_{eye}_axis', 'prism': 'final_distance_{eye}_prism',
+        'base': 'final_distance_{eye}_base'
+    },
+    'final_near': {
+        'sphere': 'final_near_{eye}_sphere', 'cylinder': 'final_near_{eye}_cylinder',
+        'axis': 'final_near_{eye}_axis', 'prism': 'final_near_{eye}_prism',
+        'base': 'final_near_{eye}_base', 'va': 'final_near_{eye}_va'
+    },
+}
+
+# Per-exam (non per-eye) fields kept on the refraction_exams header row
+REFRACTION_HEADER_COLUMNS = [
+    'habitual_type', 'habitual_binocular_va', 'habitual_pd', 'vision_notes', 'uncorrected_binocular_va',
+    'objective_method', 'objective_time', 'objective_notes',
+    'cycloplegic_used', 'cycloplegic_agent', 'cycloplegic_lot', 'cycloplegic_expiry', 'cycloplegic_drops', 'cycloplegic_type',
+    'subjective_method', 'subjective_notes', 'subjective_binocular_vision', 'subjective_binocular_notes',
+    'subjective_distance', 'subjective_deg_distance',
+    'binocular_balance', 'stereopsis', 'near_point_convergence_break', 'near_point_convergence_recovery',
+    'final_prescribed_binocular_va', 'final_deg_distance', 'final_deg_near', 'bvp', 'pinhole', 'prescription_notes',
+    'binocular_tests', 'functional_tests', 'accommodation_tests', 'color_vision', 'uploaded_files',
+    'final_near_deg_od', 'final_near_deg_os', 'final_add_od', 'final_add_os',
+    # VA modifiers, ADD and DEG captured by the exam form
+    'habitual_od_modifier', 'habitual_os_modifier', 'habitual_binocular_modifier',
+    'habitual_add_od', 'habitual_add_os', 'habitual_deg_od', 'habitual_deg_os',
+    'uncorrected_od_modifier', 'uncorrected_os_modifier', 'uncorrected_binocular_modifier',
+    'subjective_od_modifier', 'subjective_os_modifier', 'subjective_add_od', 'subjective_add_os',
+    'subjective_deg_od', 'subjective_deg_os',
+    'final_prescribed_binocular_modifier', 'final_deg_od', 'final_deg_os'
+]
+
+def refraction_stage_columns(stages=None):
+    """[(stage, eye, field, wide column name)] for the given stages (default: all)."""
+    return [
+        (stage, eye, field, template.format(eye=eye))
+        for stage in (stages or REFRACTION_STAGES)
+        for eye in REFRACTION_EYES
+        for field, template in REFRACTION_STAGES[stage].items()
+    ]
+
+def refraction_wide_sql(stages=None, header="r.*", exams_table="refraction_exams", values_table="refraction_values"):
+    """SELECT that pivots refraction_values back into the legacy wide column names.
+
+    Only the requested stages are joined, so history and trend queries pay for
+    the stages they read instead of the full ~80 column row."""
+    select = [header]
+    joins = []
+    for stage in (stages or REFRACTION_STAGES):
+        for eye in REFRACTION_EYES:
+            alias = f"{stage}_{eye}"
+            joins.append(f"LEFT JOIN {values_table} {alias} ON {alias}.exam_id = r.id "
+                         f"AND {alias}.stage = '{stage}' AND {alias}.eye = '{eye.upper()}'")
+            select += [f"{alias}.{field} AS {template.format(eye=eye)}"
+                       for field, template in REFRACTION_STAGES[stage].items()]
+    return f"SELECT {', '.join(select)} FROM {exams_table} r " + " ".join(joins)
+
+def save_refraction_exam(c, patient_internal_id, record):
+    """Insert a refraction exam given as {legacy wide column: value}.
+
+    Header fields go to refraction_exams, every measured (stage, eye) becomes
+    one refraction_values row. Unknown keys are ignored. Returns the exam id."""
+    header = [column for column in REFRACTION_HEADER_COLUMNS if column in record]
+    c.execute(f"INSERT INTO refraction_exams (patient_id, {', '.join(header)}) VALUES (?{', ?' * len(header)})",
+              [patient_internal_id] + [record[column] for column in header])
+    exam_id = c.lastrowid
+    c.executemany(
+        "INSERT INTO refraction_values (exam_id, stage, eye, sphere, cylinder, axis, prism, base, va) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        refraction_value_rows(exam_id, record)
+    )
+    return exam_id
+
+def _refraction_value_layout():
+    """[(stage, EYE, wide column per REFRACTION_VALUE_FIELDS entry or None, set of those columns)]"""
+    layout = []
+    for stage, fields in REFRACTION_STAGES.items():
+        for eye in REFRACTION_EYES:
+            columns = tuple(fields[field].format(eye=eye) if field in fields else None for field in REFRACTION_VALUE_FIELDS)
+            layout.append((stage, eye.upper(), columns, frozenset(filter(None, columns))))
+    return layout
+
+REFRACTION_VALUE_LAYOUT = _refraction_value_layout()
+
+def refraction_value_rows(exam_id, record):
+    rows = []
+    for stage, eye, columns, names in REFRACTION_VALUE_LAYOUT:
+        if names.isdisjoint(record):
+            continue
+        values = [record.get(column) if column else None for column in columns]
+        if any(value is not None and value != '' for value in values):
+            rows.append((exam_id, stage, eye, *values))
+    return rows
+
+def _migration_compact_refraction(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS refraction_values (
+            exam_id INTEGER NOT NULL,
+            stage TEXT NOT NULL,
+            eye TEXT NOT NULL CHECK (eye IN ('OD', 'OS')),
+            sphere REAL,
+            cylinder REAL,
+            axis INTEGER,
+            prism TEXT,
+            base TEXT,
+            va TEXT,
+            PRIMARY KEY (exam_id, stage, eye),
+            FOREIGN KEY (exam_id) REFERENCES refraction_exams (id)
+        ) WITHOUT ROWID
+    ''')
+
+    c.execute("PRAGMA table_info(refraction_exams)")
+    existing = {col[1]: col[2] for col in c.fetchall()}
+    stage_columns = {wide for _, _, _, wide in refraction_stage_columns()}
+
+    # Move the per-eye values out of the wide rows
+    for stage, fields in REFRACTION_STAGES.items():
+        for eye in REFRACTION_EYES:
+            sources = [fields[field].format(eye=eye) if field in fields else None for field in REFRACTION_VALUE_FIELDS]
+            sources = [column if column in existing else None for column in sources]
+            present = [column for column in sources if column]
+            if not present:
+                continue
+            select = ", ".join(column or "NULL" for column in sources)
+            measured = " OR ".join(f"({column} IS NOT NULL AND {column} != '')" for column in present)
+            c.execute(f'''
+                INSERT OR IGNORE INTO refraction_values (exam_id, stage, eye, sphere, cylinder, axis, prism, base, va)
+                SELECT id, '{stage}', '{eye.upper()}', {select} FROM refraction_exams WHERE {measured}
+            ''')
+
+    # Rebuild the header table without the per-eye columns
+    keep = [name for name in existing if name not in stage_columns and name not in ('id', 'patient_id', 'exam_date')]
+    added = [name for name in REFRACTION_HEADER_COLUMNS if name not in existing]
+    column_defs = ",\n".join(f"            {name} {existing[name] or 'TEXT'}" for name in keep)
+    column_defs += "".join(f",\n            {name} TEXT" for name in added)
+    c.execute(f'''
+        CREATE TABLE refraction_exams_compact (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patient_id INTEGER NOT NULL,
+            exam_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+{column_defs},
+            FOREIGN KEY (patient_id) REFERENCES patients (id)
+        )
+    ''')
+    copied = ", ".join(['id', 'patient_id', 'exam_date'] + keep)
+    c.execute(f"INSERT INTO refraction_exams_compact ({copied}) SELECT {copied} FROM refraction_exams")
+    c.execute("DROP TABLE refraction_exams")
+    c.execute("ALTER TABLE refraction_exams_compact RENAME TO refraction_exams")
+    for index_name, table, columns in PATIENT_DATE_INDEXES:
+        if table == 'refraction_exams':
+            c.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table} ({columns})")
+
+    c.execute("DROP VIEW IF EXISTS refraction_exams_wide")
+    c.execute(f"CREATE VIEW refraction_exams_wide AS {refraction_wide_sql()}")
+
+def _migration_attachments(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS attachments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            exam_table TEXT NOT NULL,
+            exam_id INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            original_name TEXT,
+            mime_type TEXT,
+            size_bytes INTEGER,
+            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_attachments_exam ON attachments (exam_table, exam_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_attachments_sha256 ON attachments (sha256)")
+
+def _migration_attachment_status(c):
+    c.execute("ALTER TABLE attachments ADD COLUMN status TEXT DEFAULT 'pending'")
+    c.execute("ALTER TABLE attachments ADD COLUMN metadata TEXT")
+    # Attachments written before background processing existed were stored synchronously
+    c.execute("UPDATE attachments SET status = 'ready'")
+
+def _migration_analytics_cache_ttl(c):
+    c.execute("ALTER TABLE clinic_settings ADD COLUMN analytics_cache_ttl INTEGER")
+
+# -----------------------
+# DAILY COUNTERS (trigger-maintained dashboard totals)
+# -----------------------
+# (metric, table, date column). daily_counters holds one row per metric and
+# day ('YYYY-MM-DD') plus an all-time row under day '*'; patients also keep
+# 'gender:<value>' totals. Triggers keep them in step with every insert,
+# delete and date change, so the tiles read a handful of rows.
+COUNTED_TABLES = [
+    ('patients', 'patients', 'created_date'),
+    ('appointments', 'appointments', 'appointment_date'),
+    ('refraction_exams', 'refraction_exams', 'exam_date'),
+    ('contact_lens_prescriptions', 'contact_lens_prescriptions', 'prescription_date'),
+]
+COUNTER_TOTAL = '*'
+
+def _counter_day(ref, column):
+    return f"COALESCE(substr({ref}.{column}, 1, 10), '')"
+
+def _counter_upsert(values):
+    return (f"INSERT INTO daily_counters (metric, day, count) VALUES {', '.join(values)} "
+            "ON CONFLICT (metric, day) DO UPDATE SET count = count + excluded.count;")
+
+def _create_counter_triggers(c):
+    for metric, table, column in COUNTED_TABLES:
+        for event, ref, delta in (("INSERT", "NEW", 1), ("DELETE", "OLD", -1)):
+            values = [f"('{metric}', {_counter_day(ref, column)}, {delta})", f"('{metric}', '{COUNTER_TOTAL}', {delta})"]
+            if table == 'patients':
+                values.append(f"('gender:' || COALESCE({ref}.gender, ''), '{COUNTER_TOTAL}', {delta})")
+            c.execute(f"CREATE TRIGGER IF NOT EXISTS trg_{table}_count_{event.lower()} AFTER {event} ON {table} "
+                      f"BEGIN {_counter_upsert(values)} END")
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_count_update AFTER UPDATE OF {column} ON {table}
+            WHEN {_counter_day("OLD", column)} IS NOT {_counter_day("NEW", column)}
+            BEGIN {_counter_upsert([f"('{metric}', {_counter_day('OLD', column)}, -1)", f"('{metric}', {_counter_day('NEW', column)}, 1)"])} END
+        ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_patients_count_gender AFTER UPDATE OF gender ON patients
+        WHEN OLD.gender IS NOT NEW.gender
+        BEGIN {_counter_upsert(["('gender:' || COALESCE(OLD.gender, ''), '*', -1)", "('gender:' || COALESCE(NEW.gender, ''), '*', 1)"])} END
+    ''')
+
+def rebuild_daily_counters(c):
+    """Recount daily_counters from the hot tables and every archive file.
+
+    Safe to run at any time (e.g. after copying archive files in by hand);
+    the caller owns the transaction."""
+    c.execute("DELETE FROM daily_counters")
+    archived = dict(ARCHIVE_TABLES)
+    for metric, table, column in COUNTED_TABLES:
+        c.execute(f'''
+            INSERT INTO daily_counters (metric, day, count)
+            SELECT ?, {_counter_day(table, column)}, COUNT(*) FROM {table} GROUP BY 2
+        ''', (metric,))
+        if archived.get(table) != column:
+            continue
+        for path in archive_files().values():
+            archive = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+            try:
+                if not archive.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone():
+                    continue
+                counts = archive.execute(f"SELECT {_counter_day(table, column)}, COUNT(*) FROM {table} GROUP BY 1").fetchall()
+            finally:
+                archive.close()
+            c.executemany(_counter_upsert([f"('{metric}', ?, ?)"]), counts)
+    c.execute(f'''
+        INSERT INTO daily_counters (metric, day, count)
+        SELECT metric, '{COUNTER_TOTAL}', SUM(count) FROM daily_counters GROUP BY metric
+    ''')
+    c.execute(f'''
+        INSERT INTO daily_counters (metric, day, count)
+        SELECT 'gender:' || COALESCE(gender, ''), '{COUNTER_TOTAL}', COUNT(*) FROM patients GROUP BY 1
+    ''')
+
+def _migration_daily_counters(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS daily_counters (
+            metric TEXT NOT NULL,
+            day TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (metric, day)
+        ) WITHOUT ROWID
+    ''')
+    _create_counter_triggers(c)
+    rebuild_daily_counters(c)
+
+# -----------------------
+# PATIENT FULL-TEXT INDEX
+# -----------------------
+# External-content FTS5 table over the searchable patient columns, kept in
+# step by triggers. unicode61 with remove_diacritics folds Č/Ć/Š/Ž to their
+# base letters; prefix indexes make the 2-3 character queries typed into the
+# search box cheap. Like the index lists, a shipped column list is frozen.
+PATIENT_FTS_COLUMNS_V1 = ['patient_id', 'first_name', 'last_name', 'phone', 'id_number']  # migration 10
+# migration 15: + name_norm, whose folding also covers Đ/đ (unicode61 keeps it as its own letter)
+PATIENT_FTS_COLUMNS = PATIENT_FTS_COLUMNS_V1 + ['name_norm']
+
+def fts5_available(conn):
+    try:
+        return bool(conn.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')").fetchone()[0])
+    except sqlite3.Error:
+        return False
+
+def _migration_patient_fts(fts_columns):
+    """Migration step (re)building patients_fts and its triggers over `fts_columns`."""
+    return lambda c: _create_patient_fts(c, fts_columns)
+
+def _create_patient_fts(c, fts_columns):
+    if not fts5_available(c.connection):
+        print("SQLite was built without FTS5; patient search keeps using LIKE")
+        return
+    for trigger in ("trg_patients_fts_insert", "trg_patients_fts_delete", "trg_patients_fts_update"):
+        c.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    c.execute("DROP TABLE IF EXISTS patients_fts")
+    columns = ", ".join(fts_columns)
+    new_values = ", ".join(f"new.{column}" for column in fts_columns)
+    old_values = ", ".join(f"old.{column}" for column in fts_columns)
+    c.execute(f'''
+        CREATE VIRTUAL TABLE IF NOT EXISTS patients_fts USING fts5(
+            {columns},
+            content='patients', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_patients_fts_insert AFTER INSERT ON patients BEGIN
+            INSERT INTO patients_fts (rowid, {columns}) VALUES (new.id, {new_values});
+        END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_patients_fts_delete AFTER DELETE ON patients BEGIN
+            INSERT INTO patients_fts (patients_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values});
+        END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_patients_fts_update AFTER UPDATE OF {columns} ON patients BEGIN
+            INSERT INTO patients_fts (patients_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values});
+            INSERT INTO patients_fts (rowid, {columns}) VALUES (new.id, {new_values});
+        END
+    ''')
+    c.execute("INSERT INTO patients_fts (patients_fts) VALUES ('rebuild')")
+
+# Word prefixes miss a number typed from its middle ("2345678" in
+# "+385 91 234 5678"), so the number columns also go into a contentless
+# trigram index, which matches any substring of 3+ characters. Phones are
+# indexed as bare digits.
+PATIENT_NUMBER_COLUMNS = ['patient_id', 'phone', 'id_number']
+PATIENT_NUMBER_MIN_LENGTH = 3
+
+def phone_digits_sql(column):
+    """SQL expression for `column` with spaces and phone punctuation removed."""
+    expression = column
+    for ch in " -+()/.":
+        expression = f"REPLACE({expression}, '{ch}', '')"
+    return expression
+
+def _migration_patient_numbers(c):
+    if not fts5_available(c.connection):
+        return
+    columns = ", ".join(PATIENT_NUMBER_COLUMNS)
+    def values(row):
+        return f"{row}.patient_id, {phone_digits_sql(row + '.phone')}, {row}.id_number"
+    c.execute(f'''
+        CREATE VIRTUAL TABLE IF NOT EXISTS patient_numbers_fts USING fts5(
+            {columns}, content='', tokenize='trigram'
+        )
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_patient_numbers_insert AFTER INSERT ON patients BEGIN
+            INSERT INTO patient_numbers_fts (rowid, {columns}) VALUES (new.id, {values('new')});
+        END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_patient_numbers_delete AFTER DELETE ON patients BEGIN
+            INSERT INTO patient_numbers_fts (patient_numbers_fts, rowid, {columns}) VALUES ('delete', old.id, {values('old')});
+        END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_patient_numbers_update AFTER UPDATE OF {columns} ON patients BEGIN
+            INSERT INTO patient_numbers_fts (patient_numbers_fts, rowid, {columns}) VALUES ('delete', old.id, {values('old')});
+            INSERT INTO patient_numbers_fts (rowid, {columns}) VALUES (new.id, {values('new')});
+        END
+    ''')
+    c.execute(f"INSERT INTO patient_numbers_fts (rowid, {columns}) SELECT id, {values('patients')} FROM patients")
+
+# -----------------------
+# FOLDED NAMES AND TRIGRAMS (fuzzy name search)
+# -----------------------
+# patients.name_norm holds "first last" lower-cased with diacritics folded
+# (Čačić -> cacic, Đurđević -> durdevic); patient_name_trigrams indexes its
+# trigrams. Both are written from Python when a patient is registered or
+# imported - the folding is not something a trigger can do.
+NAME_FOLD_EXTRA = str.maketrans({'đ': 'd', 'ð': 'd', 'ø': 'o', 'ł': 'l', 'æ': 'ae', 'œ': 'oe', 'ß': 'ss'})
+
+def fold_name(text):
+    """Lower-case ASCII form of a name for matching; punctuation becomes spaces."""
+    text = unicodedata.normalize('NFKD', str(text or '').lower().translate(NAME_FOLD_EXTRA))
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return ' '.join(re.findall(r"[a-z0-9]+", text))
+
+def name_trigrams(folded):
+    """Trigrams of every word, padded like pg_trgm ('  a', ' ab', ..., 'yz ')."""
+    grams = set()
+    for word in folded.split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+def index_patient_names(conn, patients):
+    """Store name_norm and the name trigrams of newly inserted (id, first_name, last_name) rows."""
+    folded = [(fold_name(f"{first_name or ''} {last_name or ''}"), patient_id) for patient_id, first_name, last_name in patients]
+    conn.executemany("UPDATE patients SET name_norm = ? WHERE id = ?", folded)
+    conn.executemany("INSERT OR IGNORE INTO patient_name_trigrams (trigram, patient_id) VALUES (?, ?)",
+                     sorted((gram, patient_id) for name, patient_id in folded for gram in name_trigrams(name)))
+
+def _migration_name_trigrams(c):
+    c.execute("ALTER TABLE patients ADD COLUMN name_norm TEXT")
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS patient_name_trigrams (
+            trigram TEXT NOT NULL,
+            patient_id INTEGER NOT NULL,
+            PRIMARY KEY (trigram, patient_id)
+        ) WITHOUT ROWID
+    ''')
+    index_patient_names(c, c.execute("SELECT id, first_name, last_name FROM patients").fetchall())
+    # built after the backfill: one sort instead of 15 random index inserts per patient
+    c.execute("CREATE INDEX IF NOT EXISTS idx_patient_name_trigrams_patient ON patient_name_trigrams (patient_id)")
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_patients_trigrams_delete AFTER DELETE ON patients BEGIN
+            DELETE FROM patient_name_trigrams WHERE patient_id = old.id;
+        END
+    ''')
+
+# Ordered schema migrations: (version, description, step). Each step runs once,
+# inside its own transaction, and is recorded in schema_version. Never edit a
+# shipped step - append a new one.
+MIGRATIONS = [
+    (1, "base schema", _migration_base_schema),
+    (2, "legacy exam columns", _migration_legacy_columns),
+    (3, "patient/date indexes", _migration_indexes(PATIENT_DATE_INDEXES)),
+    (4, "default admin and patient groups", _migration_default_data),
+    (5, "compact refraction storage", _migration_compact_refraction),
+    (6, "attachments table", _migration_attachments),
+    (7, "attachment processing status", _migration_attachment_status),
+    (8, "patient gender index", _migration_indexes(PATIENT_GENDER_INDEXES)),
+    (9, "daily counters", _migration_daily_counters),
+    (10, "patient full-text index", _migration_patient_fts(PATIENT_FTS_COLUMNS_V1)),
+    (11, "folded names and name trigrams", _migration_name_trigrams),
+    (12, "patient name index", _migration_indexes(PATIENT_NAME_INDEXES)),
+    (13, "birth date and group member indexes", _migration_indexes(BIRTH_DATE_GROUP_INDEXES)),
+    (14, "analytics cache TTL setting", _migration_analytics_cache_ttl),
+    (15, "folded names in the patient full-text index", _migration_patient_fts(PATIENT_FTS_COLUMNS)),
+    (16, "patient number substring index", _migration_patient_numbers),
+]
+
+def apply_migrations(conn):
+    """Bring the schema up to date; a warm start is a single schema_version lookup."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            duration_seconds REAL
+        )
+    ''')
+    current = conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+    applied = []
+    for version, description, step in MIGRATIONS:
+        if version <= current:
+            continue
+        started = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Another process may have applied it while we waited for the lock
+            if conn.execute("SELECT 1 FROM schema_version WHERE version = ?", (version,)).fetchone():
+                conn.rollback()
+                continue
+            step(conn.cursor())
+            elapsed = time.perf_counter() - started
+            conn.execute("INSERT INTO schema_version (version, description, duration_seconds) VALUES (?, ?, ?)",
+                         (version, description, elapsed))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"Applied migration {version} ({description}) in {elapsed:.3f}s")
+        applied.append((version, description, elapsed))
+    return applied
+
+def check_migrations():
+    """Migrate a scratch database shaped like a pre-migration install.
+
+    Mirrors the first start of the app on an old database: the tables exist
+    but schema_version does not, and a pooled connection already has its
+    <table>_all views. Returns the migrations applied; raises if one fails."""
+    with tempfile.TemporaryDirectory() as scratch:
+        path = os.path.join(scratch, "baseline.db")
+        conn = sqlite3.connect(path)
+        _migration_base_schema(conn.cursor())
+        _migration_legacy_columns(conn.cursor())
+        _migration_default_data(conn.cursor())
+        conn.commit()
+        conn.close()
+
+        pool = ConnectionPool(path)
+        pooled = pool._connect()
+        try:
+            pool.sync_archives(pooled)
+            applied = pool.migrate()
+            pool.sync_archives(pooled)  # the views must rebuild over the migrated tables
+            pooled.execute("SELECT COUNT(*) FROM refraction_exams_wide_all").fetchone()
+        finally:
+            pooled.close()
+        return applied
+
+@st.cache_resource
+def init_db(db_path=DB_PATH):
+    pool = ConnectionPool(db_path)
+    pool.migrate()
+    return pool
+
+# -----------------------
+# COLD ARCHIVE (one attached database per ARCHIVE_FILE_YEARS years)
+# -----------------------
+ARCHIVE_DIR = "archive"
+ARCHIVE_KEEP_YEARS = 2  # the current and the previous calendar year stay in the hot file
+ARCHIVE_FILE_YEARS = 5  # years per archive file; SQLite attaches at most 10 files, so 50 years
+
+# (table, date column) of the archivable exam tables; refraction_values rows
+# follow their refraction_exams header.
+ARCHIVE_TABLES = [
+    ('medical_history', 'visit_date'),
+    ('refraction_exams', 'exam_date'),
+    ('functional_tests', 'test_date'),
+    ('anterior_segment_exams', 'exam_date'),
+    ('posterior_segment_exams', 'exam_date'),
+    ('contact_lens_prescriptions', 'prescription_date'),
+]
+ARCHIVED_TABLES = [table for table, _ in ARCHIVE_TABLES] + ['refraction_values']
+
+def archive_period(year):
+    """First year of the archive file that holds `year`."""
+    return int(year) - int(year) % ARCHIVE_FILE_YEARS
+
+def archive_path(year):
+    """Archive file of the period starting in `year` (see archive_period)."""
+    return os.path.join(ARCHIVE_DIR, f"ophtalcam_{int(year)}.db")
+
+def archive_file_label(year):
+    """'2015-2019' for a period file; a single year for a file from before ARCHIVE_FILE_YEARS."""
+    if archive_period(year) != year:
+        return str(year)
+    return f"{year}-{year + ARCHIVE_FILE_YEARS - 1}"
+
+def archive_files():
+    """{first year: path} of the archive files on disk, oldest first."""
+    if not os.path.isdir(ARCHIVE_DIR):
+        return {}
+    files = {}
+    for name in sorted(os.listdir(ARCHIVE_DIR)):
+        match = re.fullmatch(r"ophtalcam_(\d{4})\.db", name)
+        if match:
+            files[int(match.group(1))] = os.path.join(ARCHIVE_DIR, name)
+    return files
+
+def archive_schemas(conn):
+    """Names of the archive databases attached to `conn`, oldest first."""
+    return sorted(row[1] for row in conn.execute("PRAGMA database_list") if row[1].startswith("archive_"))
+
+def _table_columns(conn, table, schema="main"):
+    return [row[1] for row in conn.execute(f"PRAGMA {schema}.table_info({table})")]
+
+def build_archive_views(conn):
+    """Temp views <table>_all = hot rows UNION ALL every attached archive year.
+
+    Columns follow the hot table; a column added after a year was archived
+    reads as NULL for that year. Temp views are per connection, which is why
+    the pool builds them instead of a migration."""
+    for table in ARCHIVED_TABLES:
+        conn.execute(f"DROP VIEW IF EXISTS temp.{table}_all")
+        hot = _table_columns(conn, table)
+        if not hot:
+            continue
+        selects = [f"SELECT {', '.join(hot)} FROM main.{table}"]
+        for schema in archive_schemas(conn):
+            cold = set(_table_columns(conn, table, schema))
+            if cold:
+                columns = ", ".join(column if column in cold else f"NULL AS {column}" for column in hot)
+                selects.append(f"SELECT {columns} FROM {schema}.{table}")
+        conn.execute(f"CREATE TEMP VIEW {table}_all AS " + " UNION ALL ".join(selects))
+
+    conn.execute("DROP VIEW IF EXISTS temp.refraction_exams_wide_all")
+    if _table_columns(conn, 'refraction_values'):
+        conn.execute(f"CREATE TEMP VIEW refraction_exams_wide_all AS {refraction_wide_all_sql(conn)}")
+
+def refraction_wide_all_sql(conn, stages=None, header=None):
+    """refraction_wide_sql over the hot file and every attached archive.
+
+    Each year is pivoted inside its own file and the results are combined with
+    UNION ALL, so every branch joins on that file's primary key."""
+    header = header or _table_columns(conn, 'refraction_exams')
+    branches = []
+    for schema in ['main'] + archive_schemas(conn):
+        cold = set(_table_columns(conn, 'refraction_exams', schema))
+        if not cold:
+            continue
+        columns = ", ".join(f"r.{column}" if column in cold else f"NULL AS {column}" for column in header)
+        branches.append(refraction_wide_sql(stages, header=columns,
+                                            exams_table=f"{schema}.refraction_exams",
+                                            values_table=f"{schema}.refraction_values"))
+    return " UNION ALL ".join(branches)
+
+def archive_exams(db_path=DB_PATH, keep_years=ARCHIVE_KEEP_YEARS, vacuum=False):
+    """Move exams dated before the hot horizon into the archive file of their period.
+
+    Returns {year: rows moved}. Rows are copied with INSERT OR IGNORE before
+    they are deleted from the hot file, so an interrupted run can be repeated."""
+    cutoff = f"{date.today().year - keep_years + 1}-01-01"
+    conn = sqlite3.connect(db_path, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+    try:
+        years = set()
+        for table, column in ARCHIVE_TABLES:
+            for (year,) in conn.execute(f"SELECT DISTINCT substr({column}, 1, 4) FROM {table} WHERE {column} < ?", (cutoff,)):
+                if year and year.isdigit():
+                    years.add(int(year))
+
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        moved = {}
+        for year in sorted(years):
+            path = archive_path(archive_period(year))
+            conn.execute("ATTACH DATABASE ? AS archive", (path,))
+            try:
+                moved[year] = _archive_year(conn, year)
+            finally:
+                conn.execute("DETACH DATABASE archive")
+            print(f"Archived {moved[year]} exam(s) from {year} to {path}")
+        if vacuum and moved:
+            conn.execute("VACUUM")
+        return moved
+    finally:
+        conn.close()
+
+def _archive_year(conn, year):
+    bounds = (f"{year}-01-01", f"{year + 1}-01-01")
+    moved = 0
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for table, column in ARCHIVE_TABLES:
+            where = f"{column} >= ? AND {column} < ?"
+            for metric, counted_table, counted_column in COUNTED_TABLES:
+                if counted_table == table:
+                    # the delete triggers uncount these rows, but they still exist (in the archive)
+                    conn.execute(f'''
+                        INSERT INTO main.daily_counters (metric, day, count)
+                        SELECT ?, {_counter_day(table, counted_column)}, COUNT(*) FROM main.{table} WHERE {where} GROUP BY 2
+                        UNION ALL
+                        SELECT ?, '{COUNTER_TOTAL}', COUNT(*) FROM main.{table} WHERE {where}
+                        ON CONFLICT (metric, day) DO UPDATE SET count = count + excluded.count
+                    ''', (metric, *bounds, metric, *bounds))
+            if table == 'refraction_exams':
+                columns = _ensure_archive_table(conn, 'refraction_values')
+                in_year = f"exam_id IN (SELECT id FROM main.refraction_exams WHERE {where})"
+                conn.execute(f"INSERT OR IGNORE INTO archive.refraction_values ({columns}) "
+                             f"SELECT {columns} FROM main.refraction_values WHERE {in_year}", bounds)
+                conn.execute(f"DELETE FROM main.refraction_values WHERE {in_year}", bounds)
+            columns = _ensure_archive_table(conn, table)
+            conn.execute(f"INSERT OR IGNORE INTO archive.{table} ({columns}) SELECT {columns} FROM main.{table} WHERE {where}", bounds)
+            moved += conn.execute(f"DELETE FROM main.{table} WHERE {where}", bounds).rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return moved
+
+def _ensure_archive_table(conn, table):
+    """Create (or widen) `table` in the attached archive to match the hot schema."""
+    sql = conn.execute("SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()[0]
+    conn.execute(re.sub(r'^CREATE TABLE\s+("?)\w+\1', f"CREATE TABLE IF NOT EXISTS archive.{table}", sql, count=1))
+    cold = set(_table_columns(conn, table, "archive"))
+    hot = conn.execute(f"PRAGMA main.table_info({table})").fetchall()
+    for _, name, column_type, *_ in hot:
+        if name not in cold:
+            conn.execute(f"ALTER TABLE archive.{table} ADD COLUMN {name} {column_type}")
+    for index_name, index_table, columns in MANAGED_INDEXES:
+        if index_table == table:
+            conn.execute(f"CREATE INDEX IF NOT EXISTS archive.{index_name} ON {table} ({columns})")
+    return ", ".join(row[1] for row in hot)
+
+def consolidate_archives(db_path=DB_PATH):
+    """Fold archive files that don't start a period (one file per year, as
+    written before ARCHIVE_FILE_YEARS) into their period file and delete them.
+
+    Returns {period file: years folded in}. Run it with the app stopped: its
+    connections keep the folded files attached (and, on Windows, open)."""
+    conn = sqlite3.connect(db_path, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+    try:
+        folded = {}
+        for year, path in archive_files().items():
+            if archive_period(year) == year:
+                continue
+            target = archive_path(archive_period(year))
+            conn.execute("ATTACH DATABASE ? AS archive", (target,))
+            conn.execute("ATTACH DATABASE ? AS folded", (path,))
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    for table in ARCHIVED_TABLES:
+                        source = set(_table_columns(conn, table, "folded"))
+                        if not source:
+                            continue
+                        columns = ", ".join(column for column in _ensure_archive_table(conn, table).split(", ")
+                                            if column in source)
+                        conn.execute(f"INSERT OR IGNORE INTO archive.{table} ({columns}) SELECT {columns} FROM folded.{table}")
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+            finally:
+                conn.execute("DETACH DATABASE folded")
+                conn.execute("DETACH DATABASE archive")
+            os.remove(path)
+            folded.setdefault(target, []).append(year)
+            print(f"Folded {path} into {target}")
+        return folded
+    finally:
+        conn.close()
+
+
+# -----------------------
+# BACKUP AND POINT-IN-TIME RESTORE
+# -----------------------
+BACKUP_DIR = "backups"
+BACKUP_PAGES_PER_STEP = 256  # pages copied per backup step (1 MiB at the default page size)
+BACKUP_STEP_SLEEP = 0.005  # seconds between steps
+BACKUP_FULL_EVERY = 24  # incremental backups before the next full snapshot
+BACKUP_STAMP_FORMAT = "%Y%m%dT%H%M%S"
+BACKUP_INTERVAL = 3600  # seconds between scheduled backups; also how much work a restore can lose
+
+def list_backups(backup_dir=BACKUP_DIR):
+    """[(taken at, 'full' | 'delta', path)] oldest first."""
+    entries = []
+    if os.path.isdir(backup_dir):
+        for name in os.listdir(backup_dir):
+            match = re.fullmatch(r"(full|delta)_(\d{8}T\d{6})\.(db|delta)", name)
+            if match:
+                taken_at = datetime.strptime(match.group(2), BACKUP_STAMP_FORMAT)
+                entries.append((taken_at, match.group(1), os.path.join(backup_dir, name)))
+    return sorted(entries)
+
+def _snapshot(db_path, target, pages=BACKUP_PAGES_PER_STEP, sleep=BACKUP_STEP_SLEEP):
+    """Consistent copy of a live database through the online backup API.
+
+    A read transaction is held on the source for the whole copy, so every step
+    reads the same WAL snapshot: writers are never blocked, and their commits
+    do not restart the backup (which, unpinned, they would on every save)."""
+    source = sqlite3.connect(db_path, timeout=DB_BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+    copy = sqlite3.connect(target)
+    try:
+        source.execute("BEGIN")
+        source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()  # start the read snapshot
+        source.backup(copy, pages=pages, sleep=sleep)
+        source.execute("COMMIT")
+        copy.execute("PRAGMA journal_mode=DELETE")  # self-contained file, no -wal needed
+        return copy.execute("PRAGMA page_size").fetchone()[0]
+    finally:
+        copy.close()
+        source.close()
+
+def _page_digests(path, page_size):
+    with open(path, "rb") as fp:
+        return [hashlib.sha1(page).digest() for page in iter(lambda: fp.read(page_size), b"")]
+
+def _read_page_state(backup_dir):
+    """(backup path, page size, page digests) describing the newest backup, or None."""
+    try:
+        with open(os.path.join(backup_dir, "pages.state"), "rb") as fp:
+            name_length, page_size = struct.unpack(">II", fp.read(8))
+            name = fp.read(name_length).decode()
+            data = fp.read()
+    except (OSError, struct.error):
+        return None
+    return name, page_size, [data[i:i + 20] for i in range(0, len(data), 20)]
+
+def _write_page_state(backup_dir, path, page_size, digests):
+    name = os.path.basename(path).encode()
+    state_path = os.path.join(backup_dir, "pages.state")
+    with open(state_path + ".tmp", "wb") as fp:
+        fp.write(struct.pack(">II", len(name), page_size) + name + b"".join(digests))
+    os.replace(state_path + ".tmp", state_path)
+
+def backup_database(db_path=DB_PATH, backup_dir=BACKUP_DIR, full=False):
+    """Back up the live database without stopping the app.
+
+    Takes a full snapshot every BACKUP_FULL_EVERY runs (or when asked) and
+    otherwise stores only the pages that changed since the previous backup,
+    compressed. Returns (kind, path, pages written)."""
+    os.makedirs(backup_dir, exist_ok=True)
+    stamp = datetime.now().strftime(BACKUP_STAMP_FORMAT)
+    while any(os.path.exists(os.path.join(backup_dir, f"{kind}_{stamp}.{ext}")) for kind, ext in (("full", "db"), ("delta", "delta"))):
+        time.sleep(0.2)
+        stamp = datetime.now().strftime(BACKUP_STAMP_FORMAT)
+
+    snapshot = os.path.join(backup_dir, "snapshot.tmp")
+    page_size = _snapshot(db_path, snapshot)
+    digests = _page_digests(snapshot, page_size)
+
+    entries = list_backups(backup_dir)
+    state = _read_page_state(backup_dir)
+    since_full = 0
+    for _, kind, _ in reversed(entries):
+        if kind == 'full':
+            break
+        since_full += 1
+    incremental = (not full and state is not None and entries
+                   and state[0] == os.path.basename(entries[-1][2])  # state belongs to the newest backup
+                   and state[1] == page_size and since_full < BACKUP_FULL_EVERY)
+
+    if incremental:
+        previous = state[2]
+        changed = [n for n, digest in enumerate(digests) if n >= len(previous) or previous[n] != digest]
+        path = os.path.join(backup_dir, f"delta_{stamp}.delta")
+        compressor = zlib.compressobj()
+        with open(snapshot, "rb") as src, open(path + ".tmp", "wb") as out:
+            out.write(compressor.compress(struct.pack(">II", page_size, len(digests))))
+            for page_no in changed:
+                src.seek(page_no * page_size)
+                out.write(compressor.compress(struct.pack(">I", page_no) + src.read(page_size)))
+            out.write(compressor.flush())
+        os.replace(path + ".tmp", path)
+        os.remove(snapshot)
+        result = ('delta', path, len(changed))
+    else:
+        path = os.path.join(backup_dir, f"full_{stamp}.db")
+        os.replace(snapshot, path)
+        result = ('full', path, len(digests))
+    _write_page_state(backup_dir, path, page_size, digests)
+    _backup_archive_files(backup_dir)
+    return result
+
+def _backup_archive_files(backup_dir):
+    """Archive years only change when exams are archived; copy the ones that did."""
+    target_dir = os.path.join(backup_dir, "archive")
+    for year, path in archive_files().items():
+        target = os.path.join(target_dir, os.path.basename(path))
+        if not os.path.exists(target) or os.path.getmtime(target) < os.path.getmtime(path):
+            os.makedirs(target_dir, exist_ok=True)
+            _snapshot(path, target + ".tmp")
+            os.replace(target + ".tmp", target)
+
+def restore_database(at, output, backup_dir=BACKUP_DIR):
+    """Rebuild the database as it was at the newest backup taken at or before `at`.
+
+    Writes to `output` (never the live file in place) and returns the time of
+    the backup that was restored."""
+    entries = [entry for entry in list_backups(backup_dir) if entry[0] <= at]
+    fulls = [i for i, (_, kind, _) in enumerate(entries) if kind == 'full']
+    if not fulls:
+        raise ValueError(f"no full backup at or before {at:%Y-%m-%d %H:%M:%S}")
+    chain = entries[fulls[-1]:]
+
+    tmp_path = output + ".tmp"
+    shutil.copyfile(chain[0][2], tmp_path)
+    with open(tmp_path, "r+b") as fp:
+        for _, _, path in chain[1:]:
+            with open(path, "rb") as delta:
+                data = zlib.decompress(delta.read())
+            page_size, page_count = struct.unpack_from(">II", data)
+            record = 4 + page_size
+            for offset in range(8, len(data), record):
+                (page_no,) = struct.unpack_from(">I", data, offset)
+                fp.seek(page_no * page_size)
+                fp.write(data[offset + 4:offset + record])
+            fp.truncate(page_count * page_size)
+
+    check = sqlite3.connect(tmp_path)
+    try:
+        result = check.execute("PRAGMA integrity_check").fetchone()[0]
+    finally:
+        check.close()
+    if result != "ok":
+        os.remove(tmp_path)
+        raise ValueError(f"restored database failed the integrity check: {result}")
+    os.replace(tmp_path, output)
+    return chain[-1][0]
+
+@st.cache_resource
+def get_backup_scheduler():
+    newest = list_backups()
+    return {'executor': ThreadPoolExecutor(max_workers=1, thread_name_prefix="backup"),
+            'started': newest[-1][0].timestamp() if newest else 0.0,
+            'lock': threading.Lock(), 'running': threading.Lock()}
+
+def schedule_backup():
+    """Back up the live database in the background at most every BACKUP_INTERVAL.
+
+    Restores only reach backup moments, so this interval is the recovery
+    granularity: a restore loses up to BACKUP_INTERVAL of work."""
+    scheduler = get_backup_scheduler()
+    with scheduler['lock']:
+        if time.time() - scheduler['started'] < BACKUP_INTERVAL:
+            return
+        scheduler['started'] = time.time()
+    scheduler['executor'].submit(_backup_in_background, scheduler['running'])
+
+def _backup_in_background(running):
+    try:
+        with running:
+            kind, path, pages = backup_database(DB_PATH)
+        print(f"Scheduled {kind} backup written to {path} ({pages} page(s))")
+    except Exception as e:
+        print(f"Scheduled backup failed: {e}")
+
 
 # -----------------------
 # DATE FORMATTING FUNCTIONS
@@ -528,6 +1632,14 @@ def format_date_for_display(dt):
             return dt
     return dt.strftime('%d.%m.%Y') if hasattr(dt, 'strftime') else str(dt)
 
+def day_bounds(day=None):
+    """Half-open [start, end) timestamp strings for one calendar day.
+
+    Stored timestamps are 'YYYY-MM-DD HH:MM:SS' text, so comparing against these
+    bounds lets SQLite use the date indexes instead of evaluating DATE() per row."""
+    day = day or date.today()
+    return day.strftime('%Y-%m-%d'), (day + timedelta(days=1)).strftime('%Y-%m-%d')
+
 # -----------------------
 # MISSING FUNCTIONS - DODANE
 # -----------------------
@@ -536,7 +1648,7 @@ def hash_password(password):
 
 def authenticate_user(username, password):
     try:
-        c = conn.cursor()
+        c = get_conn().cursor()
         password_hash = hash_password(password)
         c.execute("SELECT username, password_hash, role FROM users WHERE username = ?", (username,))
         user = c.fetchone()
@@ -550,7 +1662,7 @@ def authenticate_user(username, password):
 
 def check_license_expiry():
     try:
-        c = conn.cursor()
+        c = get_conn().cursor()
         c.execute("SELECT license_expiry FROM users WHERE username = ?", (st.session_state.username,))
         result = c.fetchone()
         if result and result[0]:
@@ -562,62 +1674,1105 @@ def check_license_expiry():
     except Exception as e:
         st.error(f"License check error: {str(e)}")
 
-def get_patient_stats():
+class ClinicMetrics(NamedTuple):
+    """Headline counts shown on the dashboard and the analytics tiles."""
+    total_patients: int = 0
+    new_patients_today: int = 0
+    male_patients: int = 0
+    female_patients: int = 0
+    appointments_today: int = 0
+    total_refractions: int = 0
+    refractions_today: int = 0
+    total_cl_fittings: int = 0
+
+def clinic_metrics(day=None, conn=None):
+    """All headline counts from the trigger-maintained daily_counters rows.
+
+    A single primary-key lookup per tile, whatever the size of the tables.
+    All-time totals include archived years."""
+    conn = conn or get_conn()
+    today = day_bounds(day)[0]
     try:
-        total_patients = pd.read_sql("SELECT COUNT(*) as count FROM patients", conn).iloc[0]['count']
-        
-        today_str = date.today().strftime('%Y-%m-%d')
-        today_exams = pd.read_sql(
-            "SELECT COUNT(*) as count FROM appointments WHERE DATE(appointment_date) = ?", 
-            conn, params=(today_str,)
-        ).iloc[0]['count']
-        
-        total_cl = pd.read_sql("SELECT COUNT(*) as count FROM contact_lens_prescriptions", conn).iloc[0]['count']
-        
-        return total_patients, today_exams, total_cl
+        counts = dict(((metric, day_key), count) for metric, day_key, count in conn.execute(
+            "SELECT metric, day, count FROM daily_counters WHERE day IN (?, ?)", (COUNTER_TOTAL, today)
+        ))
     except Exception as e:
         print(f"Stats error: {e}")
-        return 0, 0, 0
+        return ClinicMetrics()
+    return ClinicMetrics(
+        total_patients=counts.get(('patients', COUNTER_TOTAL), 0),
+        new_patients_today=counts.get(('patients', today), 0),
+        male_patients=counts.get(('gender:Male', COUNTER_TOTAL), 0),
+        female_patients=counts.get(('gender:Female', COUNTER_TOTAL), 0),
+        appointments_today=counts.get(('appointments', today), 0),
+        total_refractions=counts.get(('refraction_exams', COUNTER_TOTAL), 0),
+        refractions_today=counts.get(('refraction_exams', today), 0),
+        total_cl_fittings=counts.get(('contact_lens_prescriptions', COUNTER_TOTAL), 0),
+    )
+
+AGE_BAND_EDGES = (18, 36, 56, 76)  # first age of every band after the youngest
+
+def age_band_labels(edges):
+    """'0-17', '18-35', ..., '76+' for the given band edges."""
+    lows = (0,) + tuple(edges)
+    return [f"{low}-{high - 1}" for low, high in zip(lows, edges)] + [f"{lows[-1]}+"]
+
+@functools.lru_cache(maxsize=16)
+def age_band_cutoffs(edges, day):
+    """ISO birth dates such that age on `day` < edge <=> date_of_birth > cutoff, one per edge.
+
+    Cached per (edges, day), so the date arithmetic runs once a day instead of
+    once per patient row. An lru_cache, not st.cache_data: the analytics
+    refresher thread calls it outside any script run."""
+    cutoffs = []
+    for age in edges:
+        try:
+            cutoffs.append(day.replace(year=day.year - age).isoformat())
+        except ValueError:  # 29 February
+            cutoffs.append(day.replace(year=day.year - age, day=28).isoformat())
+    return tuple(cutoffs)
+
+def age_distribution(edges=AGE_BAND_EDGES, group_id=None, conn=None):
+    """Patients per age band today as a Series indexed by band label.
+
+    Every band is a date_of_birth range between two of the day's cutoffs,
+    counted on idx_patients_date_of_birth; `group_id` limits the counts to
+    the members of a patient group."""
+    edges = tuple(sorted(set(edges)))
+    cutoffs = list(age_band_cutoffs(edges, date.today()))
+    member = ""
+    if group_id is not None:
+        member = " AND p.id IN (SELECT patient_id FROM patient_group_assignments WHERE group_id = :group)"
+    # Youngest band first: born after the first cutoff, ..., born on or before the last one
+    bounds = list(zip([None] + cutoffs, cutoffs + ['']))
+    counts = []
+    params = {'group': group_id}
+    for i, (upper, lower) in enumerate(bounds):
+        where = f"p.date_of_birth > :lower{i}" + (f" AND p.date_of_birth <= :upper{i}" if upper else "")
+        counts.append(f"(SELECT COUNT(*) FROM patients p WHERE {where}{member})")
+        params.update({f"lower{i}": lower, f"upper{i}": upper})
+    labels = age_band_labels(edges)
+    return pd.Series(list(one(f"SELECT {', '.join(counts)}", params, conn=conn)), dtype='int64',
+                     index=pd.CategoricalIndex(labels, categories=labels, ordered=True))
 
 def get_todays_appointments():
     try:
-        today_str = date.today().strftime('%Y-%m-%d')
-        return pd.read_sql('''
-            SELECT a.*, p.first_name, p.last_name, p.patient_id 
-            FROM appointments a 
-            JOIN patients p ON a.patient_id = p.id 
-            WHERE DATE(a.appointment_date) = ? 
+        return rows('''
+            SELECT a.id, a.appointment_date, a.appointment_type, a.status, p.first_name, p.last_name, p.patient_id
+            FROM appointments a
+            JOIN patients p ON a.patient_id = p.id
+            WHERE a.appointment_date >= ? AND a.appointment_date < ?
             ORDER BY a.appointment_date
-        ''', conn, params=(today_str,))
+        ''', day_bounds())
     except Exception as e:
         print(f"Appointments error: {e}")
-        return pd.DataFrame()
+        return []
 
 def get_recent_patients(limit=5):
     try:
-        return pd.read_sql(f'''
-            SELECT * FROM patients 
-            ORDER BY created_date DESC 
-            LIMIT {limit}
-        ''', conn)
+        return rows('''
+            SELECT patient_id, first_name, last_name, date_of_birth, created_date FROM patients
+            ORDER BY created_date DESC
+            LIMIT ?
+        ''', (limit,))
     except Exception as e:
         print(f"Recent patients error: {e}")
-        return pd.DataFrame()
+        return []
 
 def get_upcoming_appointments(limit=5):
     try:
         today_str = date.today().strftime('%Y-%m-%d')
-        return pd.read_sql(f'''
-            SELECT a.*, p.first_name, p.last_name 
-            FROM appointments a 
-            JOIN patients p ON a.patient_id = p.id 
-            WHERE DATE(a.appointment_date) >= ? 
-            ORDER BY a.appointment_date 
-            LIMIT {limit}
-        ''', conn, params=(today_str,))
+        return rows('''
+            SELECT a.appointment_date, a.appointment_type, p.first_name, p.last_name
+            FROM appointments a
+            JOIN patients p ON a.patient_id = p.id
+            WHERE a.appointment_date >= ?
+            ORDER BY a.appointment_date
+            LIMIT ?
+        ''', (today_str, limit))
     except Exception as e:
         print(f"Upcoming appointments error: {e}")
-        return pd.DataFrame()
+        return []
+
+# -----------------------
+# PATIENT CONTEXT
+# -----------------------
+def get_patient_context():
+    """Row of the selected patient as a dict (internal id + demographics).
+
+    Resolved once when st.session_state.selected_patient changes and kept in
+    session state, so exam steps and reports can bind the integer key directly
+    instead of looking the patient up again on every rerun."""
+    pid_code = st.session_state.get('selected_patient')
+    if not pid_code:
+        return None
+    ctx = st.session_state.get('patient_context')
+    if ctx is None or ctx['patient_id'] != pid_code:
+        c = get_conn().cursor()
+        c.execute("SELECT * FROM patients WHERE patient_id = ?", (pid_code,))
+        row = c.fetchone()
+        ctx = dict(zip([col[0] for col in c.description], row)) if row else None
+        st.session_state.patient_context = ctx
+    return ctx
+
+# -----------------------
+# PATIENT RECORD CACHE
+# -----------------------
+RECORD_CACHE_SIZE = 256
+
+class RecordCache:
+    """Bounded LRU of per-patient exam reads with per-table generation counters.
+
+    Every exam save bumps the generation of the table it wrote to; an entry is
+    served from memory only while it was loaded under the current generation.
+    Cached DataFrames are shared between sessions and must not be modified."""
+    def __init__(self, max_entries=RECORD_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def bump(self, table):
+        with self._lock:
+            self._generations[table] = self._generations.get(table, 0) + 1
+
+    def get_or_load(self, table, key, loader):
+        cache_key = (table,) + key
+        with self._lock:
+            generation = self._generations.get(table, 0)
+            entry = self._entries.get(cache_key)
+            if entry is not None and entry[0] == generation:
+                self._entries.move_to_end(cache_key)
+                return entry[1]
+        # Load outside the lock; a save that lands meanwhile bumps the generation
+        # and the stale entry is simply reloaded on the next read.
+        value = loader()
+        with self._lock:
+            self._entries[cache_key] = (generation, value)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+@st.cache_resource
+def get_record_cache():
+    return RecordCache()
+
+def load_patient_records(table, patient_internal_id, order_column, limit=None, source=None, columns=None):
+    """All (or the latest `limit`) rows of one patient in an exam table, newest first.
+
+    Reads `<table>_all` (hot plus archived years) unless `source` names another
+    view over `table` (e.g. refraction_exams_wide_all); either way the entry is
+    invalidated by writes to `table`. `columns` narrows the SELECT to what the
+    caller displays."""
+    source = source or f"{table}_all"
+    columns = tuple(columns) if columns else None
+    def load():
+        sql = f"SELECT {', '.join(columns) if columns else '*'} FROM {source} WHERE patient_id = ? ORDER BY {order_column} DESC"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        return pd.read_sql(sql, get_conn(), params=(int(patient_internal_id),))
+    key = (source, int(patient_internal_id), order_column, limit, columns)
+    return get_record_cache().get_or_load(table, key, load)
+
+def load_refraction_history(patient_internal_id, stages, limit=None):
+    """One row per refraction exam with only the requested stages pivoted into wide columns."""
+    def load():
+        conn = get_conn()
+        sql = refraction_wide_all_sql(conn, stages, header=['id', 'patient_id', 'exam_date'])
+        sql = f"SELECT * FROM ({sql}) WHERE patient_id = ? ORDER BY exam_date DESC"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        return pd.read_sql(sql, conn, params=(int(patient_internal_id),))
+    key = ('stages', tuple(stages), int(patient_internal_id), limit)
+    return get_record_cache().get_or_load('refraction_exams', key, load)
+
+def invalidate_records(table):
+    """Call after committing a write to an exam table."""
+    get_record_cache().bump(table)
+
+# -----------------------
+# PATIENT TIMELINE
+# -----------------------
+# kind -> (exam table, date column, one-line summary as SQL over the row `t`).
+# Every branch reads <table>_all, so archived years are part of the timeline.
+TIMELINE_KINDS = {
+    "Medical History": ('medical_history', 'visit_date', "IFNULL(t.chief_complaint, '')"),
+    "Refraction": ('refraction_exams', 'exam_date', '''(
+        SELECT group_concat(v.eye || ' ' || printf('%+.2f', v.sphere) ||
+               CASE WHEN v.cylinder IS NOT NULL THEN printf(' %+.2f x %d', v.cylinder, v.axis) ELSE '' END, ', ')
+        FROM refraction_values_all v
+        WHERE v.exam_id = t.id AND v.stage = 'final_distance' AND v.sphere IS NOT NULL
+    )'''),
+    "Functional Tests": ('functional_tests', 'test_date',
+                         "'Motility: ' || IFNULL(t.motility, '-') || '; pupils: ' || IFNULL(t.pupils, '-')"),
+    "Anterior Segment": ('anterior_segment_exams', 'exam_date',
+                         "'IOP ' || IFNULL(t.tonometry_od, '-') || ' / ' || IFNULL(t.tonometry_os, '-') || ' mmHg'"),
+    "Posterior Segment": ('posterior_segment_exams', 'exam_date',
+                          "'Fundus OD: ' || IFNULL(t.fundus_od, '-') || '; OS: ' || IFNULL(t.fundus_os, '-')"),
+    "Contact Lenses": ('contact_lens_prescriptions', 'prescription_date',
+                       "IFNULL(t.lens_type, '') || IFNULL(' - ' || COALESCE(t.soft_brand, t.rgp_brand, t.scleral_brand), '')"),
+}
+TIMELINE_PAGE_SIZE = 50
+
+def patient_timeline_sql(kinds=None, start=None, end=None):
+    """One UNION ALL over the exam tables: (date, kind, id, summary), newest first.
+
+    Kinds not asked for are left out of the compound rather than filtered, and
+    the patient and date range are repeated inside every branch so each one is
+    a range scan on its (patient_id, date) index. Named parameters: :patient,
+    :limit and, when given, :start and :end (exclusive)."""
+    branches = []
+    for kind in (kinds or TIMELINE_KINDS):
+        table, date_column, summary = TIMELINE_KINDS[kind]
+        where = "t.patient_id = :patient"
+        if start:
+            where += f" AND t.{date_column} >= :start"
+        if end:
+            where += f" AND t.{date_column} < :end"
+        branches.append(f"SELECT t.{date_column} AS date, '{kind}' AS kind, t.id AS id, {summary} AS summary "
+                        f"FROM {table}_all t WHERE {where}")
+    return " UNION ALL ".join(branches) + " ORDER BY date DESC, kind, id DESC LIMIT :limit"
+
+def patient_timeline(patient_internal_id, kinds=None, start=None, end=None, limit=TIMELINE_PAGE_SIZE):
+    """The latest `limit` exams of a patient across every exam table as one DataFrame.
+
+    `start`/`end` are dates (both inclusive); `kinds` restricts to some TIMELINE_KINDS."""
+    params = {'patient': int(patient_internal_id), 'limit': int(limit)}
+    if start:
+        params['start'] = start.isoformat()
+    if end:
+        params['end'] = (end + timedelta(days=1)).isoformat()
+    return pd.read_sql(patient_timeline_sql(kinds, start, end), get_conn(), params=params)
+
+# -----------------------
+# ATTACHMENT STORE (content addressed)
+# -----------------------
+UPLOADS_DIR = "uploads"
+BLOB_DIR = os.path.join(UPLOADS_DIR, "blobs")
+
+def blob_path(sha256):
+    """uploads/blobs/ab/cd/abcd... - two levels of sharding keep directories small."""
+    return os.path.join(BLOB_DIR, sha256[:2], sha256[2:4], sha256)
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+BLOB_GC_INTERVAL = 3600  # seconds between sweeps for unreferenced blobs
+BLOB_GC_GRACE = 3600  # a blob untouched for this long with no attachments row is an orphan
+THUMBNAIL_DIR = os.path.join(UPLOADS_DIR, "thumbs")
+THUMBNAIL_SIZE = (256, 256)
+
+def store_upload(f):
+    """Stream one upload to the blob store in fixed-size chunks, hashing as it goes.
+
+    Identical content is kept only once. The blob is written before the exam
+    row commits; if that save fails, collect_orphan_blobs() removes it once it
+    is older than BLOB_GC_GRACE. Returns (sha256, path, size)."""
+    tmp_dir = os.path.join(BLOB_DIR, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    tmp_path = os.path.join(tmp_dir, f"{os.getpid()}.{threading.get_ident()}.{time.time_ns()}")
+    digest = hashlib.sha256()
+    size = 0
+    f.seek(0)
+    with open(tmp_path, "wb") as fp:
+        while True:
+            chunk = f.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            fp.write(chunk)
+            size += len(chunk)
+    sha256 = digest.hexdigest()
+    path = blob_path(sha256)
+    if os.path.exists(path):
+        os.remove(tmp_path)
+        os.utime(path)  # restart the grace period so a sweep can't race this save
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+    return sha256, path, size
+
+def store_uploads(uploaded_files):
+    """Write Streamlit uploads to the blob store; returns one dict per file."""
+    stored = []
+    for f in uploaded_files or []:
+        sha256, path, size = store_upload(f)
+        stored.append({
+            'sha256': sha256,
+            'path': path,
+            'name': f.name,
+            'mime_type': f.type,
+            'size': size,
+        })
+    return stored
+
+def link_attachments(c, exam_table, exam_id, stored_files):
+    """Record stored uploads against an exam row (same transaction as the exam insert).
+
+    Rows start as 'pending'; returns their ids for process_attachments()."""
+    attachment_ids = []
+    for f in stored_files:
+        c.execute('''
+            INSERT INTO attachments (exam_table, exam_id, sha256, original_name, mime_type, size_bytes, status)
+            VALUES (?, ?, ?, ?, ?, ?, 'pending')
+        ''', (exam_table, exam_id, f['sha256'], f['name'], f['mime_type'], f['size']))
+        attachment_ids.append(c.lastrowid)
+    return attachment_ids
+
+@st.cache_resource
+def get_attachment_executor():
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="attachments")
+
+def process_attachments(attachment_ids):
+    """Hand post-processing of committed attachments to the background pool."""
+    pool = init_db()
+    for attachment_id in attachment_ids:
+        get_attachment_executor().submit(_process_attachment, pool, attachment_id)
+
+def _process_attachment(pool, attachment_id):
+    """Verify the stored blob, extract metadata and build a thumbnail for images."""
+    conn = pool.connection()
+    try:
+        sha256, mime_type = conn.execute(
+            "SELECT sha256, mime_type FROM attachments WHERE id = ?", (attachment_id,)
+        ).fetchone()
+        path = blob_path(sha256)
+
+        digest = hashlib.sha256()
+        with open(path, "rb") as fp:
+            for chunk in iter(lambda: fp.read(UPLOAD_CHUNK_SIZE), b""):
+                digest.update(chunk)
+        if digest.hexdigest() != sha256:
+            raise ValueError(f"checksum mismatch for {path}")
+
+        metadata = {}
+        if mime_type and mime_type.startswith("image/"):
+            try:
+                from PIL import Image
+                with Image.open(path) as image:
+                    metadata.update({'width': image.width, 'height': image.height, 'format': image.format})
+                    thumb_path = os.path.join(THUMBNAIL_DIR, sha256[:2], f"{sha256}.png")
+                    if not os.path.exists(thumb_path):
+                        os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+                        image.thumbnail(THUMBNAIL_SIZE)
+                        image.save(thumb_path, "PNG")
+                    metadata['thumbnail'] = thumb_path
+            except ImportError:
+                pass
+
+        conn.execute("UPDATE attachments SET status = 'ready', metadata = ? WHERE id = ?",
+                     (json.dumps(metadata), attachment_id))
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        conn.execute("UPDATE attachments SET status = 'failed', metadata = ? WHERE id = ?",
+                     (json.dumps({'error': str(e)}), attachment_id))
+        conn.commit()
+        print(f"Attachment {attachment_id} processing failed: {e}")
+
+def collect_orphan_blobs(conn, grace=BLOB_GC_GRACE):
+    """Delete blobs (and leftover temp files) no attachments row refers to.
+
+    Only files untouched for `grace` seconds are considered, so uploads whose
+    exam is still being saved are left alone. Returns (files removed, bytes freed)."""
+    cutoff = time.time() - grace
+    removed = freed = 0
+    for directory, _, names in os.walk(BLOB_DIR):
+        in_tmp = os.path.basename(directory) == "tmp"
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if stat.st_mtime > cutoff:
+                continue
+            if not in_tmp and conn.execute("SELECT 1 FROM attachments WHERE sha256 = ? LIMIT 1", (name,)).fetchone():
+                continue
+            os.remove(path)
+            removed += 1
+            freed += stat.st_size
+    return removed, freed
+
+@st.cache_resource
+def get_blob_collector():
+    return {'started': 0.0, 'lock': threading.Lock()}
+
+def schedule_blob_collection():
+    """Sweep orphaned blobs on the attachment pool at most every BLOB_GC_INTERVAL."""
+    collector = get_blob_collector()
+    with collector['lock']:
+        if time.time() - collector['started'] < BLOB_GC_INTERVAL:
+            return
+        collector['started'] = time.time()
+    get_attachment_executor().submit(_collect_blobs_in_background, init_db())
+
+def _collect_blobs_in_background(pool):
+    try:
+        removed, freed = collect_orphan_blobs(pool.connection())
+        if removed:
+            print(f"Removed {removed} orphaned blob(s), {freed / 1e6:.1f} MB")
+    except Exception as e:
+        print(f"Blob collection failed: {e}")
+
+# -----------------------
+# BULK IMPORT (CSV / JSON)
+# -----------------------
+IMPORT_BATCH_SIZE = 5000
+PATIENT_IMPORT_COLUMNS = ['patient_id', 'first_name', 'last_name', 'date_of_birth', 'gender', 'phone', 'email',
+                          'address', 'id_number', 'emergency_contact', 'insurance_info', 'created_date']
+PATIENT_REQUIRED_COLUMNS = ('patient_id', 'first_name', 'last_name', 'date_of_birth')
+IMPORT_KINDS = ['patients'] + [table for table, _ in ARCHIVE_TABLES]
+IMPORT_DATE_FORMATS = ('%d.%m.%Y', '%d/%m/%Y', '%d.%m.%Y %H:%M', '%d/%m/%Y %H:%M')  # tried after ISO 8601
+
+def import_format(filename):
+    """'csv', 'jsonl' or 'json' from the file extension."""
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in ('.jsonl', '.ndjson'):
+        return 'jsonl'
+    return 'json' if extension == '.json' else 'csv'
+
+def read_import_file(f, fmt):
+    """Yield records from a binary file object one at a time.
+
+    CSV and JSON Lines are streamed; a plain JSON array has to be parsed whole.
+    A JSON line that does not parse is yielded as its raw text and rejected."""
+    text = io.TextIOWrapper(f, encoding='utf-8-sig', newline='')
+    if fmt == 'csv':
+        yield from csv.DictReader(text)
+    elif fmt == 'jsonl':
+        for line in text:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield line.rstrip("\n")
+    else:
+        yield from json.load(text)
+
+def parse_import_date(value, with_time=False):
+    """Normalise a date to the stored text format ('YYYY-MM-DD[ HH:MM:SS]')."""
+    value = str(value).strip()
+    try:
+        parsed = datetime.fromisoformat(value)  # fast path for the common ISO forms
+        return parsed.strftime('%Y-%m-%d %H:%M:%S' if with_time else '%Y-%m-%d')
+    except ValueError:
+        pass
+    for fmt in IMPORT_DATE_FORMATS:
+        try:
+            parsed = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        return parsed.strftime('%Y-%m-%d %H:%M:%S' if with_time else '%Y-%m-%d')
+    raise ValueError(f"unrecognised date '{value}'")
+
+def _import_context(conn, kind):
+    """Everything validation needs that would otherwise be looked up per row."""
+    if kind == 'patients':
+        return {}
+    date_column = dict(ARCHIVE_TABLES)[kind]
+    columns = {row[1]: (row[2] or 'TEXT').upper() for row in conn.execute(f"PRAGMA table_info({kind})")}
+    if kind == 'refraction_exams':
+        for _, _, field, wide in refraction_stage_columns():
+            columns[wide] = {'sphere': 'REAL', 'cylinder': 'REAL', 'axis': 'INTEGER'}.get(field, 'TEXT')
+    for skipped in ('id', 'patient_id', date_column):
+        columns.pop(skipped, None)
+    return {
+        'date_column': date_column,
+        'columns': columns,
+        'patients': dict(conn.execute("SELECT patient_id, id FROM patients")),
+    }
+
+def _coerce_import_value(name, value, column_type):
+    if 'INT' in column_type:
+        number = float(value)
+        if not number.is_integer():
+            raise ValueError(f"{name} must be a whole number")
+        number = int(number)
+        if name.endswith('_axis') and not 0 <= number <= 180:
+            raise ValueError(f"{name} out of range 0-180")
+        return number
+    if 'REAL' in column_type:
+        return float(value)
+    return value
+
+def validate_import_record(kind, record, context):
+    """Map one raw record onto the target table; raises ValueError with the reason."""
+    record = {key.strip(): value.strip() if isinstance(value, str) else value
+              for key, value in record.items() if key}
+    record = {key: value for key, value in record.items() if value not in ('', None)}
+
+    if kind == 'patients':
+        missing = [column for column in PATIENT_REQUIRED_COLUMNS if column not in record]
+        if missing:
+            raise ValueError("missing " + ", ".join(missing))
+        row = {column: record.get(column) for column in PATIENT_IMPORT_COLUMNS}
+        row['patient_id'] = str(row['patient_id'])
+        row['date_of_birth'] = parse_import_date(row['date_of_birth'])
+        if row['created_date'] is not None:
+            # registration date from the old system; without it the patient counts as registered today
+            row['created_date'] = parse_import_date(row['created_date'], with_time=True)
+        return row
+
+    date_column = context['date_column']
+    patient_internal_id = context['patients'].get(str(record.get('patient_id', '')))
+    if patient_internal_id is None:
+        raise ValueError(f"unknown patient_id '{record.get('patient_id', '')}'")
+    if date_column not in record:
+        raise ValueError(f"missing {date_column}")
+    row = {'patient_id': patient_internal_id, date_column: parse_import_date(record[date_column], with_time=True)}
+    for name, value in record.items():
+        column_type = context['columns'].get(name)
+        if column_type is None:
+            continue  # unknown columns are ignored, not rejected
+        try:
+            row[name] = _coerce_import_value(name, value, column_type)
+        except (TypeError, ValueError) as e:
+            raise ValueError(str(e) if name in str(e) else f"invalid {name} '{value}'")
+    return row
+
+def _write_patients(conn, batch, rejected):
+    ids = [row['patient_id'] for _, row in batch]
+    existing = {pid for (pid,) in conn.execute(
+        f"SELECT patient_id FROM patients WHERE patient_id IN ({', '.join('?' * len(ids))})", ids)}
+    rows = []
+    for number, row in batch:
+        if row['patient_id'] in existing:
+            rejected.append((number, f"patient_id '{row['patient_id']}' already exists", row))
+            continue
+        existing.add(row['patient_id'])
+        rows.append([row[column] for column in PATIENT_IMPORT_COLUMNS])
+    last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM patients").fetchone()[0]
+    values = ", ".join("COALESCE(?, CURRENT_TIMESTAMP)" if column == 'created_date' else "?" for column in PATIENT_IMPORT_COLUMNS)
+    conn.executemany(f"INSERT INTO patients ({', '.join(PATIENT_IMPORT_COLUMNS)}) VALUES ({values})", rows)
+    index_patient_names(conn, conn.execute("SELECT id, first_name, last_name FROM patients WHERE id > ?", (last_id,)).fetchall())
+    return len(rows)
+
+def _write_exams(conn, table, batch):
+    columns = list(dict.fromkeys(column for _, row in batch for column in row))
+    conn.executemany(
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+        [[row.get(column) for column in columns] for _, row in batch]
+    )
+    return len(batch)
+
+def _write_refractions(conn, batch):
+    # Ids are assigned here (we hold the write lock) so the value rows can be
+    # written with executemany instead of one header insert per exam.
+    next_id = conn.execute(
+        "SELECT MAX(COALESCE((SELECT MAX(id) FROM refraction_exams), 0), "
+        "COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'refraction_exams'), 0)) + 1"
+    ).fetchone()[0]
+    present = set().union(*(row for _, row in batch))
+    header = ['id', 'patient_id', 'exam_date'] + [column for column in REFRACTION_HEADER_COLUMNS if column in present]
+    exams, values = [], []
+    for exam_id, (_, row) in enumerate(batch, start=next_id):
+        row['id'] = exam_id
+        exams.append([row.get(column) for column in header])
+        values.extend(refraction_value_rows(exam_id, row))
+    conn.executemany(f"INSERT INTO refraction_exams ({', '.join(header)}) VALUES ({', '.join('?' * len(header))})", exams)
+    conn.executemany(
+        "INSERT INTO refraction_values (exam_id, stage, eye, sphere, cylinder, axis, prism, base, va) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        values
+    )
+    return len(batch)
+
+def import_records(conn, kind, records, batch_size=IMPORT_BATCH_SIZE, progress=None):
+    """Validate records and insert them with executemany, one transaction per batch.
+
+    `kind` is 'patients' or an exam table; exam records reference patients by
+    their patient_id code. Returns (imported, rejected) where rejected is a list
+    of (record number, reason, record). `progress(imported, rejected)` is called
+    after every committed batch."""
+    context = _import_context(conn, kind)
+    imported = 0
+    rejected = []
+    batch = []
+
+    def flush():
+        nonlocal imported
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if kind == 'patients':
+                imported += _write_patients(conn, batch, rejected)
+            elif kind == 'refraction_exams':
+                imported += _write_refractions(conn, batch)
+            else:
+                imported += _write_exams(conn, kind, batch)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        batch.clear()
+        if progress:
+            progress(imported, len(rejected))
+
+    for number, record in enumerate(records, start=1):
+        if not isinstance(record, dict):
+            rejected.append((number, "not a record", record))
+            continue
+        try:
+            batch.append((number, validate_import_record(kind, record, context)))
+        except ValueError as e:
+            rejected.append((number, str(e), record))
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return imported, rejected
+
+def rejected_rows_csv(rejected):
+    """Rejected records as CSV text (record number, reason, original record as JSON)."""
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(['record', 'reason', 'data'])
+    for number, reason, record in rejected:
+        writer.writerow([number, reason, json.dumps(record, default=str)])
+    return out.getvalue()
+
+# -----------------------
+# COLUMNAR ANALYTICS COPY (Parquet)
+# -----------------------
+ANALYTICS_DIR = "analytics"
+ANALYTICS_EXPORT_INTERVAL = 300  # seconds between incremental exports
+ANALYTICS_REBUILD_INTERVAL = 24 * 3600  # seconds between full exports, which pick up edited and deleted rows
+ANALYTICS_MAX_PARTS = 32  # parts per dataset before they are compacted into one file
+ANALYTICS_GENERATION_GRACE = ANALYTICS_EXPORT_INTERVAL  # seconds a replaced generation stays readable
+
+# dataset: (source table or view, watermark column, {column: type})
+# Append-only exam data: new rows are exported above the id watermark.
+ANALYTICS_DATASETS = {
+    'refraction_exams': ('refraction_exams_all', 'id', {
+        'id': 'int', 'patient_id': 'int', 'exam_date': 'date', 'habitual_type': 'text',
+        'final_add_od': 'real', 'final_add_os': 'real'}),
+    'refraction_values': ('refraction_values_all', 'exam_id', {
+        'exam_id': 'int', 'stage': 'text', 'eye': 'text', 'sphere': 'real', 'cylinder': 'real', 'axis': 'real'}),
+    'anterior_segment_exams': ('anterior_segment_exams_all', 'id', {
+        'id': 'int', 'patient_id': 'int', 'exam_date': 'date',
+        'tonometry_od': 'real', 'tonometry_os': 'real', 'pachymetry_od': 'real', 'pachymetry_os': 'real'}),
+    'contact_lens_prescriptions': ('contact_lens_prescriptions_all', 'id', {
+        'id': 'int', 'patient_id': 'int', 'prescription_date': 'date', 'lens_type': 'text'}),
+}
+
+# Tables the app updates and deletes rows of (appointments are rescheduled,
+# cancelled and deleted); a watermark can't follow them, so analytics_frame
+# always reads these from SQLite. Same shape as ANALYTICS_DATASETS.
+LIVE_ANALYTICS_DATASETS = {
+    'patients': ('patients', 'id', {
+        'id': 'int', 'gender': 'text', 'date_of_birth': 'date', 'created_date': 'date'}),
+    'appointments': ('appointments', 'id', {
+        'id': 'int', 'patient_id': 'int', 'appointment_date': 'date', 'appointment_type': 'text', 'status': 'text'}),
+}
+
+# Each dataset lives in generation directories, analytics/<dataset>/gen-<ns>/,
+# and the CURRENT file names the one readers use. Appends add parts to the
+# current generation; a rebuild or compaction writes a new generation and
+# swaps CURRENT in one rename, so readers never see a half-written copy, and
+# part paths are never reused (they key the read cache).
+def _analytics_generation(dataset):
+    """Directory of the dataset's current generation, or None before the first export."""
+    try:
+        with open(os.path.join(ANALYTICS_DIR, dataset, "CURRENT")) as fp:
+            return os.path.join(ANALYTICS_DIR, dataset, fp.read().strip())
+    except FileNotFoundError:
+        return None
+
+def _new_analytics_generation(dataset):
+    directory = os.path.join(ANALYTICS_DIR, dataset, f"gen-{time.time_ns()}")
+    os.makedirs(directory)
+    return directory
+
+def _publish_analytics_generation(dataset, directory):
+    """Point CURRENT at `directory`; the generation it replaces is pruned after a grace period."""
+    previous = _analytics_generation(dataset)
+    current = os.path.join(ANALYTICS_DIR, dataset, "CURRENT")
+    with open(current + ".tmp", "w") as fp:
+        fp.write(os.path.basename(directory))
+    os.replace(current + ".tmp", current)
+    if previous and os.path.isdir(previous):
+        os.utime(previous)  # start its grace period now
+
+def _prune_analytics_generations(dataset):
+    """Delete replaced generations (and parts of the old flat layout) readers are done with."""
+    directory = os.path.join(ANALYTICS_DIR, dataset)
+    current = _analytics_generation(dataset)
+    cutoff = time.time() - ANALYTICS_GENERATION_GRACE
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if path == current or name.startswith("CURRENT") or os.path.getmtime(path) > cutoff:
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+
+def _analytics_parts(dataset, directory=None):
+    """[(first id, last id, path)] of the Parquet parts of a generation (default: the current one) in id order.
+
+    The last id of the newest part is the export watermark; keeping it in the
+    file name means a part and its watermark are published by one rename."""
+    directory = directory or _analytics_generation(dataset)
+    parts = []
+    if directory and os.path.isdir(directory):
+        for name in os.listdir(directory):
+            match = re.fullmatch(r"part-(\d+)-(\d+)\.parquet", name)
+            if match:
+                parts.append((int(match.group(1)), int(match.group(2)), os.path.join(directory, name)))
+    return sorted(parts)
+
+def _analytics_part_columns(path):
+    return tuple(pq.read_schema(path).names)
+
+def _typed_analytics_frame(df, columns):
+    """Coerce raw rows to the dataset types; free-text numbers that don't parse become NaN."""
+    for name, kind in columns.items():
+        if kind == 'int':
+            df[name] = df[name].astype('int64')
+        elif kind == 'real':
+            df[name] = pd.to_numeric(df[name], errors='coerce').astype('float64')
+        elif kind == 'date':
+            df[name] = pd.to_datetime(df[name], errors='coerce', format='ISO8601').astype('datetime64[us]')
+        else:
+            df[name] = df[name].astype('string')
+    return df
+
+def export_analytics(conn, rebuild=False):
+    """Append rows above each dataset's watermark to its Parquet copy.
+
+    All datasets are read in one snapshot so refraction values never get ahead
+    of their exams. Rows changed after they were exported are only picked up
+    by a full export: `rebuild`, or the first export after
+    ANALYTICS_REBUILD_INTERVAL, which writes new generations.
+    Returns {dataset: rows appended}."""
+    if pa is None:
+        raise RuntimeError("pyarrow is not installed")
+    marker = os.path.join(ANALYTICS_DIR, "rebuilt")
+    rebuild = (rebuild or not os.path.exists(marker)
+               or time.time() - os.path.getmtime(marker) > ANALYTICS_REBUILD_INTERVAL)
+
+    frames = {}
+    generations = {}  # dataset: generation appended to, None for a new one
+    conn.execute("BEGIN")
+    try:
+        for dataset, (source, key, columns) in ANALYTICS_DATASETS.items():
+            generation = None if rebuild else _analytics_generation(dataset)
+            parts = _analytics_parts(dataset, generation) if generation else []
+            if parts and not set(columns) <= set(_analytics_part_columns(parts[-1][2])):
+                # A column was added to the dataset since this copy was written
+                generation, parts = None, []
+            generations[dataset] = generation
+            watermark = parts[-1][1] if parts else 0
+            frames[dataset] = pd.read_sql(
+                f"SELECT {', '.join(columns)} FROM {source} WHERE {key} > ? ORDER BY {key}",
+                conn, params=(watermark,)
+            )
+    finally:
+        conn.rollback()
+
+    appended = {}
+    type_map = {'int': pa.int64(), 'real': pa.float64(), 'text': pa.string(), 'date': pa.timestamp('us')}
+    for dataset, df in frames.items():
+        appended[dataset] = len(df)
+        generation = generations[dataset]
+        directory = generation or _new_analytics_generation(dataset)
+        if not df.empty:
+            _, key, columns = ANALYTICS_DATASETS[dataset]
+            df = _typed_analytics_frame(df, columns)
+            schema = pa.schema([(name, type_map[kind]) for name, kind in columns.items()])
+            path = os.path.join(directory, f"part-{int(df[key].iloc[0]):012d}-{int(df[key].iloc[-1]):012d}.parquet")
+            pq.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False), path + ".tmp")
+            os.replace(path + ".tmp", path)
+        if generation is None:
+            _publish_analytics_generation(dataset, directory)
+        elif len(_analytics_parts(dataset, directory)) > ANALYTICS_MAX_PARTS:
+            _compact_analytics(dataset)
+        _prune_analytics_generations(dataset)
+    if rebuild:
+        open(marker, "w").close()
+    return appended
+
+def _compact_analytics(dataset):
+    """Merge the current generation's parts into one file in a new generation."""
+    parts = _analytics_parts(dataset)
+    table = pa.concat_tables([pq.read_table(path) for _, _, path in parts])
+    directory = _new_analytics_generation(dataset)
+    path = os.path.join(directory, f"part-{parts[0][0]:012d}-{parts[-1][1]:012d}.parquet")
+    pq.write_table(table, path + ".tmp")
+    os.replace(path + ".tmp", path)
+    _publish_analytics_generation(dataset, directory)
+
+@st.cache_resource
+def get_analytics_exporter():
+    return {'executor': ThreadPoolExecutor(max_workers=1, thread_name_prefix="analytics-export"),
+            'started': 0.0, 'lock': threading.Lock()}
+
+def schedule_analytics_export():
+    """Refresh the columnar copy in the background at most every ANALYTICS_EXPORT_INTERVAL."""
+    if pa is None:
+        return
+    exporter = get_analytics_exporter()
+    with exporter['lock']:
+        if time.time() - exporter['started'] < ANALYTICS_EXPORT_INTERVAL:
+            return
+        exporter['started'] = time.time()
+    exporter['executor'].submit(_export_analytics_in_background, init_db())
+
+def _export_analytics_in_background(pool):
+    try:
+        appended = export_analytics(pool.connection())
+        if any(appended.values()):
+            print(f"Analytics export appended {sum(appended.values())} row(s)")
+    except Exception as e:
+        print(f"Analytics export failed: {e}")
+
+@functools.lru_cache(maxsize=64)
+def _read_analytics_parts(paths, columns):
+    # lru_cache because the analytics refresher thread reads here too; callers get copies
+    return pa.concat_tables([pq.read_table(path, columns=list(columns)) for path in paths]).to_pandas()
+
+def analytics_frame(dataset, columns):
+    """Columns of an analytics dataset, read from the Parquet copy.
+
+    Reads the source table directly for LIVE_ANALYTICS_DATASETS and when there
+    is no copy yet (first run, pyarrow not installed, or a copy written before
+    one of the columns was added), so callers have one code path."""
+    if dataset in LIVE_ANALYTICS_DATASETS:
+        source, _, types = LIVE_ANALYTICS_DATASETS[dataset]
+        df = pd.read_sql(f"SELECT {', '.join(columns)} FROM {source}", get_conn())
+        return _typed_analytics_frame(df, {name: types[name] for name in columns})
+    paths = tuple(path for _, _, path in _analytics_parts(dataset)) if pa is not None else ()
+    if paths and set(columns) <= set(_analytics_part_columns(paths[0])):
+        return _read_analytics_parts(paths, tuple(columns)).copy()
+    source, _, types = ANALYTICS_DATASETS[dataset]
+    df = pd.read_sql(f"SELECT {', '.join(columns)} FROM {source}", get_conn())
+    return _typed_analytics_frame(df, {name: types[name] for name in columns})
+
+# -----------------------
+# ANALYTICS RESULT CACHE (TTL, background refresh)
+# -----------------------
+ANALYTICS_CACHE_TTL = 600  # seconds; Clinic Settings can change it
+ANALYTICS_REFRESH_AHEAD = 0.8  # share of the TTL after which a result is recomputed in the background
+ANALYTICS_REFRESH_POLL = 5  # seconds between refresher passes
+ANALYTICS_IDLE_TTLS = 3  # results nobody has read for this many TTLs are dropped, not refreshed
+
+class AnalyticsCache:
+    """Clinical Analytics aggregates shared by every session, kept fresh by a background thread.
+
+    A result is computed in the foreground only the first time it is asked
+    for; concurrent first readers wait for that one computation. After that
+    get() returns at once and the refresher thread recomputes the result
+    ANALYTICS_REFRESH_AHEAD into its TTL, so readers never wait and never see
+    data much older than the TTL."""
+    def __init__(self, pool, ttl=ANALYTICS_CACHE_TTL):
+        self.pool = pool
+        self.ttl = ttl
+        self._entries = {}  # key -> {'value', 'computed_at', 'read_at', 'retry_at', 'compute'}
+        self._loading = {}  # key -> lock held by the first computation
+        self._lock = threading.Lock()
+        threading.Thread(target=self._refresh_loop, name="analytics-refresh", daemon=True).start()
+
+    def get(self, key, compute):
+        """(value, computed_at) for `key`; `compute()` runs here only if there is no result yet."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                loading = self._loading.setdefault(key, threading.Lock())
+        if entry is None:
+            with loading:
+                with self._lock:
+                    entry = self._entries.get(key)
+                if entry is None:
+                    computed_at = time.time()
+                    entry = {'value': compute(), 'computed_at': computed_at, 'retry_at': 0.0, 'compute': compute}
+                    with self._lock:
+                        self._entries[key] = entry
+                        self._loading.pop(key, None)
+        entry['read_at'] = time.time()
+        return entry['value'], entry['computed_at']
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _refresh_loop(self):
+        _worker.pool = self.pool
+        while True:
+            time.sleep(ANALYTICS_REFRESH_POLL)
+            now = time.time()
+            with self._lock:
+                for key in [key for key, entry in self._entries.items()
+                            if now - entry.get('read_at', now) > self.ttl * ANALYTICS_IDLE_TTLS]:
+                    del self._entries[key]
+                due = [(key, entry) for key, entry in self._entries.items()
+                       if now - entry['computed_at'] >= self.ttl * ANALYTICS_REFRESH_AHEAD and now >= entry['retry_at']]
+            for key, entry in due:
+                computed_at = time.time()
+                try:
+                    value = entry['compute']()
+                except Exception as e:
+                    print(f"Analytics refresh of {key[0]} failed: {e}")
+                    entry['retry_at'] = time.time() + self.ttl * (1 - ANALYTICS_REFRESH_AHEAD)
+                    continue
+                with self._lock:
+                    # Unless "Refresh now" cleared the cache meanwhile
+                    if self._entries.get(key) is entry:
+                        self._entries[key] = dict(entry, value=value, computed_at=computed_at)
+
+@st.cache_resource
+def get_analytics_cache():
+    return AnalyticsCache(init_db())
+
+def cached_analytics(compute, *args):
+    """(compute(*args), when it was computed) from the shared analytics cache; args must be hashable."""
+    return get_analytics_cache().get((compute.__name__,) + args, lambda: compute(*args))
+
+def analytics_cache_ttl():
+    return int(scalar("SELECT analytics_cache_ttl FROM clinic_settings WHERE analytics_cache_ttl > 0 LIMIT 1")
+               or ANALYTICS_CACHE_TTL)
+
+def save_analytics_cache_ttl(seconds):
+    conn = get_conn()
+    if scalar("SELECT COUNT(*) FROM clinic_settings", conn=conn):
+        conn.execute("UPDATE clinic_settings SET analytics_cache_ttl = ?", (int(seconds),))
+    else:
+        conn.execute("INSERT INTO clinic_settings (analytics_cache_ttl) VALUES (?)", (int(seconds),))
+    conn.commit()
+
+# -----------------------
+# POWER VECTORS (M, J0, J45)
+# -----------------------
+# Sphere/cylinder/axis can't be averaged or subtracted directly; power vectors
+# can:  M = S + C/2,  J0 = -C/2 cos 2a,  J45 = -C/2 sin 2a  (Thibos).
+# Everything below works on whole columns - no Python loop per exam - so the
+# practice-wide progression review runs over every refraction on file.
+POWER_VECTOR_STAGES = {
+    'habitual_distance': "Habitual",
+    'autorefractor': "Autorefraction",
+    'subjective': "Subjective",
+    'final_distance': "Final",
+}
+POWER_VECTORS = ['M', 'J0', 'J45']
+PROGRESSION_MIN_YEARS = 0.5  # follow-up needed before a change rate is reported
+MYOPIA_PROGRESSION_RATE = -0.5  # D/year of M; faster myopic shift is flagged for review
+MYOPIA_REVIEW_ROWS = 100
+
+def power_vectors(sphere, cylinder, axis):
+    """(M, J0, J45) float arrays for equally long sphere, cylinder and axis columns.
+
+    A missing cylinder is plano; a cylinder without an axis gives NaN J0/J45,
+    a missing sphere NaN everywhere."""
+    sphere = np.asarray(pd.to_numeric(sphere, errors='coerce'), dtype='float64')
+    cylinder = np.nan_to_num(np.asarray(pd.to_numeric(cylinder, errors='coerce'), dtype='float64'), nan=0.0)
+    axis = np.asarray(pd.to_numeric(axis, errors='coerce'), dtype='float64')
+    angle = 2 * np.radians(np.where(cylinder == 0, 0.0, axis))
+    half_cylinder = cylinder / 2
+    return sphere + half_cylinder, -half_cylinder * np.cos(angle), -half_cylinder * np.sin(angle)
+
+def add_power_vectors(df):
+    """Copy of `df` (sphere, cylinder, axis columns) with M, J0 and J45 added."""
+    return df.assign(**dict(zip(POWER_VECTORS, power_vectors(df['sphere'], df['cylinder'], df['axis']))))
+
+def patient_power_vectors(patient_internal_id, stages=tuple(POWER_VECTOR_STAGES)):
+    """Every measured refraction of a patient as exam_date, stage, eye, sphere..axis, M, J0, J45; oldest first.
+
+    Like refraction_wide_all_sql, each attached year joins exams to values
+    inside its own file."""
+    stages = tuple(stages)
+    def load():
+        conn = get_conn()
+        branches = [f'''
+            SELECT r.exam_date, v.stage, v.eye, v.sphere, v.cylinder, v.axis
+            FROM {schema}.refraction_exams r
+            JOIN {schema}.refraction_values v ON v.exam_id = r.id
+            WHERE r.patient_id = ? AND v.stage IN ({', '.join('?' * len(stages))}) AND v.sphere IS NOT NULL
+        ''' for schema in ['main'] + archive_schemas(conn)
+            if _table_columns(conn, 'refraction_values', schema)]
+        df = pd.read_sql(" UNION ALL ".join(branches) + " ORDER BY exam_date", conn,
+                         params=(int(patient_internal_id), *stages) * len(branches))
+        df['exam_date'] = pd.to_datetime(df['exam_date'], errors='coerce', format='ISO8601')
+        return add_power_vectors(df)
+    return get_record_cache().get_or_load('refraction_exams', ('power_vectors', int(patient_internal_id), stages), load)
+
+def practice_power_vectors(stage='final_distance'):
+    """patient_id, exam_date, eye and power vectors of one stage for every refraction on file."""
+    values = analytics_frame('refraction_values', ['exam_id', 'stage', 'eye', 'sphere', 'cylinder', 'axis'])
+    values = values[(values['stage'] == stage) & values['sphere'].notna()]
+    exams = analytics_frame('refraction_exams', ['id', 'patient_id', 'exam_date'])
+    df = values.merge(exams, left_on='exam_id', right_on='id')
+    return add_power_vectors(df[['patient_id', 'exam_date', 'eye', 'sphere', 'cylinder', 'axis']])
+
+def progression_rates(df, by=('patient_id', 'eye')):
+    """Least-squares change per year of M, J0 and J45 for every `by` group of `df`.
+
+    Slopes are sum((t - mean t) * y) / sum((t - mean t)^2) from grouped sums,
+    one pass over the frame. Groups followed for less than
+    PROGRESSION_MIN_YEARS are left out. Returns one row per group: exams,
+    first_exam, last_exam, years, latest M and <vector>_rate in D/year."""
+    by = list(by)
+    df = df.dropna(subset=['exam_date'] + POWER_VECTORS).sort_values('exam_date')
+    years = (df['exam_date'] - df['exam_date'].min()).dt.days / 365.25
+    t = years - years.groupby([df[column] for column in by]).transform('mean')
+    frame = df[by + ['exam_date', 'M']].assign(tt=t * t, **{f"{name}_t": df[name] * t for name in POWER_VECTORS})
+    sums = frame.groupby(by).agg(
+        exams=('exam_date', 'size'), first_exam=('exam_date', 'min'), last_exam=('exam_date', 'max'),
+        latest_M=('M', 'last'), tt=('tt', 'sum'), **{f"{name}_t": (f"{name}_t", 'sum') for name in POWER_VECTORS}
+    )
+    sums['years'] = (sums['last_exam'] - sums['first_exam']).dt.days / 365.25
+    sums = sums[sums['years'] >= PROGRESSION_MIN_YEARS]
+    for name in POWER_VECTORS:
+        sums[f"{name}_rate"] = sums[f"{name}_t"] / sums['tt']
+    return sums.drop(columns=['tt'] + [f"{name}_t" for name in POWER_VECTORS]).reset_index()
+
+# -----------------------
+# REFRACTIVE CONDITIONS
+# -----------------------
+# Categories of each patient's latest final distance Rx (a patient can be in
+# several). Thresholds are per eye unless noted.
+MYOPIA_M = -0.50  # M at or below
+HYPEROPIA_M = 0.50  # M at or above
+ASTIGMATISM_CYL = 0.75  # |cylinder| at or above
+ANISOMETROPIA_M = 1.00  # |M OD - M OS| at or above
+PRESBYOPIA_ADD = 0.75  # near ADD at or above
+PRESBYOPIA_AGE = 45  # when no ADD was recorded
+REFRACTIVE_CONDITIONS = ['Myopia', 'Hyperopia', 'Astigmatism', 'Anisometropia', 'Presbyopia']
+CONDITION_WINDOWS = {"Last 30 days": 30, "Last 90 days": 90, "Last 12 months": 365, "All time": None}
+
+def refractive_condition_flags(window_days=None, today=None):
+    """One row per patient examined in the window: their latest final Rx exam and a bool column per condition."""
+    today = pd.Timestamp(today or date.today())
+    exams = analytics_frame('refraction_exams', ['id', 'patient_id', 'exam_date', 'final_add_od', 'final_add_os'])
+    if window_days:
+        exams = exams[exams['exam_date'] >= today - pd.Timedelta(days=window_days)]
+
+    values = analytics_frame('refraction_values', ['exam_id', 'stage', 'eye', 'sphere', 'cylinder', 'axis'])
+    values = values[(values['stage'] == 'final_distance') & values['sphere'].notna() & values['exam_id'].isin(exams['id'])]
+    values = add_power_vectors(values).assign(abs_cylinder=values['cylinder'].abs().fillna(0.0))
+    per_eye = values.pivot_table(index='exam_id', columns='eye', values=['M', 'abs_cylinder'], aggfunc='first')
+    per_eye.columns = [f"{name}_{eye}" for name, eye in per_eye.columns]
+    per_eye = per_eye.reindex(columns=['M_OD', 'M_OS', 'abs_cylinder_OD', 'abs_cylinder_OS'])
+
+    # Latest exam with a final Rx per patient
+    latest = (exams[exams['id'].isin(per_eye.index)]
+              .sort_values(['exam_date', 'id'])
+              .drop_duplicates('patient_id', keep='last')
+              .join(per_eye, on='id'))
+    patients = analytics_frame('patients', ['id', 'date_of_birth']).set_index('id')['date_of_birth']
+    age = (today - latest['patient_id'].map(patients)).dt.days / 365.25
+    add = latest[['final_add_od', 'final_add_os']].max(axis=1)
+    m = latest[['M_OD', 'M_OS']]
+
+    return latest[['patient_id', 'id', 'exam_date']].assign(
+        Myopia=(m <= MYOPIA_M).any(axis=1),
+        Hyperopia=(m >= HYPEROPIA_M).any(axis=1),
+        Astigmatism=(latest[['abs_cylinder_OD', 'abs_cylinder_OS']] >= ASTIGMATISM_CYL).any(axis=1),
+        Anisometropia=(m['M_OD'] - m['M_OS']).abs() >= ANISOMETROPIA_M,
+        Presbyopia=(add >= PRESBYOPIA_ADD) | (add.isna() & (age >= PRESBYOPIA_AGE)),
+    )
+
+def refractive_condition_counts(window_days=None):
+    """(patients examined in the window, patients per condition)."""
+    flags = refractive_condition_flags(window_days)
+    return len(flags), flags[REFRACTIVE_CONDITIONS].sum().astype('int64')
 
 def draw_tabo_scheme(od_axis, os_axis):
     """Create professional Tabo scheme visualization for axis"""
@@ -763,7 +2918,7 @@ def save_clinic_logo(uploaded_file):
             # Convert to bytes
             bytes_data = uploaded_file.getvalue()
             
-            c = conn.cursor()
+            c = get_conn().cursor()
             # Check if logo already exists
             c.execute("SELECT COUNT(*) FROM clinic_settings")
             count = c.fetchone()[0]
@@ -775,7 +2930,7 @@ def save_clinic_logo(uploaded_file):
                 # Insert new
                 c.execute("INSERT INTO clinic_settings (clinic_logo) VALUES (?)", (bytes_data,))
             
-            conn.commit()
+            get_conn().commit()
             return True
         return False
     except Exception as e:
@@ -785,7 +2940,7 @@ def save_clinic_logo(uploaded_file):
 def get_clinic_logo():
     """Get clinic logo from database"""
     try:
-        c = conn.cursor()
+        c = get_conn().cursor()
         c.execute("SELECT clinic_logo FROM clinic_settings LIMIT 1")
         result = c.fetchone()
         
@@ -815,19 +2970,34 @@ def ophtalcam_device_button(location, small=False):
 # -----------------------
 def schedule_appointment():
     st.markdown("<h2 class='main-header'>Schedule Appointment</h2>", unsafe_allow_html=True)
-    
+
+    # Lookup outside the form: pressing Enter reruns with a new candidate list
+    # instead of loading every patient into the selectbox
+    patient_query = st.text_input("Find patient", key="appt_patient_query",
+                                  placeholder="Surname, name or patient ID, then press Enter...")
+    candidates = find_patients_by_prefix(patient_query) if patient_query else []
+    truncated = len(candidates) == PATIENT_PICKER_LIMIT
+    if st.session_state.get('selected_patient'):
+        # Offer the current patient first only until a search for someone else is typed
+        current = one("SELECT patient_id, first_name, last_name FROM patients WHERE patient_id = ?",
+                      (st.session_state.selected_patient,))
+        if current is not None and not patient_query:
+            candidates = [current]
+        elif current is not None and any(row['patient_id'] == current['patient_id'] for row in candidates):
+            candidates = [current] + [row for row in candidates if row['patient_id'] != current['patient_id']]
+    if patient_query and not candidates:
+        st.info("No patients match. Check the spelling or register the patient first.")
+
     with st.form("appointment_form"):
         col1, col2 = st.columns(2)
-        
+
         with col1:
             # Patient selection
-            patients_df = pd.read_sql("SELECT patient_id, first_name, last_name FROM patients ORDER BY last_name, first_name", conn)
-            if patients_df.empty:
-                st.error("No patients found. Please register patients first.")
-                return
-                
-            patient_options = [f"{row['patient_id']} - {row['first_name']} {row['last_name']}" for _, row in patients_df.iterrows()]
-            selected_patient = st.selectbox("Select Patient*", patient_options)
+            patient_options = [f"{row['patient_id']} - {row['first_name']} {row['last_name']}" for row in candidates]
+            if truncated:
+                st.caption(f"First {PATIENT_PICKER_LIMIT} matches by surname - search more precisely to narrow them down")
+            selected_patient = st.selectbox("Select Patient*", patient_options,
+                                            placeholder="Search for a patient above")
             
             # Extract patient_id from selection
             patient_id = selected_patient.split(" - ")[0] if selected_patient else None
@@ -853,7 +3023,7 @@ def schedule_appointment():
                     # Combine date and time
                     appointment_datetime = datetime.combine(appointment_date, appointment_time)
                     
-                    c = conn.cursor()
+                    c = get_conn().cursor()
                     # Get patient internal ID
                     c.execute("SELECT id FROM patients WHERE patient_id = ?", (patient_id,))
                     patient_result = c.fetchone()
@@ -866,7 +3036,7 @@ def schedule_appointment():
                             (patient_id, appointment_date, duration_minutes, appointment_type, status, notes)
                             VALUES (?, ?, ?, ?, ?, ?)
                         ''', (patient_internal_id, appointment_datetime, duration, appointment_type, status, notes))
-                        conn.commit()
+                        get_conn().commit()
                         st.success(f"Appointment scheduled successfully for {appointment_datetime.strftime('%d.%m.%Y %H:%M')}!")
                     else:
                         st.error("Patient not found.")
@@ -877,16 +3047,17 @@ def schedule_appointment():
     # Display upcoming appointments
     st.markdown("### Upcoming Appointments")
     try:
-        upcoming_appts = pd.read_sql('''
-            SELECT a.*, p.first_name, p.last_name, p.patient_id 
-            FROM appointments a 
-            JOIN patients p ON a.patient_id = p.id 
-            WHERE DATE(a.appointment_date) >= ? 
+        upcoming_appts = rows('''
+            SELECT a.id, a.appointment_date, a.duration_minutes, a.appointment_type, a.status, a.notes,
+                   p.first_name, p.last_name, p.patient_id
+            FROM appointments a
+            JOIN patients p ON a.patient_id = p.id
+            WHERE a.appointment_date >= ?
             ORDER BY a.appointment_date
-        ''', conn, params=(date.today().strftime('%Y-%m-%d'),))
-        
-        if not upcoming_appts.empty:
-            for _, apt in upcoming_appts.iterrows():
+        ''', (date.today().strftime('%Y-%m-%d'),))
+
+        if upcoming_appts:
+            for apt in upcoming_appts:
                 apt_time = pd.to_datetime(apt['appointment_date']).strftime('%d.%m.%Y %H:%M')
                 with st.container():
                     col_a, col_b, col_c = st.columns([3, 1, 1])
@@ -901,9 +3072,9 @@ def schedule_appointment():
                             st.rerun()
                     with col_c:
                         if st.button("Delete", key=f"delete_{apt['id']}"):
-                            c = conn.cursor()
+                            c = get_conn().cursor()
                             c.execute("DELETE FROM appointments WHERE id = ?", (apt['id'],))
-                            conn.commit()
+                            get_conn().commit()
                             st.success("Appointment deleted!")
                             st.rerun()
         else:
@@ -914,9 +3085,71 @@ def schedule_appointment():
 # -----------------------
 # CLINICAL ANALYTICS - NOW FUNCTIONAL
 # -----------------------
+# Estimated fee per appointment type for the financial overview
+APPOINTMENT_FEES = {
+    'Routine Exam': 100,
+    'Contact Lens Fitting': 150,
+    'Follow-up': 80,
+    'Emergency': 200,
+    'Surgery Consultation': 250,
+}
+APPOINTMENT_DEFAULT_FEE = 100
+
+def exam_type_counts():
+    refractions = analytics_frame('refraction_exams', ['habitual_type'])
+    return refractions['habitual_type'].notna().map({True: 'With Correction', False: 'Without Correction'}).value_counts()
+
+def revenue_by_day(days=30):
+    _, _, types = LIVE_ANALYTICS_DATASETS['appointments']
+    appointments = _typed_analytics_frame(pd.read_sql(
+        "SELECT appointment_date, appointment_type FROM appointments WHERE appointment_date >= ?",
+        get_conn(), params=((date.today() - timedelta(days=days)).isoformat(),)
+    ), {name: types[name] for name in ('appointment_date', 'appointment_type')})
+    fees = appointments['appointment_type'].map(APPOINTMENT_FEES).fillna(APPOINTMENT_DEFAULT_FEE)
+    return (fees.groupby(appointments['appointment_date'].dt.strftime('%Y-%m-%d'))
+            .agg(['size', 'sum'])
+            .rename(columns={'size': 'appointments', 'sum': 'estimated_revenue'})
+            .rename_axis('date').reset_index())
+
+def myopia_progression_review(stage='final_distance'):
+    """(patients followed, patients flagged, up to MYOPIA_REVIEW_ROWS fastest-progressing eyes with names)."""
+    rates = progression_rates(practice_power_vectors(stage))
+    fast = rates[rates['M_rate'] <= MYOPIA_PROGRESSION_RATE].sort_values('M_rate')
+    followed, flagged = rates['patient_id'].nunique(), fast['patient_id'].nunique()
+    fast = fast.head(MYOPIA_REVIEW_ROWS)
+    if not fast.empty:
+        ids = [int(patient_id) for patient_id in fast['patient_id'].unique()]
+        names = pd.read_sql(f"SELECT id, patient_id AS patient, first_name, last_name FROM patients "
+                            f"WHERE id IN ({', '.join('?' * len(ids))})", get_conn(), params=ids)
+        fast = fast.merge(names, left_on='patient_id', right_on='id')
+    return followed, flagged, fast
+
+def contact_lens_type_counts():
+    return analytics_frame('contact_lens_prescriptions', ['lens_type'])['lens_type'].value_counts()
+
+def _age_text(seconds):
+    if seconds < 60:
+        return "just now"
+    if seconds < 3600:
+        return f"{int(seconds // 60)} min ago"
+    return f"{seconds / 3600:.1f} h ago"
+
 def clinical_analytics():
     st.markdown("<h2 class='main-header'>Clinical Analytics</h2>", unsafe_allow_html=True)
-    
+    schedule_analytics_export()
+    metrics = clinic_metrics()
+
+    # Aggregates come from the shared cache: instant for every viewer, at most
+    # about one TTL old. The status line is filled in once all are known.
+    cache = get_analytics_cache()
+    cache.ttl = analytics_cache_ttl()
+    status = st.container()
+    computed = []
+    def cached(compute, *args):
+        value, computed_at = cached_analytics(compute, *args)
+        computed.append(computed_at)
+        return value
+
     tab1, tab2, tab3, tab4 = st.tabs(["Patient Statistics", "Examination Analytics", "Financial Overview", "Clinical Trends"])
     
     with tab1:
@@ -925,98 +3158,59 @@ def clinical_analytics():
         col1, col2, col3, col4 = st.columns(4)
         
         with col1:
-            total_patients = pd.read_sql("SELECT COUNT(*) as count FROM patients", conn).iloc[0]['count']
-            st.metric("Total Patients", total_patients)
-        
+            st.metric("Total Patients", metrics.total_patients)
+
         with col2:
-            today_patients = pd.read_sql(
-                "SELECT COUNT(*) as count FROM patients WHERE DATE(created_date) = ?", 
-                conn, params=(date.today().strftime('%Y-%m-%d'),)
-            ).iloc[0]['count']
-            st.metric("New Today", today_patients)
-        
+            st.metric("New Today", metrics.new_patients_today)
+
         with col3:
-            male_patients = pd.read_sql(
-                "SELECT COUNT(*) as count FROM patients WHERE gender = 'Male'", 
-                conn
-            ).iloc[0]['count']
-            st.metric("Male Patients", male_patients)
-        
+            st.metric("Male Patients", metrics.male_patients)
+
         with col4:
-            female_patients = pd.read_sql(
-                "SELECT COUNT(*) as count FROM patients WHERE gender = 'Female'", 
-                conn
-            ).iloc[0]['count']
-            st.metric("Female Patients", female_patients)
-        
+            st.metric("Female Patients", metrics.female_patients)
+
         # Age distribution
         st.markdown("#### Age Distribution")
         try:
-            age_data = pd.read_sql('''
-                SELECT 
-                    CASE 
-                        WHEN (julianday('now') - julianday(date_of_birth))/365.25 < 18 THEN '0-17'
-                        WHEN (julianday('now') - julianday(date_of_birth))/365.25 BETWEEN 18 AND 35 THEN '18-35'
-                        WHEN (julianday('now') - julianday(date_of_birth))/365.25 BETWEEN 36 AND 55 THEN '36-55'
-                        WHEN (julianday('now') - julianday(date_of_birth))/365.25 BETWEEN 56 AND 75 THEN '56-75'
-                        ELSE '75+'
-                    END as age_group,
-                    COUNT(*) as count
-                FROM patients 
-                GROUP BY age_group
-                ORDER BY 
-                    CASE age_group
-                        WHEN '0-17' THEN 1
-                        WHEN '18-35' THEN 2
-                        WHEN '36-55' THEN 3
-                        WHEN '56-75' THEN 4
-                        ELSE 5
-                    END
-            ''', conn)
-            
-            if not age_data.empty:
-                st.bar_chart(age_data.set_index('age_group')['count'])
+            col_edges, col_group = st.columns(2)
+            with col_edges:
+                edges_text = st.text_input("Band edges (years)", ", ".join(map(str, AGE_BAND_EDGES)), key="age_band_edges",
+                                           help="First age of every band after the youngest, e.g. 18, 36, 56, 76")
+            with col_group:
+                groups = dict(rows("SELECT id, group_name FROM patient_groups ORDER BY group_name"))
+                group_id = st.selectbox("Patient group", [None] + list(groups), key="age_band_group",
+                                        format_func=lambda group: "All patients" if group is None else groups[group])
+            edges = [int(age) for age in re.findall(r"\d+", edges_text) if 0 < int(age) < 150] or list(AGE_BAND_EDGES)
+            age_data = cached(age_distribution, tuple(sorted(set(edges))), group_id)
+
+            if age_data.sum() > 0:
+                st.bar_chart(age_data.rename_axis('age_group').rename('count'))
             else:
                 st.info("No age data available.")
         except Exception as e:
             st.error(f"Error loading age distribution: {str(e)}")
-    
+
     with tab2:
         st.markdown("#### Examination Statistics")
         
         col1, col2, col3 = st.columns(3)
         
         with col1:
-            total_exams = pd.read_sql("SELECT COUNT(*) as count FROM refraction_exams", conn).iloc[0]['count']
-            st.metric("Total Refractions", total_exams)
-        
+            st.metric("Total Refractions", metrics.total_refractions)
+
         with col2:
-            today_exams = pd.read_sql(
-                "SELECT COUNT(*) as count FROM refraction_exams WHERE DATE(exam_date) = ?", 
-                conn, params=(date.today().strftime('%Y-%m-%d'),)
-            ).iloc[0]['count']
-            st.metric("Exams Today", today_exams)
-        
+            st.metric("Exams Today", metrics.refractions_today)
+
         with col3:
-            total_cl = pd.read_sql("SELECT COUNT(*) as count FROM contact_lens_prescriptions", conn).iloc[0]['count']
-            st.metric("Contact Lens Fittings", total_cl)
+            st.metric("Contact Lens Fittings", metrics.total_cl_fittings)
         
         # Exam types distribution
         st.markdown("#### Examination Types")
         try:
-            exam_types = pd.read_sql('''
-                SELECT 
-                    CASE 
-                        WHEN habitual_type IS NOT NULL THEN 'With Correction'
-                        ELSE 'Without Correction'
-                    END as exam_type,
-                    COUNT(*) as count
-                FROM refraction_exams 
-                GROUP BY exam_type
-            ''', conn)
-            
+            exam_types = cached(exam_type_counts)
+
             if not exam_types.empty:
-                st.bar_chart(exam_types.set_index('exam_type')['count'])
+                st.bar_chart(exam_types.rename_axis('exam_type').rename('count'))
         except Exception as e:
             st.error(f"Error loading exam types: {str(e)}")
     
@@ -1025,23 +3219,7 @@ def clinical_analytics():
         
         # Appointment revenue simulation
         try:
-            revenue_data = pd.read_sql('''
-                SELECT 
-                    DATE(appointment_date) as date,
-                    COUNT(*) as appointments,
-                    SUM(CASE 
-                        WHEN appointment_type = 'Routine Exam' THEN 100
-                        WHEN appointment_type = 'Contact Lens Fitting' THEN 150
-                        WHEN appointment_type = 'Follow-up' THEN 80
-                        WHEN appointment_type = 'Emergency' THEN 200
-                        WHEN appointment_type = 'Surgery Consultation' THEN 250
-                        ELSE 100
-                    END) as estimated_revenue
-                FROM appointments 
-                WHERE DATE(appointment_date) >= DATE('now', '-30 days')
-                GROUP BY DATE(appointment_date)
-                ORDER BY date
-            ''', conn)
+            revenue_data = cached(revenue_by_day, 30)
             
             if not revenue_data.empty:
                 col1, col2 = st.columns(2)
@@ -1060,36 +3238,95 @@ def clinical_analytics():
     with tab4:
         st.markdown("#### Clinical Trends")
         
-        # Common diagnoses/conditions (simulated)
-        st.markdown("##### Common Conditions (Last 30 Days)")
-        
-        conditions_data = {
-            'Condition': ['Myopia', 'Hyperopia', 'Astigmatism', 'Presbyopia', 'Cataract', 'Glaucoma', 'Dry Eye'],
-            'Cases': [45, 23, 38, 29, 12, 8, 31]
-        }
-        
-        conditions_df = pd.DataFrame(conditions_data)
-        st.bar_chart(conditions_df.set_index('Condition')['Cases'])
+        # Refractive conditions from each patient's latest final prescription
+        st.markdown("##### Common Conditions")
+        window = st.selectbox("Examined", list(CONDITION_WINDOWS), key="conditions_window")
+        try:
+            examined, conditions = cached(refractive_condition_counts, CONDITION_WINDOWS[window])
+            if examined:
+                st.caption(f"{examined} patient(s) with a final prescription; a patient can fall into several categories")
+                st.bar_chart(conditions.rename_axis('Condition').rename('Patients'))
+            else:
+                st.info("No final prescriptions recorded in this period.")
+        except Exception as e:
+            st.error(f"Error loading condition data: {str(e)}")
         
+        # Myopia progression review
+        st.markdown("##### Myopia Progression Review")
+        try:
+            followed, flagged, fast = cached(myopia_progression_review, 'final_distance')
+            st.caption(f"{flagged} patient(s) with a final-Rx myopic shift of "
+                       f"{-MYOPIA_PROGRESSION_RATE:.2f} D/year or more, out of {followed} "
+                       f"followed for at least {PROGRESSION_MIN_YEARS:g} years")
+            if not fast.empty:
+                st.dataframe(pd.DataFrame({
+                    'Patient ID': fast['patient'],
+                    'Name': fast['first_name'] + ' ' + fast['last_name'],
+                    'Eye': fast['eye'],
+                    'Exams': fast['exams'],
+                    'Years': fast['years'].round(1),
+                    'Latest M (D)': fast['latest_M'].round(2),
+                    'M (D/yr)': fast['M_rate'].round(2),
+                    'J0 (D/yr)': fast['J0_rate'].round(2),
+                    'J45 (D/yr)': fast['J45_rate'].round(2),
+                }), use_container_width=True, hide_index=True)
+        except Exception as e:
+            st.error(f"Error loading progression data: {str(e)}")
+
         # Contact lens types
         st.markdown("##### Contact Lens Types")
         try:
-            cl_types = pd.read_sql('''
-                SELECT lens_type, COUNT(*) as count 
-                FROM contact_lens_prescriptions 
-                GROUP BY lens_type
-            ''', conn)
-            
+            cl_types = cached(contact_lens_type_counts)
+
             if not cl_types.empty:
-                st.bar_chart(cl_types.set_index('lens_type')['count'])
+                st.bar_chart(cl_types.rename_axis('lens_type').rename('count'))
             else:
                 st.info("No contact lens data available.")
         except Exception as e:
             st.error(f"Error loading contact lens data: {str(e)}")
 
+    with status:
+        col_age, col_refresh = st.columns([4, 1])
+        with col_age:
+            if computed:
+                st.caption(f"Figures computed {_age_text(time.time() - min(computed))}; "
+                           f"refreshed in the background every {cache.ttl // 60} min")
+        with col_refresh:
+            if st.button("Refresh now", key="analytics_refresh", use_container_width=True):
+                cache.clear()
+                st.rerun()
+
 # -----------------------
 # VIEW PATIENT HISTORY - NOW FUNCTIONAL
 # -----------------------
+HISTORY_SECTIONS = ["Timeline", "Medical History", "Refraction History", "Anterior Segment", "Posterior Segment", "Contact Lenses"]
+HISTORY_PAGE_SIZE = 10  # records per section before "Load older records"
+
+def render_power_vector_trends(vectors):
+    """M / J0 / J45 over time per eye for one patient, with the change rates."""
+    stages = [stage for stage in POWER_VECTOR_STAGES if stage in set(vectors['stage'])]
+    stage = st.radio("Trend of", stages, index=len(stages) - 1, horizontal=True, key="trend_stage",
+                     format_func=POWER_VECTOR_STAGES.get)
+    df = vectors[vectors['stage'] == stage]
+
+    chart_m, chart_j = st.columns(2)
+    with chart_m:
+        st.caption("Spherical equivalent M (D)")
+        st.line_chart(df.pivot_table(index='exam_date', columns='eye', values='M'))
+    with chart_j:
+        st.caption("Astigmatism J0 / J45 (D)")
+        st.line_chart(df.pivot_table(index='exam_date', columns='eye', values=['J0', 'J45'])
+                      .pipe(lambda frame: frame.set_axis([f"{vector} {eye}" for vector, eye in frame.columns], axis=1)))
+
+    rates = progression_rates(df, by=['eye'])
+    if rates.empty:
+        st.caption(f"Change rates need at least {PROGRESSION_MIN_YEARS:g} years of follow-up.")
+    for _, rate in rates.iterrows():
+        cols = st.columns(3)
+        for col, name in zip(cols, POWER_VECTORS):
+            col.metric(f"{rate['eye']} {name} change", f"{rate[f'{name}_rate']:+.2f} D/yr",
+                       help=f"{rate['exams']} exams over {rate['years']:.1f} years")
+
 def view_patient_history():
     st.markdown("<h2 class='main-header'>Patient History</h2>", unsafe_allow_html=True)
     
@@ -1097,25 +3334,51 @@ def view_patient_history():
         st.error("No patient selected.")
         return
     
-    pid = st.session_state.selected_patient
+    patient_info = get_patient_context()
+    if patient_info is None:
+        st.error("Patient not found.")
+        return
+    pid = patient_info['id']
     
     try:
-        patient_info = pd.read_sql("SELECT * FROM patients WHERE patient_id = ?", conn, params=(pid,)).iloc[0]
         st.markdown(f"### Patient: {patient_info['first_name']} {patient_info['last_name']} (ID: {patient_info['patient_id']})")
         
-        # Create tabs for different history types
-        tab1, tab2, tab3, tab4, tab5 = st.tabs(["Medical History", "Refraction History", "Anterior Segment", "Posterior Segment", "Contact Lenses"])
-        
-        with tab1:
+        # Only the chosen section runs its query (st.tabs would run all five),
+        # and only its latest HISTORY_PAGE_SIZE records until more are asked for
+        section = st.radio("History", HISTORY_SECTIONS, horizontal=True, key="history_section",
+                           label_visibility="collapsed")
+        limits = st.session_state.setdefault('history_limits', {})
+        page_size = TIMELINE_PAGE_SIZE if section == "Timeline" else HISTORY_PAGE_SIZE
+        limit = limits.get((pid, section), page_size)
+
+        if section == "Timeline":
+            st.subheader("Timeline")
+            col_kinds, col_range = st.columns([2, 1])
+            with col_kinds:
+                kinds = st.multiselect("Show", list(TIMELINE_KINDS), default=list(TIMELINE_KINDS), key="timeline_kinds")
+            with col_range:
+                date_range = st.date_input("Between", value=(), key="timeline_range")
+            start, end = (tuple(date_range) + (None, None))[:2]
+            records = patient_timeline(pid, kinds, start, end, limit=limit + 1) if kinds else pd.DataFrame()
+
+            if not records.empty:
+                shown = records.head(limit)
+                st.dataframe(pd.DataFrame({
+                    'Date': shown['date'].map(lambda value: format_date_for_display(str(value)[:10])),
+                    'Type': shown['kind'],
+                    'Summary': shown['summary'],
+                }), use_container_width=True, hide_index=True)
+            else:
+                st.info("No records found for these filters.")
+
+        elif section == "Medical History":
             st.subheader("Medical History")
-            medical_history = pd.read_sql('''
-                SELECT * FROM medical_history 
-                WHERE patient_id = (SELECT id FROM patients WHERE patient_id = ?) 
-                ORDER BY visit_date DESC
-            ''', conn, params=(pid,))
-            
-            if not medical_history.empty:
-                for _, record in medical_history.iterrows():
+            records = load_patient_records('medical_history', pid, 'visit_date', limit=limit + 1,
+                                           columns=['visit_date', 'chief_complaint', 'general_health',
+                                                    'current_medications', 'allergies', 'ocular_history'])
+
+            if not records.empty:
+                for _, record in records.head(limit).iterrows():
                     with st.expander(f"Visit: {record['visit_date'][:10]}"):
                         st.write(f"**Chief Complaint:** {record.get('chief_complaint', 'N/A')}")
                         st.write(f"**General Health:** {record.get('general_health', 'N/A')}")
@@ -1124,26 +3387,25 @@ def view_patient_history():
                         st.write(f"**Ocular History:** {record.get('ocular_history', 'N/A')}")
             else:
                 st.info("No medical history records found.")
-        
-        with tab2:
+
+        elif section == "Refraction History":
             st.subheader("Refraction History")
-            refraction_history = pd.read_sql('''
-                SELECT * FROM refraction_exams 
-                WHERE patient_id = (SELECT id FROM patients WHERE patient_id = ?) 
-                ORDER BY exam_date DESC
-            ''', conn, params=(pid,))
-            
-            if not refraction_history.empty:
-                for _, record in refraction_history.iterrows():
+            vectors = patient_power_vectors(pid)
+            if not vectors.empty:
+                render_power_vector_trends(vectors)
+            records = load_refraction_history(pid, ['final_distance'], limit=limit + 1)
+
+            if not records.empty:
+                for _, record in records.head(limit).iterrows():
                     with st.expander(f"Exam: {record['exam_date'][:10]}"):
                         col1, col2 = st.columns(2)
-                        
+
                         with col1:
                             st.write("**OD:**")
                             st.write(f"Sphere: {record.get('final_prescribed_od_sphere', 'N/A')}")
                             st.write(f"Cylinder: {record.get('final_prescribed_od_cylinder', 'N/A')}")
                             st.write(f"Axis: {record.get('final_prescribed_od_axis', 'N/A')}")
-                        
+
                         with col2:
                             st.write("**OS:**")
                             st.write(f"Sphere: {record.get('final_prescribed_os_sphere', 'N/A')}")
@@ -1151,17 +3413,15 @@ def view_patient_history():
                             st.write(f"Axis: {record.get('final_prescribed_os_axis', 'N/A')}")
             else:
                 st.info("No refraction records found.")
-        
-        with tab3:
+
+        elif section == "Anterior Segment":
             st.subheader("Anterior Segment History")
-            anterior_history = pd.read_sql('''
-                SELECT * FROM anterior_segment_exams 
-                WHERE patient_id = (SELECT id FROM patients WHERE patient_id = ?) 
-                ORDER BY exam_date DESC
-            ''', conn, params=(pid,))
-            
-            if not anterior_history.empty:
-                for _, record in anterior_history.iterrows():
+            records = load_patient_records('anterior_segment_exams', pid, 'exam_date', limit=limit + 1,
+                                           columns=['exam_date', 'tonometry_od', 'tonometry_os', 'pachymetry_od',
+                                                    'pachymetry_os', 'biomicroscopy_od', 'biomicroscopy_os'])
+
+            if not records.empty:
+                for _, record in records.head(limit).iterrows():
                     with st.expander(f"Exam: {record['exam_date'][:10]}"):
                         st.write(f"**IOP OD:** {record.get('tonometry_od', 'N/A')} mmHg")
                         st.write(f"**IOP OS:** {record.get('tonometry_os', 'N/A')} mmHg")
@@ -1171,17 +3431,14 @@ def view_patient_history():
                         st.write(f"**Biomicroscopy OS:** {record.get('biomicroscopy_os', 'N/A')}")
             else:
                 st.info("No anterior segment records found.")
-        
-        with tab4:
+
+        elif section == "Posterior Segment":
             st.subheader("Posterior Segment History")
-            posterior_history = pd.read_sql('''
-                SELECT * FROM posterior_segment_exams 
-                WHERE patient_id = (SELECT id FROM patients WHERE patient_id = ?) 
-                ORDER BY exam_date DESC
-            ''', conn, params=(pid,))
-            
-            if not posterior_history.empty:
-                for _, record in posterior_history.iterrows():
+            records = load_patient_records('posterior_segment_exams', pid, 'exam_date', limit=limit + 1,
+                                           columns=['exam_date', 'fundus_od', 'fundus_os', 'oct_macula_od', 'oct_macula_os'])
+
+            if not records.empty:
+                for _, record in records.head(limit).iterrows():
                     with st.expander(f"Exam: {record['exam_date'][:10]}"):
                         st.write(f"**Fundus OD:** {record.get('fundus_od', 'N/A')}")
                         st.write(f"**Fundus OS:** {record.get('fundus_os', 'N/A')}")
@@ -1189,24 +3446,29 @@ def view_patient_history():
                         st.write(f"**OCT Macula OS:** {record.get('oct_macula_os', 'N/A')}")
             else:
                 st.info("No posterior segment records found.")
-        
-        with tab5:
+
+        else:
             st.subheader("Contact Lens History")
-            cl_history = pd.read_sql('''
-                SELECT * FROM contact_lens_prescriptions 
-                WHERE patient_id = (SELECT id FROM patients WHERE patient_id = ?) 
-                ORDER BY prescription_date DESC
-            ''', conn, params=(pid,))
-            
-            if not cl_history.empty:
-                for _, record in cl_history.iterrows():
+            records = load_patient_records('contact_lens_prescriptions', pid, 'prescription_date', limit=limit + 1,
+                                           columns=['prescription_date', 'lens_type', 'soft_brand', 'rgp_brand',
+                                                    'scleral_brand', 'professional_assessment'])
+
+            if not records.empty:
+                for _, record in records.head(limit).iterrows():
                     with st.expander(f"Prescription: {record['prescription_date'][:10]}"):
                         st.write(f"**Lens Type:** {record.get('lens_type', 'N/A')}")
                         st.write(f"**Brand:** {record.get('soft_brand', record.get('rgp_brand', record.get('scleral_brand', 'N/A')))}")
                         st.write(f"**Professional Assessment:** {record.get('professional_assessment', 'N/A')}")
             else:
                 st.info("No contact lens records found.")
-                
+
+        if len(records) > limit:
+            if st.button("Load older records", key=f"history_more_{section}"):
+                limits[(pid, section)] = limit + page_size
+                st.rerun()
+        elif len(records) > page_size:
+            st.caption(f"All {len(records)} records shown.")
+
     except Exception as e:
         st.error(f"Error loading patient history: {str(e)}")
 
@@ -1239,22 +3501,22 @@ def show_dashboard():
             st.rerun()
 
     # Stats
-    total_patients, today_exams, total_cl = get_patient_stats()
+    metrics = clinic_metrics()
     col_metrics = st.columns(3)
     with col_metrics[0]:
-        st.markdown(f"<div class='metric-card'><div style='font-size:24px'>{total_patients}</div><div>Registered Patients</div></div>", unsafe_allow_html=True)
+        st.markdown(f"<div class='metric-card'><div style='font-size:24px'>{metrics.total_patients}</div><div>Registered Patients</div></div>", unsafe_allow_html=True)
     with col_metrics[1]:
-        st.markdown(f"<div class='metric-card'><div style='font-size:24px'>{today_exams}</div><div>Today's Appointments</div></div>", unsafe_allow_html=True)
+        st.markdown(f"<div class='metric-card'><div style='font-size:24px'>{metrics.appointments_today}</div><div>Today's Appointments</div></div>", unsafe_allow_html=True)
     with col_metrics[2]:
-        st.markdown(f"<div class='metric-card'><div style='font-size:24px'>{total_cl}</div><div>Contact Lens Fittings</div></div>", unsafe_allow_html=True)
+        st.markdown(f"<div class='metric-card'><div style='font-size:24px'>{metrics.total_cl_fittings}</div><div>Contact Lens Fittings</div></div>", unsafe_allow_html=True)
 
     col_main = st.columns([2, 1])
     
     with col_main[0]:
         st.subheader("Today's Clinical Schedule")
         appts = get_todays_appointments()
-        if not appts.empty:
-            for idx, apt in appts.iterrows():
+        if appts:
+            for apt in appts:
                 with st.container():
                     col_a, col_b, col_c = st.columns([3, 1, 1])
                     with col_a:
@@ -1278,8 +3540,8 @@ def show_dashboard():
         # Recent Patients Section
         st.subheader("Recent Patients")
         recent_patients = get_recent_patients(5)
-        if not recent_patients.empty:
-            for _, patient in recent_patients.iterrows():
+        if recent_patients:
+            for patient in recent_patients:
                 col_pat1, col_pat2, col_pat3 = st.columns([3, 1, 1])
                 with col_pat1:
                     st.write(f"**{patient['first_name']} {patient['last_name']}** ({patient['patient_id']})")
@@ -1353,8 +3615,8 @@ def show_dashboard():
         # Upcoming Appointments
         st.subheader("Upcoming Appointments")
         upcoming = get_upcoming_appointments(3)
-        if not upcoming.empty:
-            for _, apt in upcoming.iterrows():
+        if upcoming:
+            for apt in upcoming:
                 apt_time = pd.to_datetime(apt['appointment_date']).strftime('%d.%m.%Y %H:%M')
                 st.write(f"**{apt_time}**")
                 st.caption(f"{apt['first_name']} {apt['last_name']} - {apt['appointment_type']}")
@@ -1370,13 +3632,11 @@ def medical_history():
         st.error("No patient selected.")
         return
     
-    pid = st.session_state.selected_patient
-    try:
-        pinfo = pd.read_sql("SELECT * FROM patients WHERE patient_id = ?", conn, params=(pid,)).iloc[0]
-        st.markdown(f"### Patient: {pinfo['first_name']} {pinfo['last_name']} (ID: {pinfo['patient_id']})")
-    except Exception:
+    pinfo = get_patient_context()
+    if pinfo is None:
         st.error("Patient not found.")
         return
+    st.markdown(f"### Patient: {pinfo['first_name']} {pinfo['last_name']} (ID: {pinfo['patient_id']})")
     
     with st.form("mh_form"):
         col1, col2 = st.columns(2)
@@ -1426,25 +3686,20 @@ def medical_history():
         
         if submit_button:
             try:
-                files = []
-                if uploaded:
-                    os.makedirs("uploads", exist_ok=True)
-                    for f in uploaded:
-                        safe_name = "".join(c for c in f.name if c.isalnum() or c in "._- ")
-                        path = os.path.join("uploads", f"{datetime.now().timestamp()}_{safe_name}")
-                        with open(path, "wb") as fp:
-                            fp.write(f.getbuffer())
-                        files.append(path)
+                stored_files = store_uploads(uploaded)
                 
-                c = conn.cursor()
+                c = get_conn().cursor()
                 c.execute('''
                     INSERT INTO medical_history
                     (patient_id, chief_complaint, general_health, current_medications, allergies, headaches_history, family_history,
                      ocular_history, previous_surgeries, last_eye_exam, smoking_status, alcohol_consumption, occupation, hobbies, uploaded_reports)
                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                 ''', (pinfo['id'], chief_complaint, general_health, current_medications, allergies, headaches, family_history, 
-                     ocular_history, previous_surgeries, last_eye_exam, smoking, alcohol, occupation, hobbies, json.dumps(files)))
-                conn.commit()
+                     ocular_history, previous_surgeries, last_eye_exam, smoking, alcohol, occupation, hobbies, json.dumps([f['path'] for f in stored_files])))
+                attachment_ids = link_attachments(c, 'medical_history', c.lastrowid, stored_files)
+                get_conn().commit()
+                invalidate_records('medical_history')
+                process_attachments(attachment_ids)
                 st.success("Medical history saved successfully!")
                 st.session_state.exam_step = "refraction"
                 st.rerun()
@@ -1461,13 +3716,11 @@ def refraction_examination():
         st.error("No patient selected.")
         return
     
-    pid_code = st.session_state.selected_patient
-    try:
-        pinfo = pd.read_sql("SELECT * FROM patients WHERE patient_id = ?", conn, params=(pid_code,)).iloc[0]
-        st.markdown(f"### Patient: {pinfo['first_name']} {pinfo['last_name']} (ID: {pinfo['patient_id']})")
-    except Exception:
+    pinfo = get_patient_context()
+    if pinfo is None:
         st.error("Patient not found.")
         return
+    st.markdown(f"### Patient: {pinfo['first_name']} {pinfo['last_name']} (ID: {pinfo['patient_id']})")
 
     if 'refraction' not in st.session_state:
         st.session_state.refraction = {}
@@ -2079,318 +4332,50 @@ def refraction_examination():
 
         if submit_final:
             try:
-                p = pd.read_sql("SELECT id FROM patients WHERE patient_id = ?", conn, params=(pid_code,)).iloc[0]
-                pid = p['id']
-
-                c = conn.cursor()
-
-                # INSERT with updated columns: new ADD fields for distance, DEG fields for near, single bvp below color vision
-                c.execute('''
-                    INSERT INTO refraction_exams (
-                        id,
-                        patient_id,
-                        exam_date,
-                        habitual_type,
-                        habitual_od_va,
-                        habitual_od_modifier,
-                        habitual_os_va,
-                        habitual_os_modifier,
-                        habitual_binocular_va,
-                        habitual_binocular_modifier,
-                        habitual_pd,
-                        habitual_add_od,
-                        habitual_add_os,
-                        habitual_deg_od,
-                        habitual_deg_os,
-                        vision_notes,
-                        uncorrected_od_va,
-                        uncorrected_od_modifier,
-                        uncorrected_os_va,
-                        uncorrected_os_modifier,
-                        uncorrected_binocular_va,
-                        uncorrected_binocular_modifier,
-                        objective_method,
-                        objective_time,
-                        autorefractor_od_sphere,
-                        autorefractor_od_cylinder,
-                        autorefractor_od_axis,
-                        autorefractor_os_sphere,
-                        autorefractor_os_cylinder,
-                        autorefractor_os_axis,
-                        objective_notes,
-                        cycloplegic_used,
-                        cycloplegic_agent,
-                        cycloplegic_lot,
-                        cycloplegic_expiry,
-                        cycloplegic_drops,
-                        subjective_method,
-                        subjective_od_sphere,
-                        subjective_od_cylinder,
-                        subjective_od_axis,
-                        subjective_od_va,
-                        subjective_od_modifier,
-                        subjective_add_od,
-                        subjective_deg_od,
-                        subjective_os_sphere,
-                        subjective_os_cylinder,
-                        subjective_os_axis,
-                        subjective_os_va,
-                        subjective_os_modifier,
-                        subjective_add_os,
-                        subjective_deg_os,
-                        subjective_distance,
-                        subjective_deg_distance,
-                        subjective_notes,
-                        binocular_balance,
-                        stereopsis,
-                        near_point_convergence_break,
-                        near_point_convergence_recovery,
-                        final_prescribed_od_sphere,
-                        final_prescribed_od_cylinder,
-                        final_prescribed_od_axis,
-                        final_prescribed_os_sphere,
-                        final_prescribed_os_cylinder,
-                        final_prescribed_os_axis,
-                        final_prescribed_binocular_va,
-                        final_prescribed_binocular_modifier,
-                        final_add_od,
-                        final_add_os,
-                        final_deg_od,
-                        final_deg_os,
-                        final_deg_distance,
-                        bvp,
-                        pinhole,
-                        prescription_notes,
-                        binocular_tests,
-                        functional_tests,
-                        accommodation_tests,
-                        uploaded_files,
-
-                        habitual_distance_od_sphere,
-                        habitual_distance_od_cylinder,
-                        habitual_distance_od_axis,
-                        habitual_distance_os_sphere,
-                        habitual_distance_os_cylinder,
-                        habitual_distance_os_axis,
-                        habitual_near_od_sphere,
-                        habitual_near_od_cylinder,
-                        habitual_near_od_axis,
-                        habitual_near_os_sphere,
-                        habitual_near_os_cylinder,
-                        habitual_near_os_axis,
-                        habitual_distance_od_prism,
-                        habitual_distance_od_base,
-                        habitual_distance_os_prism,
-                        habitual_distance_os_base,
-                        habitual_near_od_prism,
-                        habitual_near_od_base,
-                        habitual_near_os_prism,
-                        habitual_near_os_base,
-
-                        subjective_binocular_distance_od_sphere,
-                        subjective_binocular_distance_od_cylinder,
-                        subjective_binocular_distance_od_axis,
-                        subjective_binocular_distance_os_sphere,
-                        subjective_binocular_distance_os_cylinder,
-                        subjective_binocular_distance_os_axis,
-                        subjective_binocular_near_od_sphere,
-                        subjective_binocular_near_od_cylinder,
-                        subjective_binocular_near_od_axis,
-                        subjective_binocular_near_os_sphere,
-                        subjective_binocular_near_os_cylinder,
-                        subjective_binocular_near_os_axis,
-                        subjective_binocular_distance_od_prism,
-                        subjective_binocular_distance_od_base,
-                        subjective_binocular_distance_os_prism,
-                        subjective_binocular_distance_os_base,
-                        subjective_binocular_near_od_prism,
-                        subjective_binocular_near_od_base,
-                        subjective_binocular_near_os_prism,
-                        subjective_binocular_near_os_base,
-
-                        final_distance_od_prism,
-                        final_distance_od_base,
-                        final_distance_os_prism,
-                        final_distance_os_base,
-                        final_near_od_prism,
-                        final_near_od_base,
-                        final_near_os_prism,
-                        final_near_os_base,
-                        color_vision,
-
-                        subjective_binocular_vision,
-                        subjective_binocular_notes,
-                        cycloplegic_type,
-                        final_deg_near,
-
-                        final_near_deg_od,
-                        final_near_deg_os,
-
-                        final_near_od_sphere,
-                        final_near_od_cylinder,
-                        final_near_od_axis,
-                        final_near_od_va,
-
-                        final_near_os_sphere,
-                        final_near_os_cylinder,
-                        final_near_os_axis,
-                        final_near_os_va
-                    )
-                    VALUES (
-                        NULL, ?, CURRENT_TIMESTAMP,
-                        ?,?,?,?,?,?,?,?,?,?,?,?,?,?,
-                        ?,?,?,?,?,?,?,?,?,?,?,?,?,?,
-                        ?,?,?,?,?,?,?,?,?,?,?,?,?,?,
-                        ?,?,?,?,?,?,?,?,?,?,?,?,?,?,
-                        ?,?,?,?,?,?,?,?,?,?,?,?,?,?,
-                        ?,?,?,?,?,?,?,?,?,?,?,?,?,?,
-                        ?,?,?,?,?,?,?,?,?,?,?,?,?,?,
-                        ?,?,?,?,?,?,?,?,?,?,?,?,?,?,
-                        ?,?,?,?,?,?,?,?,?,?,?,?,?,?,
-                        ?,?,?,?,?,?,?,?,?,?,?,?,?,?,
-                        ?,?,?,?,?,?,?,?
-                    )
-                ''',
-                (
-                    pid,
-                    st.session_state.refraction.get('habitual_type'),
-                    st.session_state.refraction.get('habitual_od_va'),
-                    st.session_state.refraction.get('habitual_od_modifier'),
-                    st.session_state.refraction.get('habitual_os_va'),
-                    st.session_state.refraction.get('habitual_os_modifier'),
-                    st.session_state.refraction.get('habitual_binocular_va'),
-                    st.session_state.refraction.get('habitual_binocular_modifier'),
-                    st.session_state.refraction.get('habitual_pd'),
-                    st.session_state.refraction.get('habitual_add_od'),
-                    st.session_state.refraction.get('habitual_add_os'),
-                    st.session_state.refraction.get('habitual_deg_od'),
-                    st.session_state.refraction.get('habitual_deg_os'),
-                    st.session_state.refraction.get('vision_notes'),
-                    st.session_state.refraction.get('uncorrected_od_va'),
-                    st.session_state.refraction.get('uncorrected_od_modifier'),
-                    st.session_state.refraction.get('uncorrected_os_va'),
-                    st.session_state.refraction.get('uncorrected_os_modifier'),
-                    st.session_state.refraction.get('uncorrected_binocular_va'),
-                    st.session_state.refraction.get('uncorrected_binocular_modifier'),
-                    st.session_state.refraction.get('objective_method'),
-                    st.session_state.refraction.get('objective_time'),
-                    st.session_state.refraction.get('autorefractor_od_sphere'),
-                    st.session_state.refraction.get('autorefractor_od_cylinder'),
-                    st.session_state.refraction.get('autorefractor_od_axis'),
-                    st.session_state.refraction.get('autorefractor_os_sphere'),
-                    st.session_state.refraction.get('autorefractor_os_cylinder'),
-                    st.session_state.refraction.get('autorefractor_os_axis'),
-                    st.session_state.refraction.get('objective_notes'),
-                    st.session_state.refraction.get('cycloplegic_used'),
-                    st.session_state.refraction.get('cycloplegic_agent'),
-                    st.session_state.refraction.get('cycloplegic_lot'),
-                    st.session_state.refraction.get('cycloplegic_expiry'),
-                    st.session_state.refraction.get('cycloplegic_drops'),
-                    st.session_state.refraction.get('subjective_method'),
-                    st.session_state.refraction.get('subjective_od_sphere'),
-                    st.session_state.refraction.get('subjective_od_cylinder'),
-                    st.session_state.refraction.get('subjective_od_axis'),
-                    st.session_state.refraction.get('subjective_od_va'),
-                    st.session_state.refraction.get('subjective_od_modifier'),
-                    st.session_state.refraction.get('subjective_add_od'),
-                    st.session_state.refraction.get('subjective_deg_od'),
-                    st.session_state.refraction.get('subjective_os_sphere'),
-                    st.session_state.refraction.get('subjective_os_cylinder'),
-                    st.session_state.refraction.get('subjective_os_axis'),
-                    st.session_state.refraction.get('subjective_os_va'),
-                    st.session_state.refraction.get('subjective_os_modifier'),
-                    st.session_state.refraction.get('subjective_add_os'),
-                    st.session_state.refraction.get('subjective_deg_os'),
-                    st.session_state.refraction.get('subjective_distance'),
-                    st.session_state.refraction.get('subjective_deg_distance'),
-                    st.session_state.refraction.get('subjective_notes'),
-                    binocular_balance, stereopsis, npc_break, npc_recovery,
-
-                    final_od_sph, final_od_cyl, final_od_axis,
-                    final_os_sph, final_os_cyl, final_os_axis,
-                    final_bin_va, None,
-
-                    final_add_od, final_add_os,
-                    st.session_state.refraction.get('final_deg_od'),
-                    st.session_state.refraction.get('final_deg_os'),
-                    final_deg_distance,
-
-                    bvp,
-                    None,
-                    prescription_notes,
-                    None,
-                    None,
-                    None,
-                    None,
-
-                    st.session_state.refraction.get('habitual_distance_od_sphere'),
-                    st.session_state.refraction.get('habitual_distance_od_cylinder'),
-                    st.session_state.refraction.get('habitual_distance_od_axis'),
-                    st.session_state.refraction.get('habitual_distance_os_sphere'),
-                    st.session_state.refraction.get('habitual_distance_os_cylinder'),
-                    st.session_state.refraction.get('habitual_distance_os_axis'),
-                    st.session_state.refraction.get('habitual_near_od_sphere'),
-                    st.session_state.refraction.get('habitual_near_od_cylinder'),
-                    st.session_state.refraction.get('habitual_near_od_axis'),
-                    st.session_state.refraction.get('habitual_near_os_sphere'),
-                    st.session_state.refraction.get('habitual_near_os_cylinder'),
-                    st.session_state.refraction.get('habitual_near_os_axis'),
-                    st.session_state.refraction.get('habitual_distance_od_prism'),
-                    st.session_state.refraction.get('habitual_distance_od_base'),
-                    st.session_state.refraction.get('habitual_distance_os_prism'),
-                    st.session_state.refraction.get('habitual_distance_os_base'),
-                    st.session_state.refraction.get('habitual_near_od_prism'),
-                    st.session_state.refraction.get('habitual_near_od_base'),
-                    st.session_state.refraction.get('habitual_near_os_prism'),
-                    st.session_state.refraction.get('habitual_near_os_base'),
-
-                    st.session_state.refraction.get('subjective_binocular_distance_od_sphere'),
-                    st.session_state.refraction.get('subjective_binocular_distance_od_cylinder'),
-                    st.session_state.refraction.get('subjective_binocular_distance_od_axis'),
-                    st.session_state.refraction.get('subjective_binocular_distance_os_sphere'),
-                    st.session_state.refraction.get('subjective_binocular_distance_os_cylinder'),
-                    st.session_state.refraction.get('subjective_binocular_distance_os_axis'),
-                    st.session_state.refraction.get('subjective_binocular_near_od_sphere'),
-                    st.session_state.refraction.get('subjective_binocular_near_od_cylinder'),
-                    st.session_state.refraction.get('subjective_binocular_near_od_axis'),
-                    st.session_state.refraction.get('subjective_binocular_near_os_sphere'),
-                    st.session_state.refraction.get('subjective_binocular_near_os_cylinder'),
-                    st.session_state.refraction.get('subjective_binocular_near_os_axis'),
-                    st.session_state.refraction.get('subjective_binocular_distance_od_prism'),
-                    st.session_state.refraction.get('subjective_binocular_distance_od_base'),
-                    st.session_state.refraction.get('subjective_binocular_distance_os_prism'),
-                    st.session_state.refraction.get('subjective_binocular_distance_os_base'),
-                    st.session_state.refraction.get('subjective_binocular_near_od_prism'),
-                    st.session_state.refraction.get('subjective_binocular_near_od_base'),
-                    st.session_state.refraction.get('subjective_binocular_near_os_prism'),
-                    st.session_state.refraction.get('subjective_binocular_near_os_base'),
-
-                    final_dist_od_prism, final_dist_od_base,
-                    final_dist_os_prism, final_dist_os_base,
-                    final_near_od_prism, final_near_od_base,
-                    final_near_os_prism, final_near_os_base,
-
-                    color_vision,
-                    st.session_state.refraction.get('subjective_binocular_vision'),
-                    st.session_state.refraction.get('subjective_binocular_notes'),
-                    st.session_state.refraction.get('cycloplegic_type'),
-                    None,
-
-                    final_near_deg_od,
-                    final_near_deg_os,
-
-                    final_near_od_sph,
-                    final_near_od_cyl,
-                    final_near_od_axis,
-                    final_near_od_va,
-
-                    final_near_os_sph,
-                    final_near_os_cyl,
-                    final_near_os_axis,
-                    final_near_os_va
-                ))
-                ))
-                conn.commit()
+                # Values saved by the earlier refraction forms plus the final prescription form
+                record = dict(st.session_state.refraction)
+                record.update({
+                    'binocular_balance': binocular_balance,
+                    'stereopsis': stereopsis,
+                    'near_point_convergence_break': npc_break,
+                    'near_point_convergence_recovery': npc_recovery,
+                    'final_prescribed_od_sphere': final_od_sph,
+                    'final_prescribed_od_cylinder': final_od_cyl,
+                    'final_prescribed_od_axis': final_od_axis,
+                    'final_prescribed_os_sphere': final_os_sph,
+                    'final_prescribed_os_cylinder': final_os_cyl,
+                    'final_prescribed_os_axis': final_os_axis,
+                    'final_prescribed_binocular_va': final_bin_va,
+                    'final_add_od': final_add_od,
+                    'final_add_os': final_add_os,
+                    'final_deg_distance': final_deg_distance,
+                    'bvp': bvp,
+                    'prescription_notes': prescription_notes,
+                    'final_distance_od_prism': final_dist_od_prism,
+                    'final_distance_od_base': final_dist_od_base,
+                    'final_distance_os_prism': final_dist_os_prism,
+                    'final_distance_os_base': final_dist_os_base,
+                    'final_near_od_prism': final_near_od_prism,
+                    'final_near_od_base': final_near_od_base,
+                    'final_near_os_prism': final_near_os_prism,
+                    'final_near_os_base': final_near_os_base,
+                    'color_vision': color_vision,
+                    'final_near_deg_od': final_near_deg_od,
+                    'final_near_deg_os': final_near_deg_os,
+                    'final_near_od_sphere': final_near_od_sph,
+                    'final_near_od_cylinder': final_near_od_cyl,
+                    'final_near_od_axis': final_near_od_axis,
+                    'final_near_od_va': final_near_od_va,
+                    'final_near_os_sphere': final_near_os_sph,
+                    'final_near_os_cylinder': final_near_os_cyl,
+                    'final_near_os_axis': final_near_os_axis,
+                    'final_near_os_va': final_near_os_va
+                })
+
+                c = get_conn().cursor()
+                save_refraction_exam(c, pinfo['id'], record)
+                get_conn().commit()
+                invalidate_records('refraction_exams')
                 st.success("Refraction examination saved successfully!")
                 st.session_state.refraction = {}
                 st.session_state.exam_step = "functional_tests"
@@ -2405,7 +4390,10 @@ def functional_tests():
         st.error("No patient selected.")
         return
     
-    pid = st.session_state.selected_patient
+    pinfo = get_patient_context()
+    if pinfo is None:
+        st.error("Patient not found.")
+        return
     
     # Navigation
     col_nav = st.columns(3)
@@ -2457,14 +4445,14 @@ def functional_tests():
         
         if submit_functional:
             try:
-                p = pd.read_sql("SELECT id FROM patients WHERE patient_id = ?", conn, params=(pid,)).iloc[0]
-                c = conn.cursor()
+                c = get_conn().cursor()
                 c.execute('''
                     INSERT INTO functional_tests 
                     (patient_id, motility, hirschberg, cover_test_distance, cover_test_near, pupils, rapd, confrontation_fields, near_point_convergence_break, near_point_convergence_recovery, near_point_accommodation, color_vision, other_notes)
                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (p['id'], motility, hirschberg, cover_distance, cover_near, pupils, rapd, confrontation, npc_break, npc_recovery, npa, color_vision, other_notes))
-                conn.commit()
+                ''', (pinfo['id'], motility, hirschberg, cover_distance, cover_near, pupils, rapd, confrontation, npc_break, npc_recovery, npa, color_vision, other_notes))
+                get_conn().commit()
+                invalidate_records('functional_tests')
                 st.success("Functional tests saved successfully!")
                 st.session_state.exam_step = "anterior_segment"
                 st.rerun()
@@ -2489,7 +4477,10 @@ def anterior_segment_examination():
         st.error("No patient selected.")
         return
     
-    pid = st.session_state.selected_patient
+    pinfo = get_patient_context()
+    if pinfo is None:
+        st.error("Patient not found.")
+        return
     
     # Navigation
     col_nav = st.columns(3)
@@ -2569,19 +4560,9 @@ def anterior_segment_examination():
         
         if submit_anterior:
             try:
-                p = pd.read_sql("SELECT id FROM patients WHERE patient_id = ?", conn, params=(pid,)).iloc[0]
-                
-                file_paths = []
-                if uploaded_files:
-                    os.makedirs("uploads", exist_ok=True)
-                    for f in uploaded_files:
-                        safe_name = "".join(c for c in f.name if c.isalnum() or c in "._- ")
-                        path = os.path.join("uploads", f"{datetime.now().timestamp()}_{safe_name}")
-                        with open(path, "wb") as fp:
-                            fp.write(f.getbuffer())
-                        file_paths.append(path)
+                stored_files = store_uploads(uploaded_files)
                 
-                c = conn.cursor()
+                c = get_conn().cursor()
                 c.execute('''
                     INSERT INTO anterior_segment_exams 
                     (patient_id, biomicroscopy_od, biomicroscopy_os, biomicroscopy_notes,
@@ -2590,11 +4571,14 @@ def anterior_segment_examination():
                      tonometry_type, tonometry_time, tonometry_compensation, tonometry_od, tonometry_os,
                      pupillography_results, pupillography_notes, uploaded_files)
                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (p['id'], biomicroscopy_od, biomicroscopy_os, biomicroscopy_notes,
+                ''', (pinfo['id'], biomicroscopy_od, biomicroscopy_os, biomicroscopy_notes,
                      ac_depth_od, ac_depth_os, ac_volume_od, ac_volume_os, angle_od, angle_os, pachymetry_od, pachymetry_os,
                      tonometry_type, tonometry_time.strftime("%H:%M"), tonometry_compensation, iop_od, iop_os, 
-                     pupillography_results, pupillography_notes, json.dumps(file_paths)))
-                conn.commit()
+                     pupillography_results, pupillography_notes, json.dumps([f['path'] for f in stored_files])))
+                attachment_ids = link_attachments(c, 'anterior_segment_exams', c.lastrowid, stored_files)
+                get_conn().commit()
+                invalidate_records('anterior_segment_exams')
+                process_attachments(attachment_ids)
                 st.success("Anterior segment examination saved successfully!")
                 st.session_state.exam_step = "posterior_segment"
                 st.rerun()
@@ -2615,7 +4599,10 @@ def posterior_segment_examination():
         st.error("No patient selected.")
         return
     
-    pid = st.session_state.selected_patient
+    pinfo = get_patient_context()
+    if pinfo is None:
+        st.error("Patient not found.")
+        return
     
     # Navigation
     col_nav = st.columns(3)
@@ -2686,29 +4673,22 @@ def posterior_segment_examination():
         
         if submit_posterior:
             try:
-                p = pd.read_sql("SELECT id FROM patients WHERE patient_id = ?", conn, params=(pid,)).iloc[0]
-                
-                file_paths = []
-                if uploaded_files:
-                    os.makedirs("uploads", exist_ok=True)
-                    for f in uploaded_files:
-                        safe_name = "".join(c for c in f.name if c.isalnum() or c in "._- ")
-                        path = os.path.join("uploads", f"{datetime.now().timestamp()}_{safe_name}")
-                        with open(path, "wb") as fp:
-                            fp.write(f.getbuffer())
-                        file_paths.append(path)
+                stored_files = store_uploads(uploaded_files)
                 
-                c = conn.cursor()
+                c = get_conn().cursor()
                 c.execute('''
                     INSERT INTO posterior_segment_exams 
                     (patient_id, fundus_exam_type, fundus_od, fundus_os, fundus_notes,
                      oct_macula_od, oct_macula_os, oct_rnfl_od, oct_rnfl_os, oct_notes, 
                      ophthalmoscopy_od, ophthalmoscopy_os, uploaded_files)
                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (p['id'], fundus_type, fundus_od, fundus_os, fundus_notes,
+                ''', (pinfo['id'], fundus_type, fundus_od, fundus_os, fundus_notes,
                      oct_macula_od, oct_macula_os, oct_rnfl_od, oct_rnfl_os, oct_notes,
-                     ophthalmoscopy_od, ophthalmoscopy_os, json.dumps(file_paths)))
-                conn.commit()
+                     ophthalmoscopy_od, ophthalmoscopy_os, json.dumps([f['path'] for f in stored_files])))
+                attachment_ids = link_attachments(c, 'posterior_segment_exams', c.lastrowid, stored_files)
+                get_conn().commit()
+                invalidate_records('posterior_segment_exams')
+                process_attachments(attachment_ids)
                 st.success("Posterior segment examination saved successfully!")
                 st.session_state.exam_step = "contact_lenses"
                 st.rerun()
@@ -2729,14 +4709,11 @@ def contact_lenses():
         st.info("Please select a patient first from Patient Search or Dashboard.")
         return
     
-    pid = st.session_state.selected_patient
-    
-    try:
-        pinfo = pd.read_sql("SELECT * FROM patients WHERE patient_id = ?", conn, params=(pid,)).iloc[0]
-        st.markdown(f"### Patient: {pinfo['first_name']} {pinfo['last_name']} (ID: {pinfo['patient_id']})")
-    except Exception:
+    pinfo = get_patient_context()
+    if pinfo is None:
         st.error("Patient not found.")
         return
+    st.markdown(f"### Patient: {pinfo['first_name']} {pinfo['last_name']} (ID: {pinfo['patient_id']})")
 
     # Navigation
     col_nav = st.columns(3)
@@ -2864,19 +4841,9 @@ def contact_lenses():
         
         if submit_cl:
             try:
-                p = pd.read_sql("SELECT id FROM patients WHERE patient_id = ?", conn, params=(pid,)).iloc[0]
+                stored_files = store_uploads(fitting_images)
                 
-                file_paths = []
-                if fitting_images:
-                    os.makedirs("uploads", exist_ok=True)
-                    for f in fitting_images:
-                        safe_name = "".join(c for c in f.name if c.isalnum() or c in "._- ")
-                        path = os.path.join("uploads", f"{datetime.now().timestamp()}_{safe_name}")
-                        with open(path, "wb") as fp:
-                            fp.write(f.getbuffer())
-                        file_paths.append(path)
-                
-                c = conn.cursor()
+                c = get_conn().cursor()
                 
                 # Unified insert for all lens types with correct number of parameters
                 c.execute('''
@@ -2896,7 +4863,7 @@ def contact_lenses():
                      wearing_schedule, care_solution, follow_up_date, fitting_notes,
                      professional_assessment, patient_feedback, fitting_images)
                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (p['id'], lens_type, lens_design, lens_material, lens_color,
+                ''', (pinfo['id'], lens_type, lens_design, lens_material, lens_color,
                      soft_brand if lens_type == "Soft" else None,
                      soft_base_curve if lens_type == "Soft" else None,
                      soft_diameter if lens_type == "Soft" else None,
@@ -2918,9 +4885,12 @@ def contact_lenses():
                      ortho_k_landing_zone if lens_type == "Ortho-K" else None,
                      special_lens_parameters if lens_type in ["Custom", "Hybrid", "Other"] else None,
                      wearing_schedule, care_solution, follow_up_date, fitting_notes,
-                     professional_assessment, patient_feedback, json.dumps(file_paths)))
+                     professional_assessment, patient_feedback, json.dumps([f['path'] for f in stored_files])))
                 
-                conn.commit()
+                attachment_ids = link_attachments(c, 'contact_lens_prescriptions', c.lastrowid, stored_files)
+                get_conn().commit()
+                invalidate_records('contact_lens_prescriptions')
+                process_attachments(attachment_ids)
                 st.success("Contact lens prescription saved successfully!")
                 st.session_state.exam_step = "generate_report"
                 st.rerun()
@@ -2946,42 +4916,23 @@ def generate_patient_report():
         st.error("No patient selected.")
         return
     
-    pid_code = st.session_state.selected_patient
+    p = get_patient_context()
+    if p is None:
+        st.error("Patient not found.")
+        return
     
     try:
-        # Get patient info
-        p = pd.read_sql("SELECT * FROM patients WHERE patient_id = ?", conn, params=(pid_code,)).iloc[0]
         
         # Get all examination data
-        medical_data = pd.read_sql('''
-            SELECT * FROM medical_history 
-            WHERE patient_id = (SELECT id FROM patients WHERE patient_id = ?) 
-            ORDER BY visit_date DESC LIMIT 1
-        ''', conn, params=(pid_code,))
-        
-        refraction_data = pd.read_sql('''
-            SELECT * FROM refraction_exams 
-            WHERE patient_id = (SELECT id FROM patients WHERE patient_id = ?) 
-            ORDER BY exam_date DESC LIMIT 1
-        ''', conn, params=(pid_code,))
-        
-        anterior_data = pd.read_sql('''
-            SELECT * FROM anterior_segment_exams 
-            WHERE patient_id = (SELECT id FROM patients WHERE patient_id = ?) 
-            ORDER BY exam_date DESC LIMIT 1
-        ''', conn, params=(pid_code,))
-        
-        posterior_data = pd.read_sql('''
-            SELECT * FROM posterior_segment_exams 
-            WHERE patient_id = (SELECT id FROM patients WHERE patient_id = ?) 
-            ORDER BY exam_date DESC LIMIT 1
-        ''', conn, params=(pid_code,))
-        
-        cl_data = pd.read_sql('''
-            SELECT * FROM contact_lens_prescriptions 
-            WHERE patient_id = (SELECT id FROM patients WHERE patient_id = ?) 
-            ORDER BY prescription_date DESC LIMIT 1
-        ''', conn, params=(pid_code,))
+        medical_data = load_patient_records('medical_history', p['id'], 'visit_date', limit=1)
+        
+        refraction_data = load_patient_records('refraction_exams', p['id'], 'exam_date', limit=1, source='refraction_exams_wide_all')
+        
+        anterior_data = load_patient_records('anterior_segment_exams', p['id'], 'exam_date', limit=1)
+        
+        posterior_data = load_patient_records('posterior_segment_exams', p['id'], 'exam_date', limit=1)
+        
+        cl_data = load_patient_records('contact_lens_prescriptions', p['id'], 'prescription_date', limit=1)
 
         # Custom Report Notes
         st.markdown("#### Clinical Assessment & Recommendations")
@@ -3252,18 +5203,15 @@ def generate_prescription_report():
         st.error("No patient selected.")
         return
     
-    pid_code = st.session_state.selected_patient
+    p = get_patient_context()
+    if p is None:
+        st.error("Patient not found.")
+        return
     
     try:
-        # Get patient info
-        p = pd.read_sql("SELECT * FROM patients WHERE patient_id = ?", conn, params=(pid_code,)).iloc[0]
         
         # Get latest refraction
-        refraction_data = pd.read_sql('''
-            SELECT * FROM refraction_exams 
-            WHERE patient_id = (SELECT id FROM patients WHERE patient_id = ?) 
-            ORDER BY exam_date DESC LIMIT 1
-        ''', conn, params=(pid_code,))
+        refraction_data = load_patient_records('refraction_exams', p['id'], 'exam_date', limit=1, source='refraction_exams_wide_all')
         
         if refraction_data.empty:
             st.error("No refraction data found for this patient.")
@@ -3539,12 +5487,12 @@ def generate_report():
         st.error("No patient selected.")
         return
     
-    pid_code = st.session_state.selected_patient
+    p = get_patient_context()
+    if p is None:
+        st.error("Patient not found.")
+        return
     
     try:
-        # Get patient info
-        p = pd.read_sql("SELECT * FROM patients WHERE patient_id = ?", conn, params=(pid_code,)).iloc[0]
-        
         # Navigation
         col_nav = st.columns(3)
         with col_nav[0]:
@@ -3617,19 +5565,196 @@ def patient_registration():
                         # Auto-generate patient ID
                         patient_id = f"PAT{int(datetime.now().timestamp())}"
                     
-                    c = conn.cursor()
+                    c = get_conn().cursor()
                     c.execute('''
                         INSERT INTO patients 
                         (patient_id, first_name, last_name, date_of_birth, gender, phone, email, address, id_number, emergency_contact, insurance_info)
                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                     ''', (patient_id, first_name, last_name, date_of_birth, gender, phone, email, address, id_number, emergency_contact, insurance_info))
-                    conn.commit()
+                    index_patient_names(c, [(c.lastrowid, first_name, last_name)])
+                    get_conn().commit()
                     st.success(f"Patient registered successfully! Patient ID: **{patient_id}**")
                 except sqlite3.IntegrityError:
                     st.error("Patient ID already exists. Please choose a different ID.")
                 except Exception as e:
                     st.error(f"Database error: {str(e)}")
 
+PATIENT_SEARCH_PAGE_SIZES = [25, 50, 100]
+PATIENT_COUNT_LIMIT = 1000  # matches counted before the total is shown as "1000+"
+PATIENT_PICKER_LIMIT = 20  # candidates offered per patient lookup
+FUZZY_CANDIDATES = 200  # patients sharing the most trigrams with the query, scored in Python
+FUZZY_POSTINGS_BUDGET = 8000  # trigram index entries read per search; the rarest trigrams go first
+FUZZY_MIN_SIMILARITY = 0.35
+FUZZY_RESULTS = 25
+
+# "Search by" modes -> searched columns
+PATIENT_SEARCH_FIELDS = {
+    "All Fields": PATIENT_FTS_COLUMNS,
+    "Patient ID": ['patient_id'],
+    "Name": ['first_name', 'last_name', 'name_norm'],
+    "Phone": ['phone'],
+    "ID Number": ['id_number'],
+    "Fuzzy Name": ['first_name', 'last_name'],
+}
+
+def _name_similarity(query_words, query_grams, name):
+    """(per-word, whole-name) trigram similarity of a folded name to the query.
+
+    Per-word: mean over the query words of the best Jaccard against any name
+    word, so "simic" fully matches "Željko Šimić". Whole-name Jaccard breaks
+    ties in favour of names without extra words."""
+    name_words = (name or '').split()
+    if not name_words:
+        return 0.0, 0.0
+    word_grams = [name_trigrams(word) for word in name_words]
+    per_word = sum(max(len(grams & other) / len(grams | other) for other in word_grams)
+                   for grams in map(name_trigrams, query_words)) / len(query_words)
+    whole = set().union(*word_grams)
+    return per_word, len(query_grams & whole) / len(query_grams | whole)
+
+def _selective_trigrams(conn, grams, budget=FUZZY_POSTINGS_BUDGET):
+    """The rarest query trigrams whose index entries fit in `budget`.
+
+    A trigram like 'ic ' is in most Croatian surnames and says little; reading
+    its whole posting list would make every search cost O(patients)."""
+    counts = [(conn.execute("SELECT COUNT(*) FROM (SELECT 1 FROM patient_name_trigrams WHERE trigram = ? LIMIT ?)",
+                            (gram, budget)).fetchone()[0], gram) for gram in grams]
+    chosen, spent = [], 0
+    for count, gram in sorted(counts):
+        if chosen and spent + count > budget:
+            break
+        chosen.append(gram)
+        spent += count
+    return chosen
+
+def fuzzy_search_patients(text, limit=FUZZY_RESULTS, candidates=FUZZY_CANDIDATES):
+    """Patients whose folded name is most similar to `text` (typos, missing diacritics).
+
+    The trigram table narrows 100k+ patients to `candidates` rows sharing the
+    most selective trigrams with the query; only those are scored."""
+    conn = get_conn()
+    folded = fold_name(text)
+    grams = name_trigrams(folded)
+    if not grams:
+        return pd.DataFrame()
+    selective = _selective_trigrams(conn, sorted(grams))
+    ids = [patient_id for (patient_id,) in conn.execute(f'''
+        SELECT patient_id FROM patient_name_trigrams
+        WHERE trigram IN ({', '.join('?' * len(selective))})
+        GROUP BY patient_id
+        ORDER BY COUNT(*) DESC
+        LIMIT ?
+    ''', (*selective, candidates))]
+    if not ids:
+        return pd.DataFrame()
+    query_words = folded.split()
+    scored = []
+    for patient_id, name in conn.execute(f"SELECT id, name_norm FROM patients WHERE id IN ({', '.join('?' * len(ids))})", ids):
+        per_word, whole = _name_similarity(query_words, grams, name)
+        if per_word >= FUZZY_MIN_SIMILARITY:
+            scored.append((-per_word, -whole, name, patient_id))
+    best = {patient_id: -per_word for per_word, _, _, patient_id in sorted(scored)[:limit]}
+    if not best:
+        return pd.DataFrame()
+    df = pd.read_sql(f"SELECT * FROM patients WHERE id IN ({', '.join('?' * len(best))})", conn, params=list(best))
+    df['similarity'] = df['id'].map(best)
+    return df.set_index('id', drop=False).loc[list(best)].reset_index(drop=True)  # keep the ranking order
+
+def patient_fts_query(text, columns):
+    """FTS5 MATCH expression: every typed word as a prefix, restricted to `columns`.
+
+    Words are quoted so punctuation in the input ('-', '+', '"') can't be read
+    as query syntax, and folded like name_norm so "Đurđ" finds "durdevic".
+    Returns None when the input has no searchable word."""
+    words = re.findall(r"\w+", text.lower().translate(NAME_FOLD_EXTRA))
+    if not words:
+        return None
+    terms = " ".join('"' + word.replace('"', '""') + '"*' for word in words)
+    if columns == PATIENT_FTS_COLUMNS:
+        return terms
+    return "{" + " ".join(columns) + "} : (" + terms + ")"
+
+def patient_number_query(text, columns):
+    """FTS5 MATCH expression for `text` anywhere inside the number columns among `columns`.
+
+    Phones are matched on the query's digits. None when the query has no
+    digit or no value reaches PATIENT_NUMBER_MIN_LENGTH."""
+    digits = re.sub(r"\D", "", text)
+    if not digits:
+        return None
+    terms = []
+    for column in columns:
+        if column not in PATIENT_NUMBER_COLUMNS:
+            continue
+        value = digits if column == 'phone' else text.strip()
+        if len(value) >= PATIENT_NUMBER_MIN_LENGTH:
+            terms.append(f'{column} : "' + value.replace('"', '""') + '"')
+    return " OR ".join(terms) or None
+
+def _patient_match_filter(conn, text, search_type):
+    """(WHERE clause over `patients p`, params) for a search box query."""
+    columns = PATIENT_SEARCH_FIELDS[search_type]
+    match = patient_fts_query(text, columns)
+    if match and scalar("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'patients_fts'", conn=conn):
+        clauses, params = ["p.id IN (SELECT rowid FROM patients_fts WHERE patients_fts MATCH ?)"], [match]
+        numbers = patient_number_query(text, columns)
+        if numbers:
+            clauses.append("p.id IN (SELECT rowid FROM patient_numbers_fts WHERE patient_numbers_fts MATCH ?)")
+            params.append(numbers)
+    else:
+        # No FTS5 in this SQLite build, or nothing word-like to match on
+        clauses, params = [f"p.{column} LIKE ?" for column in columns], [f"%{text}%"] * len(columns)
+        digits = re.sub(r"\D", "", text)
+        if 'phone' in columns and digits:
+            clauses.append(f"{phone_digits_sql('p.phone')} LIKE ?")
+            params.append(f"%{digits}%")
+    return "(" + " OR ".join(clauses) + ")", params
+
+def search_patients(text, search_type="All Fields", after=None, page_size=PATIENT_SEARCH_PAGE_SIZES[0]):
+    """One page of patients matching `text`, ordered by (last_name, first_name, id).
+
+    Keyset pagination: `after` is the (last_name, first_name, id) of the last
+    row of the previous page, so page N costs the same as page 1. Fuzzy Name
+    results are ranked by similarity instead and come back as one short page."""
+    if search_type == "Fuzzy Name":
+        return fuzzy_search_patients(text)
+    conn = get_conn()
+    where, params = _patient_match_filter(conn, text, search_type)
+    if after is not None:
+        where += " AND (p.last_name, p.first_name, p.id) > (?, ?, ?)"
+        params += list(after)
+    return pd.read_sql(f'''
+        SELECT p.* FROM patients p
+        WHERE {where}
+        ORDER BY p.last_name, p.first_name, p.id
+        LIMIT ?
+    ''', conn, params=params + [page_size])
+
+def find_patients_by_prefix(text, limit=PATIENT_PICKER_LIMIT):
+    """The first `limit` (patient_id, first_name, last_name) rows matching `text`, by surname.
+
+    Same matching as the "All Fields" search, ordered by idx_patients_name
+    before the LIMIT, so the candidates are the alphabetically first matches
+    rather than whichever postings the index returned first."""
+    if not patient_fts_query(text, PATIENT_FTS_COLUMNS):
+        return []
+    conn = get_conn()
+    where, params = _patient_match_filter(conn, text, "All Fields")
+    return rows(f'''
+        SELECT p.patient_id, p.first_name, p.last_name FROM patients p
+        WHERE {where}
+        ORDER BY p.last_name, p.first_name, p.id
+        LIMIT ?
+    ''', params + [limit], conn=conn)
+
+def count_patient_matches(text, search_type="All Fields", limit=PATIENT_COUNT_LIMIT):
+    """Matches of a search, counting no further than `limit` + 1 (shown as "1000+")."""
+    if search_type == "Fuzzy Name":
+        return None
+    conn = get_conn()
+    where, params = _patient_match_filter(conn, text, search_type)
+    return scalar(f"SELECT COUNT(*) FROM (SELECT 1 FROM patients p WHERE {where} LIMIT ?)", params + [limit + 1], conn=conn)
+
 def patient_search():
     st.markdown("<h2 class='main-header'>Patient Search & Records</h2>", unsafe_allow_html=True)
     
@@ -3639,75 +5764,110 @@ def patient_search():
                                    placeholder="Enter patient ID, name, phone, or ID number...", key="search_query")
     with col_search2:
         search_type = st.selectbox("Search by", 
-                                 ["All Fields", "Patient ID", "Name", "Phone", "ID Number"], key="search_type")
+                                 list(PATIENT_SEARCH_FIELDS), key="search_type")
     
     if search_query:
         try:
-            if search_type == "All Fields":
-                df = pd.read_sql('''
-                    SELECT * FROM patients 
-                    WHERE patient_id LIKE ? OR first_name LIKE ? OR last_name LIKE ? OR phone LIKE ? OR id_number LIKE ?
-                    ORDER BY last_name, first_name
-                ''', conn, params=(f'%{search_query}%', f'%{search_query}%', f'%{search_query}%', f'%{search_query}%', f'%{search_query}%'))
-            elif search_type == "Patient ID":
-                df = pd.read_sql('SELECT * FROM patients WHERE patient_id LIKE ? ORDER BY patient_id', 
-                               conn, params=(f'%{search_query}%',))
-            elif search_type == "Name":
-                df = pd.read_sql('SELECT * FROM patients WHERE first_name LIKE ? OR last_name LIKE ? ORDER BY last_name, first_name', 
-                               conn, params=(f'%{search_query}%', f'%{search_query}%'))
-            elif search_type == "Phone":
-                df = pd.read_sql('SELECT * FROM patients WHERE phone LIKE ? ORDER BY last_name, first_name', 
-                               conn, params=(f'%{search_query}%',))
-            else:  # ID Number
-                df = pd.read_sql('SELECT * FROM patients WHERE id_number LIKE ? ORDER BY last_name, first_name', 
-                               conn, params=(f'%{search_query}%',))
-            
+            page_size = st.session_state.get("search_page_size", PATIENT_SEARCH_PAGE_SIZES[0])
+            # Page cursors: the keyset of the last row of every page before the current one
+            search_key = (search_query, search_type, page_size)
+            if st.session_state.get("search_key") != search_key:
+                st.session_state.search_key = search_key
+                st.session_state.search_cursors = []
+                st.session_state.search_total = None  # counted once per search, not on every rerun
+            cursors = st.session_state.search_cursors
+            after = cursors[-1] if cursors else None
+
+            page = search_patients(search_query, search_type, after=after, page_size=page_size + 1)
+            has_next = len(page) > page_size
+            df = page.head(page_size).reset_index(drop=True)
+
             if df.empty:
                 st.info("No patients found matching your search criteria.")
             else:
-                st.success(f"Found {len(df)} patient(s)")
-                
-                for idx, row in df.iterrows():
-                    with st.expander(f"{row['patient_id']} - {row['first_name']} {row['last_name']}"):
-                        col_info1, col_info2 = st.columns(2)
-                        
-                        with col_info1:
-                            st.write(f"**Date of Birth:** {format_date_for_display(row['date_of_birth'])}")
-                            st.write(f"**Gender:** {row['gender']}")
-                            st.write(f"**Phone:** {row['phone']}")
+                if st.session_state.search_total is None:
+                    st.session_state.search_total = count_patient_matches(search_query, search_type)
+                total = st.session_state.search_total
+                first = len(cursors) * page_size + 1
+                if total is None:
+                    st.success(f"Found {len(df)} similar name(s), best match first")
+                else:
+                    found = f"{PATIENT_COUNT_LIMIT}+" if total > PATIENT_COUNT_LIMIT else total
+                    st.success(f"Found {found} patient(s) - showing {first}-{first + len(df) - 1}")
+
+                table = pd.DataFrame({
+                    'Patient ID': df['patient_id'],
+                    'Last Name': df['last_name'],
+                    'First Name': df['first_name'],
+                    'Date of Birth': df['date_of_birth'].map(format_date_for_display),
+                    'Phone': df['phone'],
+                    'ID Number': df['id_number'],
+                })
+                # One widget per search and page: a selected row must not carry over to other results
+                results_key = hashlib.sha1(repr((search_key, after)).encode()).hexdigest()[:12]
+                selection = st.dataframe(table, use_container_width=True, hide_index=True,
+                                         on_select="rerun", selection_mode="single-row",
+                                         key=f"search_results_{results_key}")
+
+                col_prev, col_size, col_next = st.columns([1, 1, 1])
+                with col_prev:
+                    if cursors and st.button("Previous", use_container_width=True, key="search_prev"):
+                        cursors.pop()
+                        st.rerun()
+                with col_size:
+                    st.selectbox("Rows per page", PATIENT_SEARCH_PAGE_SIZES, key="search_page_size",
+                                 label_visibility="collapsed")
+                with col_next:
+                    if has_next and st.button("Next", use_container_width=True, key="search_next"):
+                        last = df.iloc[-1]
+                        cursors.append((last['last_name'], last['first_name'], int(last['id'])))
+                        st.rerun()
+
+                selected_rows = [i for i in selection.selection.rows if i < len(df)]
+                if not selected_rows:
+                    st.caption("Select a row to open the patient's record actions.")
+                else:
+                    row = df.iloc[selected_rows[0]]
+                    st.markdown(f"**{row['patient_id']} - {row['first_name']} {row['last_name']}**")
+                    col_info1, col_info2 = st.columns(2)
+
+                    with col_info1:
+                        st.write(f"**Date of Birth:** {format_date_for_display(row['date_of_birth'])}")
+                        st.write(f"**Gender:** {row['gender']}")
+                        st.write(f"**Phone:** {row['phone']}")
+
+                    with col_info2:
+                        st.write(f"**Email:** {row['email']}")
+                        st.write(f"**ID Number:** {row['id_number']}")
+                        st.write(f"**Registered:** {format_date_for_display(row['created_date'])}")
+
+                    # Action buttons
+                    col_act1, col_act2, col_act3, col_act4 = st.columns(4)
+
+                    with col_act1:
+                        if st.button("Begin Exam", key=f"exam_{row['id']}"):
+                            st.session_state.selected_patient = row['patient_id']
+                            st.session_state.menu = "Examination Protocol"
+                            st.session_state.exam_step = "medical_history"
+                            st.rerun()
+                            
+                    with col_act2:
+                        if st.button("View History", key=f"history_{row['id']}"):
+                            st.session_state.selected_patient = row['patient_id']
+                            st.info(f"Showing history for {row['first_name']} {row['last_name']}")
+                            
+                    with col_act3:
+                        if st.button("Contact Lenses", key=f"cl_{row['id']}"):
+                            st.session_state.selected_patient = row['patient_id']
+                            st.session_state.menu = "Contact Lenses"
+                            st.rerun()
+                            
+                    with col_act4:
+                        if st.button("Schedule", key=f"schedule_{row['id']}"):
+                            st.session_state.selected_patient = row['patient_id']
+                            st.session_state.menu = "Schedule Appointment"
+                            st.rerun()
                             
-                        with col_info2:
-                            st.write(f"**Email:** {row['email']}")
-                            st.write(f"**ID Number:** {row['id_number']}")
-                            st.write(f"**Registered:** {format_date_for_display(row['created_date'])}")
-                        
-                        # Action buttons
-                        col_act1, col_act2, col_act3, col_act4 = st.columns(4)
-                        
-                        with col_act1:
-                            if st.button("Begin Exam", key=f"exam_{row['id']}"):
-                                st.session_state.selected_patient = row['patient_id']
-                                st.session_state.menu = "Examination Protocol"
-                                st.session_state.exam_step = "medical_history"
-                                st.rerun()
-                                
-                        with col_act2:
-                            if st.button("View History", key=f"history_{row['id']}"):
-                                st.session_state.selected_patient = row['patient_id']
-                                st.info(f"Showing history for {row['first_name']} {row['last_name']}")
-                                
-                        with col_act3:
-                            if st.button("Contact Lenses", key=f"cl_{row['id']}"):
-                                st.session_state.selected_patient = row['patient_id']
-                                st.session_state.menu = "Contact Lenses"
-                                st.rerun()
-                                
-                        with col_act4:
-                            if st.button("Schedule", key=f"schedule_{row['id']}"):
-                                st.session_state.selected_patient = row['patient_id']
-                                st.session_state.menu = "Schedule Appointment"
-                                st.rerun()
-                                
         except Exception as e:
             st.error(f"Search error: {str(e)}")
 
@@ -3722,7 +5882,7 @@ def user_management():
         
     st.markdown("<h2 class='main-header'>User Management & License Control</h2>", unsafe_allow_html=True)
     
-    tab1, tab2, tab3, tab4 = st.tabs(["User Management", "Appointment Schedule", "Patient Groups", "Clinic Settings"])
+    tab1, tab2, tab3, tab4, tab5 = st.tabs(["User Management", "Appointment Schedule", "Patient Groups", "Clinic Settings", "Data Maintenance"])
     
     with tab1:
         st.markdown("#### Add New User")
@@ -3740,13 +5900,13 @@ def user_management():
             if submit_user:
                 if new_username and new_password:
                     try:
-                        c = conn.cursor()
+                        c = get_conn().cursor()
                         password_hash = hash_password(new_password)
                         c.execute('''
                             INSERT INTO users (username, password_hash, role, license_expiry)
                             VALUES (?, ?, ?, ?)
                         ''', (new_username, password_hash, new_role, license_expiry))
-                        conn.commit()
+                        get_conn().commit()
                         st.success(f"User {new_username} added successfully!")
                     except sqlite3.IntegrityError:
                         st.error("Username already exists.")
@@ -3758,9 +5918,9 @@ def user_management():
         st.markdown("#### Existing Users")
         try:
             # FIXED: Koristimo ispravan SQL upit sa postojećim stupcima
-            users_df = pd.read_sql("SELECT id, username, role, license_expiry FROM users ORDER BY username", conn)
-            if not users_df.empty:
-                for _, user in users_df.iterrows():
+            users = rows("SELECT id, username, role, license_expiry FROM users ORDER BY username")
+            if users:
+                for user in users:
                     col_user, col_role, col_license, col_action = st.columns([2, 1, 1, 1])
                     with col_user:
                         st.write(user['username'])
@@ -3776,9 +5936,9 @@ def user_management():
                     with col_action:
                         if user['username'] != st.session_state.username:
                             if st.button("Delete", key=f"del_{user['id']}"):
-                                c = conn.cursor()
+                                c = get_conn().cursor()
                                 c.execute("DELETE FROM users WHERE id = ?", (user['id'],))
-                                conn.commit()
+                                get_conn().commit()
                                 st.success(f"User {user['username']} deleted.")
                                 st.rerun()
             else:
@@ -3807,7 +5967,7 @@ def user_management():
                 
                 if st.button(f"Save {day_name} Schedule", key=f"save_{day_idx}"):
                     try:
-                        c = conn.cursor()
+                        c = get_conn().cursor()
                         # Remove existing schedule for this day
                         c.execute("DELETE FROM appointment_schedule WHERE day_of_week = ?", (day_idx,))
                         # Insert new schedule
@@ -3816,7 +5976,7 @@ def user_management():
                             (day_of_week, start_time, end_time, appointment_duration, max_appointments, is_active)
                             VALUES (?, ?, ?, ?, ?, ?)
                         ''', (day_idx, start_time, end_time, duration, max_appts, is_active))
-                        conn.commit()
+                        get_conn().commit()
                         st.success(f"{day_name} schedule saved!")
                     except Exception as e:
                         st.error(f"Error saving schedule: {str(e)}")
@@ -3838,10 +5998,10 @@ def user_management():
         if st.button("Create New Group", use_container_width=True, key="create_group"):
             if new_group_name:
                 try:
-                    c = conn.cursor()
+                    c = get_conn().cursor()
                     c.execute("INSERT INTO patient_groups (group_name, description) VALUES (?, ?)", 
                              (new_group_name, new_group_desc))
-                    conn.commit()
+                    get_conn().commit()
                     st.success(f"Group '{new_group_name}' created successfully!")
                 except sqlite3.IntegrityError:
                     st.error("Group name already exists.")
@@ -3853,9 +6013,9 @@ def user_management():
         # Display existing groups
         st.markdown("#### Existing Patient Groups")
         try:
-            groups_df = pd.read_sql("SELECT * FROM patient_groups ORDER BY group_name", conn)
-            if not groups_df.empty:
-                for _, group in groups_df.iterrows():
+            groups = rows("SELECT id, group_name, description FROM patient_groups ORDER BY group_name")
+            if groups:
+                for group in groups:
                     col_grp1, col_grp2, col_grp3 = st.columns([3, 2, 1])
                     with col_grp1:
                         st.write(f"**{group['group_name']}**")
@@ -3863,9 +6023,9 @@ def user_management():
                         st.write(group['description'])
                     with col_grp3:
                         if st.button("Delete", key=f"del_grp_{group['id']}"):
-                            c = conn.cursor()
+                            c = get_conn().cursor()
                             c.execute("DELETE FROM patient_groups WHERE id = ?", (group['id'],))
-                            conn.commit()
+                            get_conn().commit()
                             st.success(f"Group '{group['group_name']}' deleted.")
                             st.rerun()
             else:
@@ -3894,14 +6054,90 @@ def user_management():
             st.image(current_logo, width=200)
             if st.button("Remove Logo", key="remove_logo"):
                 try:
-                    c = conn.cursor()
+                    c = get_conn().cursor()
                     c.execute("UPDATE clinic_settings SET clinic_logo = NULL")
-                    conn.commit()
+                    get_conn().commit()
                     st.success("Logo removed successfully!")
                     st.rerun()
                 except Exception as e:
                     st.error(f"Error removing logo: {str(e)}")
 
+        st.markdown("##### Analytics")
+        ttl_minutes = st.number_input("Refresh analytics figures every (minutes)", min_value=1, max_value=24 * 60,
+                                      value=max(1, analytics_cache_ttl() // 60), key="analytics_ttl_minutes")
+        if st.button("Save Analytics Settings", key="save_analytics_ttl"):
+            try:
+                save_analytics_cache_ttl(int(ttl_minutes) * 60)
+                st.success("Analytics settings saved!")
+            except Exception as e:
+                st.error(f"Error saving analytics settings: {str(e)}")
+
+    with tab5:
+        st.markdown("#### Exam Archive")
+        st.caption(f"Older exams move to archive files of {ARCHIVE_FILE_YEARS} years each. History and reports still show them.")
+        archived_years = archive_files()
+        if archived_years:
+            st.write("Archived years: " + ", ".join(archive_file_label(year) for year in archived_years))
+        keep_years = st.number_input("Years kept in the active database", min_value=1, max_value=50,
+                                     value=ARCHIVE_KEEP_YEARS, key="archive_keep_years")
+        if st.button("Archive Old Exams", key="archive_exams"):
+            try:
+                moved = archive_exams(DB_PATH, keep_years=int(keep_years))
+                for table in ARCHIVED_TABLES:
+                    invalidate_records(table)
+                if moved:
+                    st.success(f"Archived {sum(moved.values())} exams from {', '.join(str(year) for year in moved)}.")
+                else:
+                    st.info("No exams older than the archive horizon.")
+            except Exception as e:
+                st.error(f"Error archiving exams: {str(e)}")
+
+        st.markdown("#### Backups")
+        st.caption(f"A backup is taken every {BACKUP_INTERVAL // 60} minutes while the app is in use, without "
+                   "interrupting the clinic. Restore from the command line with "
+                   "`python app.py restore --at \"YYYY-MM-DD HH:MM\"` while the app is stopped: it returns the "
+                   "database to the newest backup taken at or before that time, so work saved after that "
+                   "backup is not recovered.")
+        if st.button("Back Up Now", key="backup_now"):
+            try:
+                with get_backup_scheduler()['running']:
+                    kind, path, pages = backup_database(DB_PATH)
+                st.success(f"{kind.capitalize()} backup saved ({pages} pages): {path}")
+            except Exception as e:
+                st.error(f"Backup failed: {str(e)}")
+        recent_backups = list_backups()[-10:]
+        if recent_backups:
+            st.dataframe(pd.DataFrame(
+                [(format_date_dmy(taken_at) + taken_at.strftime(" %H:%M:%S"), kind, f"{os.path.getsize(path) / 1024:.0f} KB")
+                 for taken_at, kind, path in reversed(recent_backups)],
+                columns=['Taken', 'Type', 'Size']
+            ), use_container_width=True, hide_index=True)
+
+        st.markdown("#### Bulk Import")
+        st.caption("CSV or JSON with one record per row. Exam records reference patients by their Patient ID.")
+        import_kind = st.selectbox("Import into", IMPORT_KINDS, key="import_kind")
+        import_file = st.file_uploader("Import file", type=['csv', 'json', 'jsonl', 'ndjson'], key="import_file")
+        if import_file and st.button("Start Import", key="start_import"):
+            status = st.empty()
+            def report(imported, rejected):
+                status.info(f"Imported {imported} rows, rejected {rejected}...")
+            try:
+                imported, rejected = import_records(
+                    get_conn(), import_kind, read_import_file(import_file, import_format(import_file.name)),
+                    progress=report
+                )
+                if import_kind != 'patients':
+                    invalidate_records(import_kind)
+                status.success(f"Imported {imported} rows into {import_kind}.")
+                if rejected:
+                    st.warning(f"{len(rejected)} rows were rejected.")
+                    st.dataframe(pd.DataFrame([(number, reason) for number, reason, _ in rejected[:200]],
+                                              columns=['Record', 'Reason']), use_container_width=True)
+                    st.download_button("Download Rejected Rows", rejected_rows_csv(rejected),
+                                       file_name=f"rejected_{import_kind}.csv", mime="text/csv")
+            except Exception as e:
+                status.error(f"Import failed: {str(e)}")
+
 # -----------------------
 # MODERN TOP NAVIGATION
 # -----------------------
@@ -4070,12 +6306,176 @@ def main():
                 st.rerun()
         
         st.markdown("---")
+        schedule_backup()
+        schedule_blob_collection()
         main_navigation()
 
-# Initialize database connection
-conn = init_db()
+# -----------------------
+# COMMAND LINE (python app.py <command>)
+# -----------------------
+def cli(argv):
+    parser = argparse.ArgumentParser(prog="app.py", description="OphtalCAM maintenance commands")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_migrate = sub.add_parser("migrate", help="apply pending schema migrations and report their timings")
+    p_migrate.add_argument("--db", default=DB_PATH, help="database file (use a copy to benchmark a migration)")
+    p_migrate.add_argument("--check", action="store_true",
+                           help="instead, migrate a scratch database shaped like a pre-migration install")
+
+    p_archive = sub.add_parser("archive", help=f"move old exams into archive files of {ARCHIVE_FILE_YEARS} years each")
+    p_archive.add_argument("--db", default=DB_PATH, help="hot database file")
+    p_archive.add_argument("--keep-years", type=int, default=ARCHIVE_KEEP_YEARS,
+                           help="calendar years (including the current one) kept in the hot file")
+    p_archive.add_argument("--vacuum", action="store_true", help="compact the hot file afterwards")
+    p_archive.add_argument("--consolidate", action="store_true",
+                           help="first fold per-year archive files into their period file (stop the app before)")
+
+    p_import = sub.add_parser("import", help="bulk import patients or exams from CSV / JSON")
+    p_import.add_argument("kind", choices=IMPORT_KINDS)
+    p_import.add_argument("file")
+    p_import.add_argument("--db", default=DB_PATH, help="database file")
+    p_import.add_argument("--format", choices=("csv", "json", "jsonl"), help="default: from the file extension")
+    p_import.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE, help="rows per transaction")
+    p_import.add_argument("--rejects", help="write rejected records to this CSV file")
+
+    p_backup = sub.add_parser("backup", help="online backup of the live database")
+    p_backup.add_argument("--db", default=DB_PATH, help="database file")
+    p_backup.add_argument("--dir", default=BACKUP_DIR, help="backup directory")
+    p_backup.add_argument("--full", action="store_true", help="take a full snapshot instead of an incremental one")
+
+    p_restore = sub.add_parser("restore", help="rebuild the database as of the newest backup at or before a time")
+    p_restore.add_argument("--at", required=True,
+                           help="timestamp, e.g. '2025-03-04 14:30'; changes after the backup found are not "
+                                f"recovered (the app backs up every {BACKUP_INTERVAL // 60} minutes)")
+    p_restore.add_argument("--output", default="ophtalcam_restored.db", help="file to write (stop the app before replacing the live file)")
+    p_restore.add_argument("--dir", default=BACKUP_DIR, help="backup directory")
+    p_restore.add_argument("--force", action="store_true", help="overwrite the output file if it exists")
+
+    p_export = sub.add_parser("export-analytics", help="append new rows to the Parquet analytics copy")
+    p_export.add_argument("--db", default=DB_PATH, help="database file")
+    p_export.add_argument("--rebuild", action="store_true", help="discard the copy and export everything again")
+
+    p_blobs = sub.add_parser("gc-blobs", help="delete uploaded files no attachment refers to")
+    p_blobs.add_argument("--db", default=DB_PATH, help="database file")
+    p_blobs.add_argument("--grace", type=int, default=BLOB_GC_GRACE,
+                         help="seconds a file must be untouched before it is removed")
+
+    p_counters = sub.add_parser("rebuild-counters", help="recount the dashboard daily_counters table")
+    p_counters.add_argument("--db", default=DB_PATH, help="database file")
+
+    p_bench = sub.add_parser("bench", help="time the dashboard count queries: pd.read_sql vs scalar()")
+    p_bench.add_argument("--db", default=DB_PATH, help="database file")
+    p_bench.add_argument("-n", type=int, default=2000, help="iterations per query")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "migrate":
+        if args.check:
+            applied = check_migrations()
+            print(f"{len(applied)} migration(s) applied to a pre-migration database")
+            return 0
+        applied = ConnectionPool(args.db).migrate()
+        total = sum(elapsed for _, _, elapsed in applied)
+        print(f"{len(applied)} migration(s) applied to {args.db} in {total:.3f}s")
+    elif args.command == "rebuild-counters":
+        pool = ConnectionPool(args.db)
+        pool.migrate()
+        conn = pool.connection()
+        started = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rebuild_daily_counters(conn)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        rows_written = scalar("SELECT COUNT(*) FROM daily_counters", conn=conn)
+        print(f"Rebuilt {rows_written} counter row(s) in {time.perf_counter() - started:.2f}s")
+    elif args.command == "archive":
+        if args.consolidate:
+            folded = consolidate_archives(args.db)
+            print(f"{sum(map(len, folded.values()))} per-year archive file(s) folded into {len(folded)} period file(s)")
+        moved = archive_exams(args.db, keep_years=args.keep_years, vacuum=args.vacuum)
+        print(f"{sum(moved.values())} exam(s) from {len(moved)} year(s) archived")
+    elif args.command == "backup":
+        started = time.perf_counter()
+        kind, path, pages = backup_database(args.db, args.dir, full=args.full)
+        print(f"{kind.capitalize()} backup written to {path} ({pages} page(s)) in {time.perf_counter() - started:.1f}s")
+    elif args.command == "restore":
+        if os.path.exists(args.output) and not args.force:
+            print(f"{args.output} already exists; use --force to overwrite it")
+            return 1
+        at = datetime.fromisoformat(args.at)
+        try:
+            restored_at = restore_database(at, args.output, args.dir)
+        except ValueError as e:
+            print(e)
+            return 1
+        print(f"Restored the backup taken {restored_at:%Y-%m-%d %H:%M:%S} to {args.output}")
+        if restored_at < at:
+            print(f"Changes saved between {restored_at:%Y-%m-%d %H:%M:%S} and {at:%Y-%m-%d %H:%M:%S} are not included")
+    elif args.command == "gc-blobs":
+        removed, freed = collect_orphan_blobs(ConnectionPool(args.db).connection(), grace=args.grace)
+        print(f"Removed {removed} orphaned blob(s), {freed / 1e6:.1f} MB")
+    elif args.command == "export-analytics":
+        conn = ConnectionPool(args.db).connection()
+        started = time.perf_counter()
+        appended = export_analytics(conn, rebuild=args.rebuild)
+        for dataset, rows in appended.items():
+            print(f"  {dataset}: {rows} row(s)")
+        print(f"Analytics copy updated in {time.perf_counter() - started:.1f}s")
+    elif args.command == "bench":
+        conn = ConnectionPool(args.db).connection()
+        queries = [
+            ("SELECT COUNT(*) FROM patients", ()),
+            ("SELECT COUNT(*) FROM patients WHERE created_date >= ? AND created_date < ?", day_bounds()),
+            ("SELECT COUNT(*) FROM appointments WHERE appointment_date >= ? AND appointment_date < ?", day_bounds()),
+            ("SELECT COUNT(*) FROM refraction_exams WHERE exam_date >= ? AND exam_date < ?", day_bounds()),
+            ("SELECT COUNT(*) FROM contact_lens_prescriptions_all", ()),
+        ]
+        print(f"{'query':<60} {'read_sql':>10} {'scalar':>10}")
+        for sql, params in queries:
+            started = time.perf_counter()
+            for _ in range(args.n):
+                pd.read_sql(sql, conn, params=params).iloc[0, 0]
+            with_pandas = (time.perf_counter() - started) / args.n
+            started = time.perf_counter()
+            for _ in range(args.n):
+                scalar(sql, params, conn=conn)
+            with_cursor = (time.perf_counter() - started) / args.n
+            print(f"{sql[:60]:<60} {with_pandas * 1e6:>8.0f}us {with_cursor * 1e6:>8.0f}us")
+        started = time.perf_counter()
+        for _ in range(args.n):
+            clinic_metrics(conn=conn)
+        print(f"{'clinic_metrics() (all tiles)':<60} {'':>10} {(time.perf_counter() - started) / args.n * 1e6:>8.0f}us")
+    elif args.command == "import":
+        pool = ConnectionPool(args.db)
+        pool.migrate()
+        conn = pool.connection()
+        started = time.perf_counter()
+        def report(imported, rejected):
+            elapsed = time.perf_counter() - started
+            print(f"{imported} imported, {rejected} rejected ({imported / elapsed:.0f} rows/s)")
+        with open(args.file, "rb") as f:
+            records = read_import_file(f, args.format or import_format(args.file))
+            imported, rejected = import_records(conn, args.kind, records, batch_size=args.batch_size, progress=report)
+        print(f"Imported {imported} {args.kind} row(s) in {time.perf_counter() - started:.1f}s, rejected {len(rejected)}")
+        if rejected and args.rejects:
+            with open(args.rejects, "w", newline="", encoding="utf-8") as out:
+                out.write(rejected_rows_csv(rejected))
+            print(f"Rejected records written to {args.rejects}")
+        elif rejected:
+            for number, reason, _ in rejected[:20]:
+                print(f"  record {number}: {reason}")
+    return 0
+
+CLI_COMMANDS = ("migrate", "archive", "import", "backup", "restore", "export-analytics", "gc-blobs", "rebuild-counters", "bench")
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in CLI_COMMANDS:
+        sys.exit(cli(sys.argv[1:]))
+    # Initialize database (schema + connection pool) once per process
+    init_db()
     main()
 
 